@@ -1,95 +1,214 @@
-import sys
-from typing import Dict, List, Set
-import matplotlib.pyplot as plt
-import subprocess
-
-def weighted_count(curr_set: Set[str], data: Dict[str, float]):
-    
-    for ele in curr_set:
-        incr = 1/len(ele)
-        if ele not in data.keys():
-            data.update({ele:incr})
-        else:
-            data[ele] += incr
-
-def count_set(key:int, curr_set: Set[str], data: Dict[int, Dict[str, int]]):
-    
-    for ele in curr_set:
-        if ele in data[key].keys():
-            data[key][ele] += 1
-        else:
-            data[key].update({ele:1})
-
-def analyze_locations(filename):
-    
-    common_switch_count: Dict[int, int] = dict()
-    per_line_per_switch_count: Dict[int, Dict[str, int]] = dict()
-    weighted_per_switch_count: Dict[str, float] = dict()
-    accesse_per_line: Dict[int, int] = dict()
-    
+import json
+import argparse
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+import switch_log
+
+#Events per chunk when reading the text format
+TEXT_CHUNK = 1 << 20
+
+def label_order(label:str):
+    #S2 before S10
+    return (label[0], int(label[1:]) if label[1:].isdigit() else label[1:])
+
+def read_text_events(filename:str,labels:List[str],addresses:List[int],chunk_events:int=TEXT_CHUNK)->Iterator[Tuple[np.ndarray,np.ndarray]]:
+    '''
+    Stream switch_loc.json as (address ids, location bits) chunks, like switch_log.read_events
+    Labels and addresses are discovered while reading and appended to the given lists
+    '''
+    label_bit: Dict[str,int] = {label:i for i,label in enumerate(labels)}
+    addr_ids: Dict[int,int] = dict()
+    #The same few switch sets repeat, so every distinct line is only split once
+    line_bits: Dict[str,List[int]] = dict()
+    ids: List[int] = []
+    rows: List[List[int]] = []
+    addr_id = None
+
+    def chunk():
+        bits = np.zeros((len(ids),len(labels)),dtype=np.uint8)
+        event = np.repeat(np.arange(len(ids)),[len(r) for r in rows])
+        bits[event,np.concatenate(rows).astype(np.int64) if rows else []] = 1
+        return np.array(ids,dtype=np.uint32), bits
+
     with open(filename) as file:
-        addr = None
-        first_line = False
-        curr_set = set()
-        last_set = set()
-        while True:
-            line = file.readline()
-            if not line:
-                break
+        for line in file:
             if line.startswith('0x'):
                 addr = int(line.strip(),16)
-                if addr not in common_switch_count.keys():
-                    common_switch_count.update({addr:0})
-                if addr not in per_line_per_switch_count.keys():
-                    per_line_per_switch_count.update({addr:dict()})
-                if addr not in accesse_per_line.keys():
-                    accesse_per_line.update({addr:1})
-                else:
-                    accesse_per_line[addr] += 1
-            else:
-                curr_set = set([x.strip() for x in line.split(',')])
-                count_set(addr,curr_set,per_line_per_switch_count)
-                weighted_count(curr_set,weighted_per_switch_count)
-                common = last_set.intersection(curr_set)
-                # print(f"{hex(addr)},{last_set},{curr_set},{common}")
-                if len(common) == 0:
-                    common_switch_count[addr] += 1
-                # print(f"{hex(addr)},{len(common)}")
-                last_set = curr_set
-        
-    print(per_line_per_switch_count)
-    print(weighted_per_switch_count)
-    
-    switch_names = ["S0","S1","S2","S3","S4","S5","S6","S7","S8"]
-    lines_per_switch: Dict[str, float] = {s:0 for s in switch_names}
-    for addr in per_line_per_switch_count.keys():
-        weight = accesse_per_line[addr]
-        for switchname,count in per_line_per_switch_count[addr].items():
-            lines_per_switch[switchname] += weight * count/sum(per_line_per_switch_count[addr].values()) 
-    
-    # final_val = {key:val/sum(accesse_per_line.values()) for key,val in lines_per_switch.items()}               
-    
-    final_val = lines_per_switch
-    print(final_val)
-    print(sum(final_val.values()))
-    
-    # plt.figure(1)
-    # x = range(len(weighted_per_switch_count))
-    # y = [x/49771 for x in weighted_per_switch_count.values()]
-    # x_label = weighted_per_switch_count.keys()
-    # plt.figure(1)
-    x = range(len(final_val))
-    y = [x for x in final_val.values()]
-    x_label = final_val.keys()
-    plt.xlabel("Switches")
-    plt.ylabel("Number of cachelines")
-    plt.bar(x,y)
-    plt.xticks(ticks=x,labels=x_label)
-    plt.savefig(f"switch_distribution.png")
-    
-    
+                addr_id = addr_ids.get(addr)
+                if addr_id == None:
+                    addr_id = len(addresses)
+                    addr_ids[addr] = addr_id
+                    addresses.append(addr)
+                continue
+            row = line_bits.get(line)
+            if row == None:
+                row = []
+                for label in line.strip().split(','):
+                    if label not in label_bit:
+                        label_bit[label] = len(labels)
+                        labels.append(label)
+                    row.append(label_bit[label])
+                line_bits[line] = row
+            ids.append(addr_id)
+            rows.append(row)
+            if len(ids) == chunk_events:
+                yield chunk()
+                ids = []
+                rows = []
+    if ids:
+        yield chunk()
+
+class LocationStats:
+    '''
+    Grouped reductions over a stream of (address id, location bits) events
+    Per address state is a few arrays indexed by address id, nothing grows with the number of events
+    '''
+
+    def __init__(self):
+        self.num_labels = 0
+        self.num_addrs = 0
+        #Events per (address, location)
+        self.counts = np.zeros((0,0),dtype=np.int64)
+        self.accesses = np.zeros(0,dtype=np.int64)
+        #Events whose ideal locations share nothing with the previous event of the same line
+        self.changes = np.zeros(0,dtype=np.int64)
+        self.last_bits = np.zeros((0,0),dtype=np.uint8)
+        self.seen = np.zeros(0,dtype=bool)
+        self.events = np.zeros(0,dtype=np.int64)
+        self.weighted = np.zeros(0)
+
+    def grow(self,num_addrs:int,num_labels:int):
+        if num_addrs <= self.num_addrs and num_labels <= self.num_labels:
+            return
+        num_addrs = max(num_addrs,self.num_addrs)
+        num_labels = max(num_labels,self.num_labels)
+        #Double the address capacity so growth is amortized
+        capacity = max(num_addrs,2*self.counts.shape[0]) if num_addrs > self.counts.shape[0] else self.counts.shape[0]
+
+        def resize(a:np.ndarray,shape):
+            b = np.zeros(shape,dtype=a.dtype)
+            b[tuple(slice(0,n) for n in a.shape)] = a
+            return b
+
+        if capacity > self.counts.shape[0] or num_labels > self.counts.shape[1]:
+            self.counts = resize(self.counts,(capacity,num_labels))
+            self.last_bits = resize(self.last_bits,(capacity,num_labels))
+            self.accesses = resize(self.accesses,(capacity,))
+            self.changes = resize(self.changes,(capacity,))
+            self.seen = resize(self.seen,(capacity,))
+        if num_labels > self.num_labels:
+            self.events = resize(self.events,(num_labels,))
+            self.weighted = resize(self.weighted,(num_labels,))
+        self.num_addrs = num_addrs
+        self.num_labels = num_labels
+
+    def add(self,addr_ids:np.ndarray,bits:np.ndarray):
+        if len(addr_ids) == 0:
+            return
+        addr_ids = addr_ids.astype(np.int64)
+        self.grow(int(addr_ids.max()) + 1,bits.shape[1])
+        if bits.shape[1] < self.num_labels:
+            bits = np.pad(bits,((0,0),(0,self.num_labels - bits.shape[1])))
+
+        #Per location totals, every event spreads a weight of 1 over its locations
+        sizes = bits.sum(axis=1,dtype=np.int64)
+        self.events += bits.sum(axis=0,dtype=np.int64)
+        self.weighted += (bits / sizes[:,None]).sum(axis=0)
+
+        #Per line totals
+        #Only touch the lines seen in this chunk, the totals cover every address so far
+        touched, n = np.unique(addr_ids,return_counts=True)
+        self.accesses[touched] += n
+        rows, cols = np.nonzero(bits)
+        cells, n = np.unique(addr_ids[rows]*self.num_labels + cols,return_counts=True)
+        self.counts[cells // self.num_labels,cells % self.num_labels] += n
+
+        #Stability: group the events of each line together, keeping their order
+        order = np.argsort(addr_ids,kind="stable")
+        ids = addr_ids[order]
+        sorted_bits = bits[order]
+        first = np.ones(len(ids),dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        #Previous locations of the same line: the row before, or what the last chunk left for the first row of a line
+        prev = np.empty_like(sorted_bits)
+        prev[1:] = sorted_bits[:-1]
+        prev[first] = self.last_bits[ids[first]]
+        had_prev = np.ones(len(ids),dtype=bool)
+        had_prev[first] = self.seen[ids[first]]
+        common = (prev & sorted_bits).any(axis=1) & had_prev
+        changed, n = np.unique(ids[~common],return_counts=True)
+        self.changes[changed] += n
+
+        last = np.ones(len(ids),dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        self.last_bits[ids[last]] = sorted_bits[last]
+        self.seen[ids[last]] = True
+
+    def results(self,labels:List[str],addresses:np.ndarray,top:int=10)->Dict:
+        n = self.num_addrs
+        counts = self.counts[:n]
+        accesses = self.accesses[:n]
+        changes = self.changes[:n]
+        lines = accesses > 0
+        #Each line counts once, split over its locations by how often each was ideal
+        per_line_total = counts.sum(axis=1)
+        line_share = (counts[lines] / per_line_total[lines,None]).sum(axis=0)
+
+        order = sorted(range(len(labels)),key=lambda i: label_order(labels[i]))
+        hottest = np.argsort(-accesses)[:top]
+        percentiles = [50, 90, 99, 100]
+        return {
+            "Events": int(accesses.sum()),
+            "Lines": int(lines.sum()),
+            "Per location": {labels[i]:{"Events":int(self.events[i]),
+                                        "Weighted events":float(self.weighted[i]),
+                                        "Line share":float(line_share[i])}
+                             for i in order if self.events[i] > 0},
+            "Location changes": int(changes.sum()),
+            "Changed events fraction": float(changes.sum()/accesses.sum()) if accesses.sum() else 0,
+            #A line whose ideal location never changed after its first event has one change
+            "Stable lines": int((changes[lines] <= 1).sum()),
+            "Events per line percentiles": {p:float(np.percentile(accesses[lines],p)) for p in percentiles} if lines.any() else {},
+            "Busiest lines": [{"Address":hex(int(addresses[i])),"Events":int(accesses[i]),"Changes":int(changes[i])} for i in hottest if accesses[i] > 0]
+        }
+
+def analyze_locations(source:str)->Tuple[Dict,Dict[str,float]]:
+    '''
+    Summarize a switch location file: switch_loc.json or the prefix of a binary switch log
+    Returns the summary and the per location line share
+    '''
+    stats = LocationStats()
+    if switch_log.exists(source):
+        labels = switch_log.read_meta(source)["Labels"]
+        for addr_ids, bits in switch_log.read_events(source):
+            stats.add(addr_ids,bits)
+        addresses = switch_log.read_addresses(source)
+    else:
+        labels: List[str] = []
+        address_list: List[int] = []
+        for addr_ids, bits in read_text_events(source,labels,address_list):
+            stats.add(addr_ids,bits)
+        addresses = np.array(address_list,dtype=np.uint64)
+
+    summary = stats.results(labels,addresses)
+    final_val = {label:vals["Line share"] for label,vals in summary["Per location"].items()}
+    return summary, final_val
+
 if __name__ == '__main__':
-    
-    switch_loc_file = sys.argv[1]
-    
-    analyze_locations(switch_loc_file)
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Stability and spread of ideal directory locations")
+    parser.add_argument("source",help="switch_loc.json, or the prefix given as \"Switch log\"")
+    parser.add_argument("--output",default=None,help="Also write the summary to this json")
+    parser.add_argument("--no-plot",action="store_true")
+    args = parser.parse_args()
+
+    summary, final_val = analyze_locations(args.source)
+    print(json.dumps(summary,indent=4))
+    if args.output != None:
+        with open(args.output,"w") as file:
+            json.dump(summary,file,indent=4)
+
+    if not args.no_plot:
+        #Only pull in matplotlib once the analysis is done
+        from visualization import plot_switch_distribution
+        plot_switch_distribution(final_val,"switch_distribution.png")
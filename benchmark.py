@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import subprocess
+import tempfile
+from typing import Callable, Dict, List, Tuple
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(REPO,"benchmarks","baseline.json")
+LINE = 64
+
+#Default regression thresholds, as fractions of the baseline
+MAX_SLOWDOWN = 0.10
+MAX_RSS_GROWTH = 0.20
+MAX_STARTUP_GROWTH = 0.50
+
+Request = Tuple[int,str,int]
+
+#Workloads
+#Every generator takes the number of hosts, the host cache size in lines, the number of requests and a seeded rng
+
+def private_only(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    Every host works on its own half cache sized region, no sharing at all
+    '''
+    footprint = host_lines//2
+    reqs = []
+    for i in range(n):
+        host = i % num_hosts
+        line = host*footprint + rng.randrange(footprint)
+        reqs.append((line*LINE,'W' if rng.random() < 0.3 else 'R',host))
+    return reqs
+
+def read_shared(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    All hosts read one shared region
+    '''
+    footprint = host_lines//2
+    return [(rng.randrange(footprint)*LINE,'R',rng.randrange(num_hosts)) for i in range(n)]
+
+def migratory(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    Lines move from host to host, each visit is a read followed by a write
+    '''
+    footprint = host_lines//4
+    reqs = []
+    while len(reqs) < n:
+        addr = rng.randrange(footprint)*LINE
+        host = rng.randrange(num_hosts)
+        reqs.append((addr,'R',host))
+        reqs.append((addr,'W',host))
+    return reqs[:n]
+
+def producer_consumer(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    One host writes a buffer, two others read it, then the next host produces
+    '''
+    buffer = 32
+    footprint = host_lines//2
+    reqs = []
+    producer = 0
+    while len(reqs) < n:
+        base = rng.randrange(footprint - buffer)
+        consumers = [(producer + 1) % num_hosts,(producer + num_hosts//2) % num_hosts]
+        reqs += [((base+i)*LINE,'W',producer) for i in range(buffer)]
+        for consumer in consumers:
+            reqs += [((base+i)*LINE,'R',consumer) for i in range(buffer)]
+        producer = (producer + 1) % num_hosts
+    return reqs[:n]
+
+def false_sharing(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    Hosts write disjoint words of the same few lines
+    '''
+    lines = 16
+    reqs = []
+    for i in range(n):
+        host = rng.randrange(num_hosts)
+        word = host % (LINE//8)
+        reqs.append((rng.randrange(lines)*LINE + 8*word,'W' if rng.random() < 0.5 else 'R',host))
+    return reqs
+
+def eviction_heavy(num_hosts:int,host_lines:int,n:int,rng:random.Random)->List[Request]:
+    '''
+    Footprint of eight host caches with a quarter of the accesses shared, so hosts and directories evict all the time
+    '''
+    footprint = 8*host_lines
+    reqs = []
+    for i in range(n):
+        host = rng.randrange(num_hosts)
+        if rng.random() < 0.25:
+            line = rng.randrange(footprint)
+        else:
+            line = (host + 1)*footprint + rng.randrange(footprint)
+        reqs.append((line*LINE,'W' if rng.random() < 0.3 else 'R',host))
+    return reqs
+
+WORKLOADS: Dict[str,Callable] = {
+    "private-only": private_only,
+    "read-shared": read_shared,
+    "migratory": migratory,
+    "producer-consumer": producer_consumer,
+    "false-sharing": false_sharing,
+    "eviction-heavy": eviction_heavy
+}
+
+#Configs
+
+def tree_edgelist(filename:str,num_hosts:int,leaves:int):
+    '''
+    Two level switch tree, the device hangs off the root, hosts are spread over the leaves
+    Node ids follow the simulator convention: hosts, then the device, then switches
+    '''
+    device = num_hosts
+    root = num_hosts + 1
+    edges = [(device,root)]
+    for leaf in range(leaves):
+        edges.append((root,root + 1 + leaf))
+    for host in range(num_hosts):
+        edges.append((host,root + 1 + host % leaves))
+    with open(filename,"w") as file:
+        for a,b in edges:
+            file.write(f"{a} {b}\n")
+
+def base_config(num_hosts:int,num_switches:int,host_lines:int,dir_lines:int,edgelist:str,intermediate:int,intermediate_path:List[int],policy:str)->Dict:
+    return {
+        "Num hosts" : num_hosts,
+        "Host line size" : LINE,
+        "Host num lines" : host_lines,
+        "Host assoc" : 16,
+        "Device line size" : LINE,
+        "Device num lines" : dir_lines,
+        "Device assoc" : 16,
+        "Num switches" : num_switches,
+        "Switch line size" : LINE,
+        "Switch num lines" : dir_lines,
+        "Switch assoc" : 16,
+        "Intermediate switch" : intermediate,
+        "Intermediate path" : intermediate_path,
+        "Placement policy" : "default",
+        "Migration policy" : policy,
+        "Edgelist" : edgelist,
+        "Debug" : False
+    }
+
+def coherence_configs(scratch:str)->Dict[str,Dict]:
+    tree = os.path.join(scratch,"tree_8.edgelist")
+    tree_edgelist(tree,8,2)
+    mesh = os.path.join(REPO,"topologies","mesh_4x4.edgelist")
+    return {
+        "mesh16-small": base_config(16,16,256,1024,mesh,23,[23,27,31,16],"adaptive"),
+        "mesh16-large": base_config(16,16,4096,16384,mesh,23,[23,27,31,16],"adaptive"),
+        "tree8-lazy": base_config(8,3,1024,4096,tree,9,[9,8],"lazy"),
+        "tree8-sssp": base_config(8,3,1024,4096,tree,9,[9,8],"sssp")
+    }
+
+def toplevel_configs()->Dict[str,Dict]:
+    #network.py has a fixed four host grid
+    return {
+        "grid4-small": base_config(4,9,256,1024,None,None,[],None),
+        "grid4-large": base_config(4,9,4096,16384,None,None,[],None)
+    }
+
+def cases(scratch:str)->List[Tuple[str,str,Dict]]:
+    '''
+    Every (simulator, config, workload) combination, by name
+    '''
+    all_cases = []
+    for simulator,configs in [("coherence",coherence_configs(scratch)),("toplevel",toplevel_configs())]:
+        for config,cfg in configs.items():
+            for workload in WORKLOADS.keys():
+                all_cases.append((f"{simulator}/{config}/{workload}",simulator,cfg))
+    return all_cases
+
+#Measurement, one fresh process per case so startup and peak RSS are not polluted by earlier cases
+
+def run_case(simulator:str,cfg:Dict,workload:str,n:int,seed:int)->Dict:
+    reqs = WORKLOADS[workload](cfg["Num hosts"],cfg["Host num lines"],n,random.Random(seed))
+
+    start = time.perf_counter()
+    if simulator == "coherence":
+        import static_allocation
+        from cache import cachesim
+        from cache.cachesim import OpType
+        sim_cfg = static_allocation.Config(d=cfg)
+        cachesim.DEBUG = sim_cfg.debug
+        N = static_allocation.build_network(sim_cfg)
+        sim = static_allocation.build_engine(sim_cfg,N)
+    else:
+        import network
+        from cache.cachesim import OpType
+        sim = network.build_simulator(network.Config(d=cfg))
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for addr,op,host in reqs:
+        sim.process_req(addr,OpType.READ if op == 'R' else OpType.WRITE,host)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "Requests": n,
+        "Requests/s": n/elapsed if elapsed > 0 else 0,
+        "Startup s": startup,
+        #ru_maxrss is in KB on Linux
+        "Peak RSS MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    }
+
+def measure(python:str,name:str,n:int,seed:int,repeat:int,scratch:str)->Dict:
+    '''
+    Best of repeat runs of one case
+    '''
+    best = None
+    for i in range(repeat):
+        out = os.path.join(scratch,"case.json")
+        log = os.path.join(scratch,"case.log")
+        with open(log,"w") as file:
+            #Simulators write side files into the working directory
+            proc = subprocess.run([python,os.path.abspath(__file__),"case",name,"--requests",str(n),"--seed",str(seed),"--out",out,"--scratch",scratch],
+                                  cwd=scratch,stdout=file,stderr=file)
+        if proc.returncode != 0:
+            print(f"{name} failed, see {log}")
+            exit(2)
+        with open(out) as file:
+            result = json.load(file)
+        if best == None:
+            best = result
+        else:
+            best["Requests/s"] = max(best["Requests/s"],result["Requests/s"])
+            best["Startup s"] = min(best["Startup s"],result["Startup s"])
+            best["Peak RSS MB"] = min(best["Peak RSS MB"],result["Peak RSS MB"])
+    return best
+
+def compare(results:Dict[str,Dict],baseline:Dict[str,Dict],max_slowdown:float,max_rss_growth:float,max_startup_growth:float)->List[str]:
+    '''
+    Cases that got slower or bigger than the thresholds allow
+    '''
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["Requests/s"] < base["Requests/s"]*(1 - max_slowdown):
+            regressions.append(f"{name}: {result['Requests/s']:.0f} requests/s, baseline {base['Requests/s']:.0f}")
+        if result["Peak RSS MB"] > base["Peak RSS MB"]*(1 + max_rss_growth):
+            regressions.append(f"{name}: {result['Peak RSS MB']:.0f}MB peak RSS, baseline {base['Peak RSS MB']:.0f}MB")
+        if result["Startup s"] > base["Startup s"]*(1 + max_startup_growth):
+            regressions.append(f"{name}: {result['Startup s']:.3f}s startup, baseline {base['Startup s']:.3f}s")
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Simulator throughput benchmarks")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+    run_parser = sub.add_parser("run",help="Run the suite and compare against the baseline")
+    run_parser.add_argument("--filter",default="",help="Only run cases whose name contains this")
+    run_parser.add_argument("--requests",type=int,default=50000)
+    run_parser.add_argument("--repeat",type=int,default=3)
+    run_parser.add_argument("--seed",type=int,default=1)
+    run_parser.add_argument("--python",default=sys.executable)
+    run_parser.add_argument("--baseline",default=BASELINE,help="Results to compare against. None is shipped, timings only mean something "
+                            "on the machine that recorded them, so record one with --save-baseline on the reference version first")
+    run_parser.add_argument("--save-baseline",action="store_true",help="Store these results as the new baseline")
+    run_parser.add_argument("--max-slowdown",type=float,default=MAX_SLOWDOWN)
+    run_parser.add_argument("--max-rss-growth",type=float,default=MAX_RSS_GROWTH)
+    run_parser.add_argument("--max-startup-growth",type=float,default=MAX_STARTUP_GROWTH)
+    run_parser.add_argument("--output",default=None,help="Also write the results to this json")
+    case_parser = sub.add_parser("case",help="Run one case in this process (used by run)")
+    case_parser.add_argument("name")
+    case_parser.add_argument("--requests",type=int,required=True)
+    case_parser.add_argument("--seed",type=int,required=True)
+    case_parser.add_argument("--out",required=True)
+    case_parser.add_argument("--scratch",required=True)
+    args = parser.parse_args()
+
+    if args.cmd == "case":
+        sys.path.insert(0,REPO)
+        named = {name:(simulator,cfg) for name,simulator,cfg in cases(args.scratch)}
+        simulator,cfg = named[args.name]
+        result = run_case(simulator,cfg,args.name.split('/')[-1],args.requests,args.seed)
+        with open(args.out,"w") as file:
+            json.dump(result,file)
+        exit(0)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            stored = json.load(file)
+        if stored["Requests"] != args.requests or stored["Seed"] != args.seed:
+            print(f"Baseline was recorded with {stored['Requests']} requests and seed {stored['Seed']}, not comparing")
+        else:
+            baseline = stored["Results"]
+    elif not args.save_baseline:
+        print(f"No baseline at {args.baseline}, only measuring. Record one with --save-baseline on the reference version")
+
+    results: Dict[str,Dict] = dict()
+    with tempfile.TemporaryDirectory() as scratch:
+        for name,simulator,cfg in cases(scratch):
+            if args.filter not in name:
+                continue
+            result = measure(args.python,name,args.requests,args.seed,args.repeat,scratch)
+            results[name] = result
+            delta = "no base" if not args.save_baseline else ""
+            if name in baseline:
+                delta = f"{100*(result['Requests/s']/baseline[name]['Requests/s'] - 1):+7.1f}%"
+            print(f"{name:<45}{result['Requests/s']:>12.0f} req/s {delta:>8}{result['Startup s']:>9.3f}s startup{result['Peak RSS MB']:>8.0f}MB")
+
+    if args.output != None:
+        with open(args.output,"w") as file:
+            json.dump(results,file,indent=4)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline),exist_ok=True)
+        #Keep the cases that were filtered out this time
+        baseline.update(results)
+        with open(args.baseline,"w") as file:
+            json.dump({"Requests":args.requests,"Seed":args.seed,"Python":args.python,"Results":baseline},file,indent=4)
+        print(f"Saved baseline to {args.baseline}")
+        exit(0)
+
+    if not baseline:
+        print("Nothing compared, regressions were not checked")
+        exit(0)
+    regressions = compare(results,baseline,args.max_slowdown,args.max_rss_growth,args.max_startup_growth)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        exit(1)
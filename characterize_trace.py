@@ -0,0 +1,172 @@
+import sys
+import json
+import argparse
+from typing import Dict, List
+from traces import read_trace
+from sketches import mix64, HyperLogLog, SpaceSaving
+
+#Most lines tracked exactly before the line sample is thinned
+MAX_SAMPLED_LINES = 1 << 18
+TOP_K = 32
+#Counters of the hot line sketch, lines hotter than 1/HOT_COUNTERS of all requests are always found
+HOT_COUNTERS = 4096
+
+class LineState:
+    '''
+    What we remember about a sampled line
+    '''
+    __slots__ = ["hosts","writers","accesses","last_reqid","last_host","last_writer","read_by_last","handoffs"]
+
+    def __init__(self):
+        self.hosts = set()
+        self.writers = set()
+        self.accesses = 0
+        self.last_reqid = -1
+        self.last_host = None
+        self.last_writer = None
+        #Whether the last host read the line before writing it
+        self.read_by_last = False
+        #Read then write by a host other than the previous writer
+        self.handoffs = 0
+
+class TraceCharacterizer:
+    '''
+    Single pass, bounded memory summary of a trace, for sizing caches and directories before simulating
+    Counts that need every line (unique lines, per host footprint) use HyperLogLog,
+    per line behaviour (sharing degree, write sharing, migratory lines, inter-host reuse) is measured exactly
+    on a hash sample of lines that is thinned whenever it outgrows max_lines
+    '''
+
+    def __init__(self,line_size:int=64,max_lines:int=MAX_SAMPLED_LINES,top_k:int=TOP_K):
+        self.offset_bits = line_size.bit_length() - 1
+        self.max_lines = max_lines
+        self.top_k = top_k
+
+        self.requests = 0
+        self.reads = 0
+        self.writes = 0
+        self.unique = HyperLogLog()
+        self.host_footprint: Dict[int,HyperLogLog] = dict()
+        self.host_requests: Dict[int,List[int]] = dict()
+        self.hot = SpaceSaving(max(HOT_COUNTERS,top_k))
+
+        #A line is sampled if its hash is below the threshold, the sampling rate is threshold/2^64
+        self.threshold = 1 << 64
+        self.lines: Dict[int,LineState] = dict()
+        #Requests between an access and the previous access to the line from a different host, log2 buckets
+        self.reuse_hist: Dict[int,int] = dict()
+
+    def add(self,addr:int,op:str,hostid:int):
+        line = addr >> self.offset_bits
+        h = mix64(line)
+        write = op == 'W'
+
+        self.requests += 1
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+        self.unique.add(h)
+        if hostid not in self.host_footprint:
+            self.host_footprint[hostid] = HyperLogLog(12)
+            self.host_requests[hostid] = [0,0]
+        self.host_footprint[hostid].add(h)
+        self.host_requests[hostid][write] += 1
+        self.hot.add(line)
+
+        if h >= self.threshold:
+            return
+        state = self.lines.get(line)
+        if state == None:
+            state = LineState()
+            self.lines[line] = state
+            if len(self.lines) > self.max_lines:
+                self.thin()
+                if line not in self.lines:
+                    return
+
+        if state.last_host != None and state.last_host != hostid:
+            distance = self.requests - state.last_reqid
+            bucket = distance.bit_length() - 1
+            self.reuse_hist[bucket] = self.reuse_hist.get(bucket,0) + 1
+
+        if write:
+            if state.last_host == hostid and state.read_by_last and state.last_writer not in (None,hostid):
+                state.handoffs += 1
+            state.writers.add(hostid)
+            state.last_writer = hostid
+            state.read_by_last = False
+        else:
+            state.read_by_last = True
+        state.hosts.add(hostid)
+        state.accesses += 1
+        state.last_reqid = self.requests
+        state.last_host = hostid
+
+    def thin(self):
+        '''
+        Halve the sampling rate, keeping only lines under the new threshold
+        '''
+        while len(self.lines) > self.max_lines:
+            self.threshold >>= 1
+            self.lines = {line:state for line,state in self.lines.items() if mix64(line) < self.threshold}
+
+    def summary(self)->Dict:
+        rate = self.threshold / (1 << 64)
+        sampled = len(self.lines)
+        degree_hist: Dict[int,int] = dict()
+        write_shared = 0
+        migratory = 0
+        for state in self.lines.values():
+            degree = len(state.hosts)
+            degree_hist[degree] = degree_hist.get(degree,0) + 1
+            if degree > 1 and state.writers:
+                write_shared += 1
+            if state.handoffs >= 2:
+                migratory += 1
+
+        return {
+            "Requests": self.requests,
+            "Reads": self.reads,
+            "Writes": self.writes,
+            "Write fraction": self.writes/self.requests if self.requests else 0,
+            "Hosts": sorted(self.host_footprint.keys()),
+            "Unique lines": self.unique.count(),
+            "Per host": {hostid:{"Footprint lines":self.host_footprint[hostid].count(),
+                                 "Reads":self.host_requests[hostid][0],
+                                 "Writes":self.host_requests[hostid][1]}
+                         for hostid in sorted(self.host_footprint.keys())},
+            "Line sampling rate": rate,
+            "Sampled lines": sampled,
+            #Histograms are scaled back up by the sampling rate
+            "Sharing degree histogram": {degree:round(count/rate) for degree,count in sorted(degree_hist.items())},
+            "Write shared fraction": write_shared/sampled if sampled else 0,
+            "Migratory fraction": migratory/sampled if sampled else 0,
+            "Inter-host reuse distance histogram": {f"{1 << bucket}-{(1 << (bucket+1)) - 1}":round(count/rate)
+                                                    for bucket,count in sorted(self.reuse_hist.items())},
+            "Hot lines": [{"Line":hex(line << self.offset_bits),"Accesses":count,"Max overcount":error}
+                          for line,count,error in self.hot.top(self.top_k)]
+        }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="One pass summary of a trace: footprint, sharing, migratory lines, reuse and hot lines")
+    parser.add_argument("trace")
+    parser.add_argument("--output",default=None,help="Summary json, printed if not given")
+    parser.add_argument("--line-size",type=int,default=64)
+    parser.add_argument("--max-lines",type=int,default=MAX_SAMPLED_LINES,help="Most lines tracked for the per line statistics")
+    parser.add_argument("--top",type=int,default=TOP_K)
+    args = parser.parse_args()
+
+    characterizer = TraceCharacterizer(args.line_size,args.max_lines,args.top)
+    for addr,op,hostid in read_trace(args.trace):
+        characterizer.add(addr,op,hostid)
+        if characterizer.requests % 1000000 == 0:
+            print(characterizer.requests,file=sys.stderr)
+
+    summary = characterizer.summary()
+    if args.output != None:
+        with open(args.output,"w") as file:
+            json.dump(summary,file,indent=4)
+    else:
+        print(json.dumps(summary,indent=4))
@@ -0,0 +1,135 @@
+import math
+from statistics import NormalDist
+from typing import Dict, List
+
+#Per transaction metrics tracked for every flow: numerator in flow_records, divided by the number of transactions
+METRICS = {
+    "AVG Benefit": "Benefit",
+    "Improved ratio": "Improved",
+    "Deteriorated ratio": "Deteriorated"
+}
+OVERALL = -1
+
+class RatioEstimate:
+    '''
+    Batch means confidence interval of sum(x)/sum(n) over windows
+    Only running sums are kept, so memory does not grow with the number of windows
+    '''
+
+    def __init__(self):
+        self.k = 0
+        self.x = 0
+        self.n = 0
+        self.xx = 0
+        self.xn = 0
+        self.nn = 0
+
+    def add(self,x:float,n:int):
+        self.k += 1
+        self.x += x
+        self.n += n
+        self.xx += x*x
+        self.xn += x*n
+        self.nn += n*n
+
+    def mean(self)->float:
+        return self.x/self.n if self.n else 0
+
+    def half_width(self,z:float)->float:
+        if self.k < 2 or self.n == 0:
+            return float('inf')
+        r = self.mean()
+        #Residuals of the ratio estimator, sum((x_i - r*n_i)^2)
+        residual = max(self.xx - 2*r*self.xn + r*r*self.nn,0)
+        mean_n = self.n/self.k
+        return z*math.sqrt(residual/(self.k - 1)/self.k)/mean_n
+
+class ConvergenceMonitor:
+    '''
+    Stop a simulation once the per flow benefit and improved/deteriorated ratios are known well enough
+    Every window requests the change in flow_records is one batch, the run stops when the confidence interval
+    of every tracked metric is narrower than +-tolerance, but never before min_requests
+    Flows that are a small share of all transactions are not tracked, they would keep rare flows from ever converging
+    '''
+
+    def __init__(self,engine,tolerance:float,min_requests:int=1000000,window:int=10000,confidence:float=0.95,min_share:float=0.01,min_windows:int=10):
+        self.engine = engine
+        self.tolerance = tolerance
+        self.min_requests = min_requests
+        self.window = window
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence)/2)
+        self.min_share = min_share
+        self.min_windows = min_windows
+
+        flows = list(engine.communication_flows.keys()) + [OVERALL]
+        self.estimates: Dict[int,Dict[str,RatioEstimate]] = {flow:{metric:RatioEstimate() for metric in METRICS} for flow in flows}
+        self.last: Dict[int,Dict[str,int]] = {flow:{"Count":0,"Benefit":0,"Improved":0,"Deteriorated":0} for flow in flows}
+        self.countdown = window
+        self.stopped_at = None
+
+    def snapshot(self)->Dict[int,Dict[str,int]]:
+        current = dict()
+        overall = {"Count":0,"Benefit":0,"Improved":0,"Deteriorated":0}
+        for flow in self.engine.communication_flows.keys():
+            stats = self.engine.flow_records[flow]
+            current[flow] = {"Count":stats["Improved"] + stats["Same"] + stats["Deteriorated"],
+                             "Benefit":stats["Benefit"],
+                             "Improved":stats["Improved"],
+                             "Deteriorated":stats["Deteriorated"]}
+            for key,val in current[flow].items():
+                overall[key] += val
+        current[OVERALL] = overall
+        return current
+
+    def tick(self)->bool:
+        '''
+        Called once per request, returns True when the simulation can stop
+        '''
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
+        self.countdown = self.window
+
+        current = self.snapshot()
+        for flow,stats in current.items():
+            n = stats["Count"] - self.last[flow]["Count"]
+            for metric,key in METRICS.items():
+                self.estimates[flow][metric].add(stats[key] - self.last[flow][key],n)
+        self.last = current
+
+        if self.engine.reqid < self.min_requests or self.estimates[OVERALL]["AVG Benefit"].k < self.min_windows:
+            return False
+        if all(hw <= self.tolerance for widths in self.half_widths().values() for hw in widths.values()):
+            self.stopped_at = self.engine.reqid
+            return True
+        return False
+
+    def tracked(self)->List[int]:
+        total = self.last[OVERALL]["Count"]
+        return [flow for flow,stats in self.last.items() if flow == OVERALL or (total > 0 and stats["Count"]/total >= self.min_share)]
+
+    def half_widths(self)->Dict[int,Dict[str,float]]:
+        return {flow:{metric:est.half_width(self.z) for metric,est in self.estimates[flow].items()} for flow in self.tracked()}
+
+    def report(self,total_requests:int=None)->Dict:
+        '''
+        Where and why the run stopped, for the output json
+        '''
+        if self.stopped_at != None:
+            reason = f"All tracked metrics within +-{self.tolerance} at {self.confidence:.0%} confidence"
+        else:
+            reason = "End of trace before convergence"
+        return {
+            "Stopped early": self.stopped_at != None,
+            "Requests processed": self.engine.reqid,
+            "Total requests": total_requests,
+            "Reason": reason,
+            "Tolerance": self.tolerance,
+            "Confidence": self.confidence,
+            "Window": self.window,
+            "Min requests": self.min_requests,
+            "Tracked flows": {flow:{metric:{"Mean":self.estimates[flow][metric].mean(),"Half width":hw}
+                                    for metric,hw in widths.items()}
+                              for flow,widths in self.half_widths().items()}
+        }
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from typing import Dict, List
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+#Requests per digest exchanged with the workers
+DEFAULT_CHUNK = 1 << 14
+RECORD_FIELDS = ["Request", "Addr", "Op", "Host", "Flow", "State", "Owner", "Sharers", "Location"]
+
+#Two runs are compared as they go: each side is a worker process that sends one digest per chunk of requests
+#and waits for the other side. At the first chunk whose digests differ, both send the records of that chunk
+#(the state of the requested line after every request) and the first differing request is found among them.
+#Nothing is written per request and neither run goes past the chunk where they diverge.
+#Workers first say which fields their simulator version can give, a field only one side has is left out on both.
+
+def load_trace_reader():
+    '''
+    read_trace of this checkout, loaded by path: the simulator under test may predate traces.py or have another one
+    '''
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("divergence_traces",os.path.join(REPO,"traces.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.read_trace
+
+def legacy_engine(static_allocation,cfg):
+    '''
+    Engine of a simulator version without build_network/build_engine, wired the way its __main__ did
+    '''
+    sa = static_allocation
+    hosts = [sa.CXLHost(cfg.host_line_size,cfg.host_num_lines,cfg.host_assoc,i) for i in range(cfg.num_hosts)]
+    device = sa.CXLDevice(cfg.device_line_size,cfg.device_num_lines,cfg.device_assoc,cfg.num_hosts)
+    switches = {i:sa.CXLSwitch(cfg.switch_line_size,cfg.switch_num_lines,cfg.switch_assoc,i) for i in range(cfg.num_hosts+1,cfg.num_hosts+1+cfg.num_switches)}
+    device.set_switches(switches)
+    N = sa.CXLNet(num_hosts=cfg.num_hosts,num_devices=1,num_switches=cfg.num_switches)
+    N.G = sa.nx.read_edgelist(cfg.edgelist,edgetype=int,nodetype=int)
+    N.set_intermediate(cfg.intermediate,cfg.intermediate_path)
+    engine = sa.CoherenceEngine(hosts,device,switches)
+    engine.add_network(N)
+    engine.set_placement_policy(cfg.placement_policy)
+    engine.set_migration_policy(cfg.migration_policy)
+    return engine
+
+def request_flow(engine):
+    '''
+    Flow of the last request, None when this simulator version does not keep it
+    '''
+    return getattr(engine,"request_flow",getattr(engine,"last_flow",None))
+
+def line_record(engine,reqid:int,addr:int,op:str,hostid:int,with_flow:bool=True)->List:
+    '''
+    State of the requested line after the request: directory state, owner, sharers, where the entry lives, flow taken
+    '''
+    device = getattr(engine,"home",lambda a: engine.device)(addr)
+    entry = device.find_directory_entry(addr)
+    if entry == None:
+        state, owner, sharers = None, None, []
+    else:
+        state, owner, sharers = str(entry.state), entry.owner, sorted(entry.sharers)
+    return [reqid, hex(addr), op, hostid, request_flow(engine) if with_flow else None, state, owner, sharers, device.find_directory_location(addr)]
+
+def run_worker(config_file:str,trace_file:str,chunk:int):
+    '''
+    Run one side, talking to the locator over stdin/stdout
+    '''
+    from cache import cachesim
+    from cache.cachesim import OpType
+    import static_allocation
+    read_trace = load_trace_reader()
+
+    #The simulators print progress, keep stdout for the protocol
+    channel = sys.stdout
+    sys.stdout = sys.stderr
+
+    def send(msg:Dict):
+        channel.write(json.dumps(msg) + "\n")
+        channel.flush()
+
+    cfg = static_allocation.Config(config_file)
+    cfg.telemetry_file = None
+    cachesim.DEBUG = False
+    if hasattr(static_allocation,"build_engine"):
+        engine = static_allocation.build_engine(cfg,static_allocation.build_network(cfg))
+    else:
+        engine = legacy_engine(static_allocation,cfg)
+
+    #Compare flows only if the other side has them too
+    send({"Hello":True,"Flow":hasattr(engine,"request_flow") or hasattr(engine,"last_flow")})
+    with_flow = sys.stdin.readline().strip() == "flow"
+
+    records: List[List] = []
+    digest = hashlib.blake2b(digest_size=8)
+    reqid = 0
+    error = None
+    for addr,op,hostid in read_trace(trace_file):
+        try:
+            engine.process_req(addr,OpType.READ if op == 'R' else OpType.WRITE,hostid)
+        except (Exception,SystemExit) as e:
+            error = f"{type(e).__name__}: {e}"
+            records.append([reqid, hex(addr), op, hostid, "Error", error, None, [], None])
+            break
+        record = line_record(engine,reqid,addr,op,hostid,with_flow)
+        records.append(record)
+        digest.update(repr(record).encode())
+        reqid += 1
+        if len(records) == chunk:
+            send({"Chunk":(reqid - 1)//chunk,"Digest":digest.hexdigest()})
+            if sys.stdin.readline().strip() == "detail":
+                send({"Records":records})
+                return
+            records = []
+            digest = hashlib.blake2b(digest_size=8)
+
+    #Last partial chunk, or the chunk that raised
+    send({"Chunk":reqid//chunk,"Digest":digest.hexdigest() if error == None else error,"End":reqid})
+    if sys.stdin.readline().strip() == "detail":
+        send({"Records":records})
+
+class Side:
+    '''
+    One worker process, running a config with the simulator found in source
+    '''
+
+    def __init__(self,name:str,config_file:str,trace_file:str,source:str,chunk:int,log:str):
+        self.name = name
+        self.log = open(log,"w")
+        self.proc = subprocess.Popen([sys.executable,os.path.abspath(__file__),"worker",config_file,trace_file,
+                                      "--chunk",str(chunk),"--source",os.path.abspath(source)],
+                                     stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=self.log,text=True)
+
+    def receive(self)->Dict:
+        line = self.proc.stdout.readline()
+        if not line:
+            return {"Crashed":f"worker exited with {self.proc.wait()}, see {self.log.name}"}
+        return json.loads(line)
+
+    def reply(self,msg:str):
+        try:
+            self.proc.stdin.write(msg + "\n")
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.log.close()
+
+def first_difference(a:List[List],b:List[List])->int:
+    for i in range(min(len(a),len(b))):
+        if a[i] != b[i]:
+            return i
+    return min(len(a),len(b))
+
+def locate(config_a:str,config_b:str,trace_file:str,source_a:str=REPO,source_b:str=REPO,chunk:int=DEFAULT_CHUNK)->Dict:
+    '''
+    Run both sides in lockstep and return where they first differ, None if they never do
+    '''
+    sides = [Side("A",config_a,trace_file,source_a,chunk,"divergence_A.log"),
+             Side("B",config_b,trace_file,source_b,chunk,"divergence_B.log")]
+    report = None
+    #Chunks both sides agree on
+    agreed = 0
+    try:
+        hello = [side.receive() for side in sides]
+        reply = "flow" if all(msg.get("Flow",False) for msg in hello) else "noflow"
+        for side in sides:
+            side.reply(reply)
+        while True:
+            msgs = [side.receive() for side in sides]
+            if msgs[0] == msgs[1] and "Crashed" not in msgs[0]:
+                if "End" in msgs[0]:
+                    break
+                agreed += 1
+                for side in sides:
+                    side.reply("next")
+                continue
+
+            for side in sides:
+                side.reply("detail")
+            records = [side.receive().get("Records",[]) for side in sides]
+            i = first_difference(records[0],records[1])
+            at = [r[i] if i < len(r) else None for r in records]
+            report = {
+                "Chunk": agreed,
+                "Request": agreed*chunk + i,
+                "Fields": RECORD_FIELDS,
+                "A": at[0],
+                "B": at[1],
+                "Differing fields": [field for field,x,y in zip(RECORD_FIELDS,at[0] or [],at[1] or []) if x != y],
+                #Same on both sides by construction
+                "Previous": records[0][i-1] if i > 0 else None
+            }
+            #A worker that died has no records, its log says why
+            for side,msg in zip(sides,msgs):
+                if "Crashed" in msg:
+                    report[side.name] = msg["Crashed"]
+            break
+    finally:
+        for side in sides:
+            side.close()
+    return report
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="First request where two simulator runs disagree")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+    locate_parser = sub.add_parser("locate",help="Compare two configs, or two versions of the simulator, on one trace")
+    locate_parser.add_argument("config_a")
+    locate_parser.add_argument("config_b")
+    locate_parser.add_argument("trace")
+    locate_parser.add_argument("--source-a",default=REPO,help="Directory of the simulator version run with config A")
+    locate_parser.add_argument("--source-b",default=REPO,help="Directory of the simulator version run with config B")
+    locate_parser.add_argument("--chunk",type=int,default=DEFAULT_CHUNK,help="Requests per digest")
+    locate_parser.add_argument("--output",default=None,help="Also write the report to this json")
+    worker_parser = sub.add_parser("worker",help="Run one side (used by locate)")
+    worker_parser.add_argument("config")
+    worker_parser.add_argument("trace")
+    worker_parser.add_argument("--chunk",type=int,required=True)
+    worker_parser.add_argument("--source",required=True)
+    args = parser.parse_args()
+
+    if args.cmd == "worker":
+        #The simulator under test comes first, ahead of this directory
+        sys.path.insert(0,args.source)
+        run_worker(args.config,args.trace,args.chunk)
+        exit(0)
+
+    report = locate(args.config_a,args.config_b,args.trace,args.source_a,args.source_b,args.chunk)
+    if report == None:
+        print("No divergence, both runs agree on every request")
+        exit(0)
+    print(f"First divergence at request {report['Request']}")
+    for field in ["Previous","A","B"]:
+        if isinstance(report[field],list):
+            print(f"{field:<9}" + " ".join(f"{name}={val}" for name,val in zip(RECORD_FIELDS[1:],report[field][1:])))
+        elif report[field] != None:
+            print(f"{field:<9}{report[field]}")
+    print(f"Differing fields: {','.join(report['Differing fields'])}")
+    if args.output != None:
+        with open(args.output,"w") as file:
+            json.dump(report,file,indent=4)
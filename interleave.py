@@ -0,0 +1,45 @@
+from typing import List
+from sketches import mix64
+
+INTERLEAVE_MODES = ["line", "page", "hash", "xor"]
+
+class Interleave:
+    '''
+    Home device of every address when memory is spread over several CXL devices
+    line and page go round robin over consecutive lines or pages, hash mixes the line number so strides do not
+    pile onto one device, xor takes device bit i from the parity of the address under masks[i] (custom hashes)
+    '''
+
+    def __init__(self,devices:List,mode:str="line",line_size:int=64,page_size:int=4096,masks:List[int]=None):
+        if mode not in INTERLEAVE_MODES:
+            print(f"Unknown interleave {mode}, expected one of {INTERLEAVE_MODES}")
+            exit(2)
+        if mode == "xor" and (masks == None or (1 << len(masks)) < len(devices)):
+            print(f"xor interleave over {len(devices)} devices needs at least {max(len(devices)-1,1).bit_length()} masks")
+            exit(2)
+        self.devices = devices
+        self.mode = mode
+        self.shift = (page_size if mode == "page" else line_size).bit_length() - 1
+        self.masks = masks
+
+    def index(self,addr:int)->int:
+        if len(self.devices) == 1:
+            return 0
+        if self.mode == "xor":
+            idx = 0
+            for bit,mask in enumerate(self.masks):
+                idx |= (bin(addr & mask).count("1") & 1) << bit
+            return idx % len(self.devices)
+        unit = addr >> self.shift
+        if self.mode == "hash":
+            unit = mix64(unit)
+        return unit % len(self.devices)
+
+    def home(self,addr:int):
+        return self.devices[self.index(addr)]
+
+    def writeback(self,addr:int):
+        '''
+        Hosts write back through this, so every line goes to its own device
+        '''
+        self.home(addr).writeback(addr)
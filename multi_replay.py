@@ -0,0 +1,93 @@
+import sys
+import json
+from typing import Dict, List
+from cache import cachesim
+from static_allocation import Config, CoherenceEngine, build_network, build_engine, trace_requests
+
+#These define the topology and the requests replayed, every variant has to agree with the base config on them
+SHARED_KEYS = ["Num hosts", "Num devices", "Num switches", "Edgelist", "Trace start", "Trace end"]
+#What Config uses when an optional one is left out
+SHARED_DEFAULTS = {"Num devices": 1, "Trace start": 0, "Trace end": None}
+
+def variant_configs(base:Dict,variants:List[Dict])->Dict[str,Config]:
+    '''
+    Overlay every variant on top of the base config
+    '''
+    cfgs: Dict[str,Config] = dict()
+    for idx,variant in enumerate(variants):
+        d = dict(base)
+        d.update(variant)
+        name = d.pop("Name",f"variant{idx}")
+        for key in SHARED_KEYS:
+            if d.get(key,SHARED_DEFAULTS.get(key)) != base.get(key,SHARED_DEFAULTS.get(key)):
+                print(f"Variant {name} changes {key}, all variants must share the topology and trace")
+                exit(2)
+        if "Output json" not in variant:
+            d["Output json"] = f"result_{name}.json"
+        assert name not in cfgs, f"Duplicate variant name {name}"
+        cfgs[name] = Config(d=d)
+    return cfgs
+
+def compare(engines:Dict[str,CoherenceEngine],filename:str):
+    '''
+    Write the overall results of every engine next to each other
+    Expects print_flow_records to have been called on every engine
+    '''
+    comparison = dict()
+    for name,engine in engines.items():
+        comparison[name] = {
+            "Placement policy": engine.placement_policy_name,
+            "Migration policy": engine.migration_policy_name,
+            "Overall": engine.flow_records[-1],
+            "Migration stats": engine.migration_stats
+        }
+    with open(filename,"w") as file:
+        json.dump(comparison,file,indent=4)
+
+    #Side by side on the console
+    print(f"{'Variant':<20}{'Placement':<12}{'Migration':<12}{'Improved':>12}{'Same':>12}{'Deteriorated':>14}{'AVG Benefit':>14}{'Migrations':>12}")
+    for name,row in comparison.items():
+        overall = row["Overall"]
+        print(f"{name:<20}{row['Placement policy']:<12}{row['Migration policy']:<12}"
+              f"{overall['Improved']:>12}{overall['Same']:>12}{overall['Deteriorated']:>14}"
+              f"{overall['AVG Benefit']:>14.4f}{row['Migration stats']['Migration count']:>12}")
+
+if __name__ == '__main__':
+
+    #Usage: python multi_replay.py <base config> <variants json> <trace> [<trace> ...]
+    #The variants file holds {"Comparison json": ..., "Variants": [{"Name": ..., <config overrides>}, ...]}
+    base_file = sys.argv[1]
+    variants_file = sys.argv[2]
+    trace_files = sys.argv[3:]
+
+    base = Config(base_file)
+    base.print()
+    cachesim.DEBUG = base.debug
+
+    with open(variants_file) as file:
+        spec = json.load(file)
+
+    cfgs = variant_configs(base.d,spec["Variants"])
+
+    #One topology and distance table for everyone
+    N = build_network(base)
+
+    engines: Dict[str,CoherenceEngine] = {name:build_engine(cfg,N) for name,cfg in cfgs.items()}
+    for name,engine in engines.items():
+        print(f"{name}: placement {engine.placement_policy_name}, migration {engine.migration_policy_name}")
+
+    requests = trace_requests(base,trace_files)
+
+    #Decode each request once and feed it to every engine in lockstep
+    engine_list = list(engines.values())
+    for addr,rw,hostid in requests:
+        for engine in engine_list:
+            engine.process_req(addr,rw,hostid)
+    print(f"Finished processing requests without triggering any assertions")
+
+    for name,engine in engines.items():
+        print(f"##### {name}")
+        engine.print_flow_records(cfgs[name].output_json)
+        print(engine.migration_stats)
+
+    compare(engines,spec.get("Comparison json","comparison.json"))
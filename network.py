@@ -1,13 +1,29 @@
 import networkx as nx
-import matplotlib.pyplot as plt
+import functools
 from cache.cachesim import BaseCache,CacheLine,DirectoryEntry,DirectoryState,HostCache,SnoopFilter,OpType,debug_print,Config,Switch
 from typing import List, Dict, Set
 import sys
 import json
 from cache import cachesim
+from telemetry import Telemetry
+from traces import read_trace, estimate_requests
+from sketches import HeavyHitters
+from switch_log import SwitchLocationWriter
+from interleave import Interleave
 
 ADDR_WIDTH = 64
 cachesim.DEBUG = False
+#Distinct (requestor, sharers) combinations whose ideal switches are remembered
+SHARER_CACHE_SIZE = 1 << 16
+#Coherence transactions that generate messages, numbered as the flows of static_allocation.py
+TRANSITIONS = {
+    6: "Request shared permission for a line that is exclusively owned by another host",
+    7: "Request exclusive permission for a line that is exclusively owned by another host",
+    8: "Request shared permission for a line that is shared by another host",
+    9: "Request exclusive permission for a line that is solely shared by the current host",
+    10: "Request exclusive permission for a line that is shared by other hosts",
+    11: "Request an invalid line"
+}
 
 class DirectoryEntryExtended(DirectoryEntry):
 
@@ -39,7 +55,18 @@ class CXLNet:
         self.G = nx.Graph()
         #Add nodes
         self.G.add_nodes_from(self.nodeids)
+        
+        #Hop counts between every pair of labels, filled once the topology is built
+        self.dist: Dict[str, Dict[str, int]] = None
+
+    def build_distance_table(self):
+        '''
+        Precompute hop counts between all pairs of nodes
+        '''
+        self.dist = dict(nx.all_pairs_shortest_path_length(self.G))
 
+    def distance(self,nodeA:str,nodeB:str)->int:
+        return self.dist[nodeA][nodeB]
 
     def connect(self,nodeA:str,nodeB:str):
         '''
@@ -57,31 +84,18 @@ class CXLNet:
         self.G.add_edge(nodeA,nodeB)
 
     def draw(self):
-        positions = nx.nx_pydot.graphviz_layout(self.G)
-        # nx.draw(self.G,pos=positions,with_label)
-        
-        colors = {
-            'H':'Red',
-            'D':'Blue',
-            'S':'Green'
-        }
-
+        #Plotting is only imported when a picture is requested
+        from visualization import draw_topology
         print(list(self.G.nodes()))
         print(list(self.G.edges()))
-
-        node_colors = [colors[n[0]] for n in self.nodeids]
-        print(node_colors)
-        
-        nx.draw_networkx(self.G,pos=positions,nodelist=self.nodeids,node_color=node_colors,with_labels=True)
-        plt.savefig('CXL_Topology.png')
-        # nx.drawing.nx_pydot.graphviz_layout(self.G, "CXL_Topology.dot")
+        draw_topology(self,'CXL_Topology.png')
 
     def cost(self,nodeA,nodeB):
         '''
         Cost of traversing the path
         Right now I just count number of hops
         '''
-        path_length = nx.shortest_path_length(self.G,source=nodeA,target=nodeB)
+        path_length = self.distance(nodeA,nodeB)
         if path_length == 0:
             print(f"Nothing to traverse between {nodeA} and {nodeB}")
             exit(1)
@@ -128,18 +142,26 @@ class TopLevelSimulator:
 
     def __init__(self,hosts: List[CXLHost],device: CXLDevice, network: CXLNet):
         self.hosts = hosts
+        #Snoop filter of the home device of the current request, see set_devices
         self.snpf = device
+        self.devices: Dict[int, CXLDevice] = {device.id:device}
+        self.interleave = Interleave([device])
         self.network = network
         self.reqid = 0
+        
+        #Optional periodic status file
+        self.telemetry: Telemetry = None
 
         self.node_id_vs_label: Dict[int, str] = dict()
         for h in hosts:
             self.node_id_vs_label[h.id] = f"H{h.id}"
         print(self.node_id_vs_label)
-        self.node_id_vs_label[snpf.id] = f"D0"
+        #Devices are numbered after the hosts and switches after the devices
+        for i in range(network.num_devices):
+            self.node_id_vs_label[network.num_hosts + i] = f"D{i}"
         print(self.node_id_vs_label)
         for i in range(network.num_switches):
-            self.node_id_vs_label[network.num_hosts + 1 + i] = f"S{i}"
+            self.node_id_vs_label[network.num_hosts + network.num_devices + i] = f"S{i}"
         print(self.node_id_vs_label)
 
         #Inverse list
@@ -148,8 +170,143 @@ class TopLevelSimulator:
         with open("nodes.json","w") as file:
             json.dump(self.node_id_vs_label,file,indent=4)
             
-        #Track per cacheline directory location
+        #Track per cacheline directory location, every event is kept unless set_heavy_hitters turns it off
         self.per_line_switch: Dict[int, List[Set[str]]] = dict()
+        #Lines with the most coherence events and the most common ideal switch sets (as bitmasks)
+        self.contended_lines = HeavyHitters()
+        self.switch_sets = HeavyHitters()
+        #Binary log of every event written during the run, instead of per_line_switch
+        self.switch_log: SwitchLocationWriter = None
+        
+        #Hops of every transaction with the directory on its switch, against the same transaction with the directory on the device
+        self.hop_records: Dict[int, Dict[str,int]] = {key:{
+                                    "Count":0,
+                                    "Hops":0,
+                                    "Device hops":0,
+                                    "Improved":0,
+                                    "Same":0,
+                                    "Deteriorated":0,
+                                    "Benefit":0}
+                             for key in TRANSITIONS.keys()}
+        self.requestor_hops: Dict[int, Dict[str,int]] = {h.id:{"Count":0,"Hops":0,"Device hops":0,"Benefit":0} for h in hosts}
+        self.device_hops: Dict[int, Dict[str,int]] = dict()
+        
+        self.build_tables()
+
+    def set_devices(self,devices: List[CXLDevice],interleave: Interleave):
+        '''
+        Spread lines over several devices, each with its own snoop filter, hosts write back through the interleave
+        '''
+        self.devices = {device.id:device for device in devices}
+        self.interleave = interleave
+        self.snpf = devices[0]
+        for host in self.hosts:
+            host.set_dir(interleave)
+        self.build_tables()
+
+    def build_tables(self):
+        '''
+        Everything the ideal location analysis needs depends only on pairs of nodes, so it is computed once per pair
+        Sets of non-host nodes (switches and the device) are bitmasks, bit i is location_labels[i]
+        '''
+        if self.network.dist == None:
+            self.network.build_distance_table()
+        self.location_labels: List[str] = [label for label in self.network.nodeids if label not in self.network.host_ids]
+        self.location_bit: Dict[str, int] = {label:1 << i for i,label in enumerate(self.location_labels)}
+        #(host, host) -> nodes on any shortest path between them, filled on first use
+        self.pair_masks: Dict[tuple, int] = dict()
+        self.mask_sets: Dict[int, frozenset] = dict()
+        #Switch next to each host on the path from each device
+        self.device_next_hop: Dict[int, Dict[int, int]] = dict()
+        for deviceid in self.devices.keys():
+            self.device_next_hop[deviceid] = dict()
+            for h in self.hosts:
+                path = nx.shortest_path(self.network.G,source=self.node_id_to_label(deviceid),target=self.node_id_to_label(h.id))
+                self.device_next_hop[deviceid][h.id] = self.label_to_node_id(path[-2])
+        self.device_hops = {deviceid:{"Count":0,"Hops":0,"Device hops":0,"Benefit":0} for deviceid in self.devices.keys()}
+        self.sharers_mask = functools.lru_cache(maxsize=SHARER_CACHE_SIZE)(self.compute_sharers_mask)
+
+    def path_mask(self,h1:str,h2:str)->int:
+        '''
+        Non-host nodes on any shortest path between two nodes
+        A node is on one exactly when going through it is no longer than the shortest path
+        '''
+        key = (h1,h2) if h1 <= h2 else (h2,h1)
+        mask = self.pair_masks.get(key)
+        if mask == None:
+            dist = self.network.dist
+            d = dist[h1][h2]
+            mask = 0
+            for label,bit in self.location_bit.items():
+                if dist[h1][label] + dist[label][h2] == d:
+                    mask |= bit
+            self.pair_masks[key] = mask
+        return mask
+
+    def mask_to_set(self,mask:int)->frozenset:
+        '''
+        Labels of a bitmask, one shared set object per distinct mask
+        '''
+        labels = self.mask_sets.get(mask)
+        if labels == None:
+            labels = frozenset(label for label,bit in self.location_bit.items() if mask & bit)
+            self.mask_sets[mask] = labels
+        return labels
+
+    def compute_sharers_mask(self,h1:str,sharers:tuple)->int:
+        mask = 0
+        for s in self.get_closest_sharers(h1,list(sharers)):
+            mask |= self.path_mask(h1,s)
+        return mask
+
+    def set_heavy_hitters(self,exact:bool,counters:int,width:int,depth:int):
+        '''
+        Exact mode keeps the full per line history, otherwise only sketches of counters candidates and a width*depth count-min
+        '''
+        if not exact:
+            self.per_line_switch = None
+        self.contended_lines = HeavyHitters(exact,counters,width,depth)
+        self.switch_sets = HeavyHitters(exact,counters,width,depth)
+
+    def set_switch_log(self,prefix:str):
+        '''
+        Stream every event to a binary log as it happens, the history is then not kept in memory
+        '''
+        self.switch_log = SwitchLocationWriter(prefix,self.location_labels)
+        self.per_line_switch = None
+
+    def record_switch_set(self,addr:int,mask:int):
+        '''
+        Save the ideal switches of one coherence event
+        '''
+        if self.switch_log != None:
+            self.switch_log.add(addr,mask)
+        if self.per_line_switch != None:
+            union_set = self.mask_to_set(mask)
+            if addr not in self.per_line_switch.keys():
+                self.per_line_switch.update({addr:[union_set]})
+            else:
+                self.per_line_switch[addr].append(union_set)
+        self.contended_lines.add(addr)
+        self.switch_sets.add(mask)
+
+    def heavy_hitter_report(self,top:int)->Dict:
+        '''
+        Most contended lines and most common ideal switch sets, counts are upper bounds unless exact
+        '''
+        report = {
+            "Exact": self.contended_lines.exact,
+            "Contended lines": [{"Address":hex(addr),"Events":count} for addr,count in self.contended_lines.top(top)],
+            "Switch sets": [{"Switches":[label for label in self.location_labels if mask & self.location_bit[label]],"Events":count}
+                            for mask,count in self.switch_sets.top(top)]
+        }
+        print("Most contended lines")
+        for entry in report["Contended lines"]:
+            print(f"{entry['Address']}:{entry['Events']}")
+        print("Most common ideal switch sets")
+        for entry in report["Switch sets"]:
+            print(f"{','.join(entry['Switches'])}:{entry['Events']}")
+        return report
 
 
     def node_id_to_label(self,nodeid:int)->str:
@@ -169,23 +326,18 @@ class TopLevelSimulator:
         Return switch ID where we will place our directory
         '''
         #For now I am just going to allocate greedily on the node closest to host
-        path_device_to_switch = nx.shortest_path(self.network.G,source=f"D0",target=self.node_id_to_label(requestor_id))
-        switch_label = path_device_to_switch[-2]
-        assert switch_label[0] == 'S','Invalid node for switch allocation'
-        debug_print(f"Allocated space for line on {switch_label}")
-        return self.label_to_node_id(switch_label)
+        switch_id = self.device_next_hop[self.snpf.id][requestor_id]
+        assert self.node_id_to_label(switch_id)[0] == 'S','Invalid node for switch allocation'
+        debug_print(f"Allocated space for line on {self.node_id_to_label(switch_id)}")
+        return switch_id
 
     def get_closest_sharers(self,h1:str,sharers:List[str]):
         '''
         Given a host and a list of sharers, find the set of sharers that are closest
         '''
-        shortest_path_length = min([nx.shortest_path_length(self.network.G,source=h1,target=s) for s in sharers])
-        
-        closest_sharers: List[str] = []
-        for s in sharers:
-            if nx.shortest_path_length(self.network.G,source=h1,target=s) == shortest_path_length:
-                closest_sharers.append(s)
-        return closest_sharers
+        dist = self.network.dist[h1]
+        shortest_path_length = min([dist[s] for s in sharers])
+        return [s for s in sharers if dist[s] == shortest_path_length]
 
     def switch_location(self,addr:int,host1:int,host2:int):
         '''
@@ -196,24 +348,14 @@ class TopLevelSimulator:
         h1 = self.node_id_to_label(host1)
         h2 = self.node_id_to_label(host2)
         
-        #Find the shortest paths between the two
-        #We want all nodes that lie on the shortest paths
+        #We want all nodes that lie on the shortest paths between the two, without the hosts
         #As long as the entry is on one of these switches, we will have latency reduction
+        mask = self.path_mask(h1,h2)
         
-        all_shortest_paths = nx.all_shortest_paths(self.network.G,source=h1,target=h2)
-        union_set: Set[str] = set()
-        for path in all_shortest_paths:
-            union_set = union_set.union(set(path))
-        #Remove the host endpoints here, the set should only have switches
-        union_set = union_set.difference(self.network.host_ids)
-        
-        assert len(union_set)!=0, f"Empty union set for req {self.reqid} {hex(addr)}"
+        assert mask != 0, f"Empty union set for req {self.reqid} {hex(addr)}"
         
         #Save this information
-        if addr not in self.per_line_switch.keys():
-            self.per_line_switch.update({addr:[union_set]})
-        else:
-            self.per_line_switch[addr].append(union_set)
+        self.record_switch_set(addr,mask)
         
     def switch_location_multiple_sharers(self,addr:int,host1:int,sharer_list:List[int]):
         '''
@@ -223,28 +365,25 @@ class TopLevelSimulator:
         sharers = [self.node_id_to_label(s) for s in sharer_list]
         if h1 in sharers:
             sharers.remove(h1)
-        closest_sharers = self.get_closest_sharers(h1,sharers)
-        union_set = set()
-        for s in closest_sharers:
-            all_shortest_paths = nx.all_shortest_paths(self.network.G,source=h1,target=s)
-            for path in all_shortest_paths:
-                union_set = union_set.union(set(path))
+        #Nodes on the shortest paths to the closest sharers, without the hosts
+        mask = self.sharers_mask(h1,tuple(sharers))
         
-        #Remove endpoints
-        union_set = union_set.difference(self.network.host_ids)
-        
-        assert len(union_set)!=0, f"Empty union set for req {self.reqid} {hex(addr)}"
+        assert mask != 0, f"Empty union set for req {self.reqid} {hex(addr)}"
         
         #Save this information
-        if addr not in self.per_line_switch.keys():
-            self.per_line_switch.update({addr:[union_set]})
-        else:
-            self.per_line_switch[addr].append(union_set)            
+        self.record_switch_set(addr,mask)
     
     def print_swtich_loc(self):
         '''
         Print the ideal switch locations
         '''
+        if self.switch_log != None:
+            self.switch_log.close()
+            print(f"Wrote {self.switch_log.num_events} switch location events to {self.switch_log.prefix}.events")
+            return
+        if self.per_line_switch == None:
+            print("Per line switch locations were not kept, set \"Heavy hitters exact\" or \"Switch log\" to keep them")
+            return
         with open("switch_loc.json","w") as file:
             for key,val in self.per_line_switch.items():
                 file.write(f"{hex(key)}\n")
@@ -252,57 +391,109 @@ class TopLevelSimulator:
                     file.write(f"{','.join(v)}\n")
                 
         
-    def calculate_hops(self,directory_entry: DirectoryEntryExtended, optype: OpType, requestor_id: int, switch_id: int = None):
+    def calculate_hops(self,directory_entry: DirectoryEntryExtended, optype: OpType, requestor_id: int, switch_id: int = None, dir_label: str = None):
         '''
         Given details of a transaction, find out how many theoretical hops it will take
+        The entry must be the state before the transaction, dir_label moves the directory (the home device for the baseline)
         '''
-        debug_print(f"Calculate hops")
+        dist = self.network.dist
+        req = self.node_id_to_label(requestor_id)
+        home = self.node_id_to_label(self.snpf.id)
         #If there is no directory entry
         if directory_entry == None:
             #Path will be
             #Req -> Device -> Switch -> Req
             #                 Switch -> Device
             debug_print(f"{optype} when invalid")
-            return self.network.cost(self.node_id_to_label(requestor_id),f"D0") +\
-                   self.network.cost(f"D0",self.node_id_to_label(switch_id)) +\
-                   self.network.cost(self.node_id_to_label(switch_id),self.node_id_to_label(requestor_id))
-        else:
-            #Directory entry exists
-            #Read when modified or Write when modified
-            if directory_entry.state == DirectoryState.A:
-                #Path will be
-                #Req -> Switch -> Owner -> Switch -> Req
-                debug_print(f"{optype} when modified, dir on {self.node_id_to_label(directory_entry.dir_location)}")
-                return 2 * (self.network.cost(self.node_id_to_label(requestor_id),self.node_id_to_label(directory_entry.dir_location)) +\
-                            self.network.cost(self.node_id_to_label(directory_entry.dir_location),self.node_id_to_label(directory_entry.owner)))
-            elif directory_entry.state == DirectoryState.S and optype == OpType.READ:
+            switch = self.node_id_to_label(switch_id) if dir_label == None else dir_label
+            return dist[req][home] + dist[home][switch] + dist[switch][req]
+        
+        #Directory entry exists
+        loc = self.node_id_to_label(directory_entry.dir_location) if dir_label == None else dir_label
+        #Read when modified or Write when modified
+        if directory_entry.state == DirectoryState.A:
+            #Path will be
+            #Req -> Switch -> Owner -> Switch -> Req
+            debug_print(f"{optype} when modified, dir on {loc}")
+            return 2 * (dist[req][loc] + dist[loc][self.node_id_to_label(directory_entry.owner)])
+        elif directory_entry.state == DirectoryState.S:
+            others = [dist[loc][self.node_id_to_label(s)] for s in directory_entry.sharers if s != requestor_id]
+            debug_print(f"{optype} when shared, dir on {loc}")
+            if len(others) == 0:
+                #Sole sharer upgrading, Req -> Dir Location -> Req
+                return 2 * dist[req][loc]
+            if optype == OpType.READ:
                 #Path will be
                 #Req -> Dir Location -> Closest Sharer -> Dir Location -> Req
-                path_to_closest_sharer = min([nx.shortest_path_length(self.network.G,source=self.node_id_to_label(directory_entry.dir_location),target=self.node_id_to_label(sharer)) for sharer in directory_entry.sharers])
-                debug_print(f"{optype} when shared, dir on {self.node_id_to_label(directory_entry.dir_location)}")
-                return 2 * (self.network.cost(self.node_id_to_label(requestor_id),self.node_id_to_label(directory_entry.dir_location)) +\
-                            path_to_closest_sharer)
-            elif directory_entry.state == DirectoryState.S and optype == OpType.WRITE:
-                #Path will be
-                #Req -> Dir Location -> Furthest sharer -> Dir Location -> Req
-                path_to_furthest_sharer = max([nx.shortest_path_length(self.G,source=self.node_id_to_label(directory_entry.dir_location),target=self.node_id_to_label(sharer)) for sharer in directory_entry.sharers])
-                debug_print(f"{optype} when shared, dir on {self.node_id_to_label(directory_entry.dir_location)}")
-                return 2 * (self.network.cost(self.node_id_to_label(requestor_id),self.node_id_to_label(directory_entry.dir_location)) +\
-                            path_to_furthest_sharer)
-            else:
-                print("Unexpected scenario")
-                print(exit)
+                return 2 * (dist[req][loc] + min(others))
+            #Path will be
+            #Req -> Dir Location -> Furthest sharer -> Dir Location -> Req
+            return 2 * (dist[req][loc] + max(others))
+        else:
+            print(f"Unexpected state {directory_entry.state}")
+            exit(2)
+    
+    def record_hops(self,flow:int,directory_entry: DirectoryEntryExtended, optype: OpType, requestor_id: int, switch_id: int = None)->int:
+        '''
+        Count the hops of one transaction against the device baseline, returns the in network hops
+        '''
+        hops = self.calculate_hops(directory_entry,optype,requestor_id,switch_id)
+        device_hops = self.calculate_hops(directory_entry,optype,requestor_id,switch_id,self.node_id_to_label(self.snpf.id))
+        stats = self.hop_records[flow]
+        stats["Count"] += 1
+        stats["Hops"] += hops
+        stats["Device hops"] += device_hops
+        if hops > device_hops:
+            stats["Deteriorated"] += 1
+        elif hops < device_hops:
+            stats["Improved"] += 1
+        else:
+            stats["Same"] += 1
+        stats["Benefit"] += device_hops - hops
+        for stats in [self.requestor_hops[requestor_id],self.device_hops[self.snpf.id]]:
+            stats["Count"] += 1
+            stats["Hops"] += hops
+            stats["Device hops"] += device_hops
+            stats["Benefit"] += device_hops - hops
+        return hops
+    
+    def print_hop_records(self,filename:str):
+        '''
+        Hop totals per transition and per requestor, in the layout of static_allocation flow records
+        '''
+        overall = {"Type":"Overall"}
+        for key in ["Count","Hops","Device hops","Improved","Same","Deteriorated","Benefit"]:
+            overall[key] = sum(stats[key] for stats in self.hop_records.values())
+        overall["AVG Benefit"] = overall["Benefit"]/overall["Count"] if overall["Count"] else 0
+        records = {flow:{"Type":TRANSITIONS[flow],**stats} for flow,stats in self.hop_records.items()}
+        records[-1] = overall
+        records["Per requestor"] = {self.node_id_to_label(hostid):stats for hostid,stats in self.requestor_hops.items()}
+        if len(self.devices) > 1:
+            records["Per device"] = {self.node_id_to_label(deviceid):{"Hit":device.stats["Hit"],"Miss":device.stats["Miss"],**self.device_hops[deviceid]}
+                                     for deviceid,device in self.devices.items()}
+        
+        if filename != None:
+            with open(filename,"w") as file:
+                json.dump(records,file,indent=4)
+        
+        print(f"Total hops: {overall['Hops']}")
+        print(f"Total hops with directory on device: {overall['Device hops']}")
+        print(f"Overall AVG benefit: {overall['AVG Benefit']}")
     
     def process_req(self,addr:int,optype:OpType,requestor:int):
         '''
         Function processes all the requests made in this address space
         '''
 
+        #Every line is tracked by the snoop filter of its home device
+        self.snpf = self.interleave.home(addr)
         self.snpf.req_id = self.reqid
         debug_print(f"{self.reqid},{hex(addr)},{optype},{requestor}")
         self.reqid += 1
         if self.reqid % 100000 == 0:
             print(self.reqid)
+        if self.telemetry != None:
+            self.telemetry.tick()
         ##############################################
         #This will helpful for using the GUI debugger
         if self.reqid == 1986:
@@ -319,7 +510,7 @@ class TopLevelSimulator:
             
         #Check if there is a directory entry for this address
         if self.snpf.check_hit(addr):
-            debug_print(f"{hex(addr)} is a hit located on {self.node_id_to_label(snpf.get_line(addr).dir_location)} {self.snpf.split_addr(addr)}")
+            debug_print(f"{hex(addr)} is a hit located on {self.node_id_to_label(self.snpf.get_line(addr).dir_location)} {self.snpf.split_addr(addr)}")
             
             #Update the LRU (since it is a hit)
             self.snpf.add_to_lru(addr)
@@ -335,6 +526,8 @@ class TopLevelSimulator:
                 else:
                     #Note which switches would be ideal to store directory entry
                     self.switch_location(addr,requestor,dentry.owner)
+                    #Network section, counted on the state before the transition
+                    self.record_hops(6 if optype == OpType.READ else 7,dentry,optype,requestor)
                     #Handle based on read or write
                     if optype == OpType.READ:
                         #Make owner a sharer
@@ -347,8 +540,6 @@ class TopLevelSimulator:
                         self.snpf.set_state(addr,DirectoryState.S)
                         #Add the line to new sharers cache
                         self.hosts[requestor].allocate(addr)
-                        # #Network section
-                        # self.calculate_hops(dentry,optype,requestor,None)
                     elif optype == OpType.WRITE:
                         #Evict line from the current owners cache
                         self.hosts[dentry.owner].evict(addr)
@@ -358,8 +549,6 @@ class TopLevelSimulator:
                         self.snpf.set_state(addr,DirectoryState.A)
                         #Add the line to new owners cache
                         self.hosts[requestor].allocate(addr)
-                    #Network section
-                    self.calculate_hops(dentry,optype,requestor,None)
             elif dentry.state == DirectoryState.S:
                 if optype == OpType.READ:
                     #Is requestor a sharer?
@@ -368,16 +557,19 @@ class TopLevelSimulator:
                         pass
                     else:
                         self.switch_location_multiple_sharers(addr,requestor,self.snpf.get_sharers(addr))
+                        #Network section
+                        self.record_hops(8,dentry,optype,requestor)
                         #Add requestor as sharer
                         self.snpf.add_sharer(addr,requestor)
                         #Add copy of line to new sharers cache
                         self.hosts[requestor].allocate(addr)
-                        #Network section
-                        self.calculate_hops(dentry,optype,requestor,None)
                 elif optype == OpType.WRITE:
                     #We only need to find ideal switch if the host requesting write permission is not the sole shared permission holder
-                    if not (len(dentry.sharers)==1 and dentry.sharers[0]==requestor):
+                    sole_sharer = len(dentry.sharers)==1 and dentry.sharers[0]==requestor
+                    if not sole_sharer:
                         self.switch_location_multiple_sharers(addr,requestor,self.snpf.get_sharers(addr))
+                    #Network section
+                    self.record_hops(9 if sole_sharer else 10,dentry,optype,requestor)
                     #Invalidate the line form cache of all hosts
                     for hostid in self.snpf.get_sharers(addr):
                         self.hosts[hostid].evict(addr)
@@ -389,8 +581,6 @@ class TopLevelSimulator:
                     self.snpf.set_state(addr,DirectoryState.A)
                     #Add the line to new owners cache
                     self.hosts[requestor].allocate(addr)
-                    #Network section
-                    self.calculate_hops(dentry,optype,requestor,None)
             else:
                 print(f"Unexpected state {dentry.state}")
             self.snpf.update_addr(addr)
@@ -405,6 +595,8 @@ class TopLevelSimulator:
             
             #Allocate a switch
             allocated_switch = self.allocate_switch(requestor)
+            #Network section
+            self.record_hops(11,None,optype,requestor,allocated_switch)
 
             if len(self.snpf.entries[setid]) < self.snpf.assoc:
                 #We don't need to evict anything in snoopfilter
@@ -418,8 +610,6 @@ class TopLevelSimulator:
                     d.owner = requestor
                 d.dir_location = allocated_switch
                 self.snpf.set_line(addr,d)
-                #Network section
-                self.calculate_hops(d,optype,requestor,allocated_switch)
                 #Now allocate line for this on host who will become sharer
                 #We might need to evict line on hosts because of this
                 #Allocate on this host
@@ -437,8 +627,6 @@ class TopLevelSimulator:
                 d.dir_location = allocated_switch
                 #We need to evict an entry in the snoop filter
                 self.snpf.allocate(addr,d)
-                #Network section
-                self.calculate_hops(d,optype,requestor,allocated_switch)
                 # #Set the line in directory
                 # self.snpf.set_line(addr,d)
                 #Add the copy on the host
@@ -495,13 +683,15 @@ class Config:
     '''
     Class which holds the configuration parameters we need for the simulation
     '''
-    def __init__(self,filename):
+    def __init__(self,filename:str=None,d:Dict=None):
         '''
         Parse a json file and update the config parameters
+        Alternatively take an already parsed config dict
         '''
-        with open(filename) as file:
-            d = json.load(file)
-            self.d = d
+        if filename != None:
+            with open(filename) as file:
+                d = json.load(file)
+        self.d = d
 
         self.num_hosts = d["Num hosts"]
         self.host_line_size = d["Host line size"]
@@ -512,6 +702,67 @@ class Config:
         self.device_assoc = d["Device assoc"]
         self.num_switches = d["Num switches"]
         self.switch_num_lines = 0
+        #Devices after D0 and the switch each one hangs off, lines go to them by the interleave
+        self.num_devices = d.get("Num devices",1)
+        self.device_switches = d.get("Device switches",[])
+        self.interleave = d.get("Interleave","line")
+        self.interleave_page_size = d.get("Interleave page size",4096)
+        self.interleave_masks = [int(mask,16) if isinstance(mask,str) else mask for mask in d.get("Interleave masks",None) or []] or None
+        #Rendering needs matplotlib, pydot and graphviz, so it is off unless asked for
+        self.draw_topology = d.get("Draw topology",False)
+        #Periodic status file, rate limited by wall clock
+        self.telemetry_file = d.get("Telemetry file",None)
+        self.telemetry_interval = d.get("Telemetry interval",5.0)
+        #The full per line history feeds analyze_switch_locations.py, turn it off for traces too large to keep it
+        self.heavy_hitters_exact = d.get("Heavy hitters exact",True)
+        self.heavy_hitter_counters = d.get("Heavy hitter counters",1024)
+        self.count_min_width = d.get("Count-min width",1 << 14)
+        self.count_min_depth = d.get("Count-min depth",4)
+        self.heavy_hitter_top = d.get("Heavy hitter top",20)
+        #Prefix of a binary log of every ideal switch location event, replaces switch_loc.json
+        self.switch_log = d.get("Switch log",None)
+        #Hop totals per transition and per requestor
+        self.hops_output = d.get("Hops output","hops.json")
+
+#3x3 switch grid with hosts on three corners and the device at the bottom
+GRID_3X3_EDGES = [("S0","S1"),("S1","S2"),("S3","S4"),("S4","S5"),("S6","S7"),("S7","S8"),
+                  ("S0","S3"),("S1","S4"),("S2","S5"),("S3","S6"),("S4","S7"),("S5","S8"),
+                  ("H0","S0"),("H1","S1"),("H2","S2"),("H3","S8"),("D0","S7")]
+
+def build_simulator(cfg:Config,edges:List=GRID_3X3_EDGES)->TopLevelSimulator:
+    '''
+    Build hosts, snoop filter and topology for the config
+    '''
+    hosts = [CXLHost(cfg.host_line_size,cfg.host_num_lines,cfg.host_assoc,i) for i in range(cfg.num_hosts)]
+    devices = [CXLDevice(cfg.device_line_size,cfg.device_num_lines,cfg.device_assoc,cfg.num_hosts+i) for i in range(cfg.num_devices)]
+    if len(cfg.device_switches) != cfg.num_devices - 1:
+        print(f"Device switches should name the switch of each of the {cfg.num_devices - 1} devices after D0")
+        exit(2)
+    snpf = devices[0]
+    for device in devices:
+        #Dummy switch for now, need to remove it for later
+        switch = Switch(64,0,16)
+        device.set_switch(switch)
+        #Provide snoop filter with the list of hosts
+        device.set_hosts(hosts)
+    #Provide each host with a reference to the snoop filter
+    for host in hosts:
+        host.set_dir(snpf)
+    
+    N = CXLNet(num_hosts=cfg.num_hosts,num_devices=cfg.num_devices,num_switches=cfg.num_switches)
+    #Build the network topology
+    N.G.add_edges_from(edges)
+    N.G.add_edges_from([(f"D{i+1}",switch) for i,switch in enumerate(cfg.device_switches)])
+    if cfg.draw_topology:
+        N.draw()
+
+    sim = TopLevelSimulator(hosts,snpf,N)
+    if len(devices) > 1:
+        sim.set_devices(devices,Interleave(devices,cfg.interleave,cfg.device_line_size,cfg.interleave_page_size,cfg.interleave_masks))
+    sim.set_heavy_hitters(cfg.heavy_hitters_exact,cfg.heavy_hitter_counters,cfg.count_min_width,cfg.count_min_depth)
+    if cfg.switch_log != None:
+        sim.set_switch_log(cfg.switch_log)
+    return sim
 
 
 if __name__ == '__main__':
@@ -540,38 +791,18 @@ if __name__ == '__main__':
         print(f"{key}:{val}")
     print("#####################")
     
-    hosts = [CXLHost(cfg.host_line_size,cfg.host_num_lines,cfg.host_assoc,i) for i in range(cfg.num_hosts)]
-    snpf = CXLDevice(cfg.device_line_size,cfg.device_num_lines,cfg.device_assoc,cfg.num_hosts)
-    #Dummy switch for now, need to remove it for later
-    switch = Switch(64,0,16)
-    snpf.set_switch(switch)
-    #Provide each host with a reference to the snoop filter
-    for host in hosts:
-        host.set_dir(snpf)
-    #Provide snoop filter with the list of hosts
-    snpf.set_hosts(hosts)
-    
-    N = CXLNet(num_hosts=cfg.num_hosts,num_devices=1,num_switches=cfg.num_switches)
-    #Build the network topology
-    edges = [("S0","S1"),("S1","S2"),("S3","S4"),("S4","S5"),("S6","S7"),("S7","S8"),
-             ("S0","S3"),("S1","S4"),("S2","S5"),("S3","S6"),("S4","S7"),("S5","S8"),
-             ("H0","S0"),("H1","S1"),("H2","S2"),("H3","S8"),("D0","S7")]
-    N.G.add_edges_from(edges)
-    N.draw()
+    sim = build_simulator(cfg)
+    if cfg.telemetry_file != None:
+        sim.telemetry = Telemetry(sim,cfg.telemetry_file,cfg.telemetry_interval,estimate_requests(trace_file))
 
-    sim = TopLevelSimulator(hosts,snpf,N)
-
-    #Read requests from trace file line by line and input to the coherence engine
-    with open(trace_file) as file:
-        while True:
-            line = file.readline()
-            if not line:
-                break
-            split_line = line.split(' ')
-            addr = int(split_line[0],16)
-            optype = OpType.READ if split_line[1] == 'R' else OpType.WRITE
-            hostid = int(split_line[2].strip())
-            #Now send request to coherence engine
-            sim.process_req(addr,optype,hostid)
+    #Read requests from the trace (text, gzip or binary) and input to the coherence engine
+    for addr,op,hostid in read_trace(trace_file):
+        sim.process_req(addr,OpType.READ if op == 'R' else OpType.WRITE,hostid)
+    
+    if sim.telemetry != None:
+        sim.telemetry.close()
     
-    sim.print_swtich_loc()
\ No newline at end of file
+    sim.print_swtich_loc()
+    sim.print_hop_records(cfg.hops_output)
+    with open("heavy_hitters.json","w") as file:
+        json.dump(sim.heavy_hitter_report(cfg.heavy_hitter_top),file,indent=4)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import json
+from time import perf_counter
+from typing import Dict, List
+
+#Engine methods timed by the phase profiler, everything else inside process_req counts as the state transition
+ENGINE_PHASES = {
+    "handle_host_eviction": "Host eviction",
+    "handle_directory_eviction": "Directory eviction",
+    "migration_policy": "Migration",
+    "placement_policy": "Placement",
+    "static_path_benefit": "Path costing",
+    "remove_intermediate": "Path costing",
+    "verify_request": "Verification",
+    "verify_region_request": "Verification",
+    "verify_system_state": "Verification"
+}
+#Directory searches on the device, which also cover the switches
+DEVICE_PHASES = {
+    "search_entry_device": "Lookup",
+    "search_entry_switch": "Lookup",
+    "find_directory_entry": "Lookup",
+    "find_directory_location": "Lookup"
+}
+TRANSITION = "State transition"
+#Requests that hit in the requestors cache and generate no CXL traffic
+NO_FLOW = 0
+
+class PhaseProfiler:
+    '''
+    Exclusive wall clock time per phase of CoherenceEngine.process_req, split by the flow type of each request
+    Works by shadowing engine and device methods with timed wrappers on the instances, so there is no cost when not attached
+    '''
+
+    def __init__(self):
+        self.time: Dict[str,float] = dict()
+        self.calls: Dict[str,int] = dict()
+        #Flow type -> phase -> time
+        self.per_flow: Dict[int,Dict[str,float]] = dict()
+        self.per_flow_requests: Dict[int,int] = dict()
+
+        self.stack: List[str] = []
+        self.mark = 0
+        self.current: Dict[str,float] = dict()
+        self.engine = None
+
+    def charge(self,now:float):
+        '''
+        Give the time since the last mark to the phase on top of the stack
+        '''
+        if self.stack:
+            phase = self.stack[-1]
+            self.current[phase] = self.current.get(phase,0) + now - self.mark
+        self.mark = now
+
+    def wrap(self,phase:str,fn):
+        def timed(*args,**kwargs):
+            self.charge(perf_counter())
+            self.stack.append(phase)
+            self.calls[phase] = self.calls.get(phase,0) + 1
+            try:
+                return fn(*args,**kwargs)
+            finally:
+                self.charge(perf_counter())
+                self.stack.pop()
+        return timed
+
+    def wrap_request(self,fn):
+        def timed(*args,**kwargs):
+            self.current = dict()
+            self.mark = perf_counter()
+            self.stack.append(TRANSITION)
+            try:
+                return fn(*args,**kwargs)
+            finally:
+                self.charge(perf_counter())
+                self.stack.pop()
+                #The request's own flow, not an eviction it caused
+                flow = self.engine.request_flow if self.engine.request_flow != None else NO_FLOW
+                flow_times = self.per_flow.setdefault(flow,dict())
+                for phase,t in self.current.items():
+                    self.time[phase] = self.time.get(phase,0) + t
+                    flow_times[phase] = flow_times.get(phase,0) + t
+                self.per_flow_requests[flow] = self.per_flow_requests.get(flow,0) + 1
+        return timed
+
+    def attach(self,engine):
+        self.engine = engine
+        for method,phase in ENGINE_PHASES.items():
+            setattr(engine,method,self.wrap(phase,getattr(engine,method)))
+        for device in engine.devices.values():
+            for method,phase in DEVICE_PHASES.items():
+                setattr(device,method,self.wrap(phase,getattr(device,method)))
+        engine.process_req = self.wrap_request(engine.process_req)
+        self.calls[TRANSITION] = 0
+
+    def report(self)->Dict:
+        total = sum(self.time.values())
+        requests = sum(self.per_flow_requests.values())
+        return {
+            "Requests": requests,
+            "Total time": total,
+            "Phases": {phase:{"Time":t,
+                              "Share":t/total if total else 0,
+                              "Calls":self.calls.get(phase,requests) if phase != TRANSITION else requests}
+                       for phase,t in sorted(self.time.items(),key=lambda item: item[1],reverse=True)},
+            "Per flow": {flow:{"Description":self.engine.communication_flows.get(flow,"No CXL traffic"),
+                               "Requests":self.per_flow_requests[flow],
+                               "Time":sum(times.values()),
+                               "Time per request":sum(times.values())/self.per_flow_requests[flow],
+                               "Phases":times}
+                         for flow,times in sorted(self.per_flow.items())}
+        }
+
+    def write(self,filename:str):
+        report = self.report()
+        with open(filename,"w") as file:
+            json.dump(report,file,indent=4)
+
+        print(f"Profiled {report['Requests']} requests in {report['Total time']:.2f}s")
+        for phase,stats in report["Phases"].items():
+            print(f"{phase:<20}{stats['Time']:>10.3f}s{100*stats['Share']:>8.1f}%{stats['Calls']:>12}")
+        for flow,stats in report["Per flow"].items():
+            print(f"Flow {flow:<3}{stats['Requests']:>12} requests{1e6*stats['Time per request']:>10.1f}us/request")
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from typing import Dict, List
+
+#Config entries that only say where results go or how verbose the run is, they do not change results
+NON_RESULT_KEYS = ["Output json", "Debug", "Draw topology", "Results db", "Telemetry file", "Telemetry interval", "Profile", "Profile output"]
+
+#Source files whose contents define the simulator version
+SIMULATOR_SOURCES = ["static_allocation.py", "traces.py", "trace_index.py", "convergence.py", "sketches.py", "interleave.py", os.path.join("cache", "cachesim.py")]
+
+HASH_CHUNK = 1 << 20
+
+def hash_file(filename:str)->str:
+    h = hashlib.sha256()
+    with open(filename,"rb") as file:
+        while True:
+            chunk = file.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def simulator_version(root:str=os.path.dirname(os.path.abspath(__file__)))->str:
+    '''
+    Hash of the simulator sources, any code change invalidates the cache
+    '''
+    h = hashlib.sha256()
+    for source in SIMULATOR_SOURCES:
+        path = os.path.join(root,source)
+        if os.path.exists(path):
+            h.update(source.encode())
+            h.update(hash_file(path).encode())
+    return h.hexdigest()
+
+def normalize_config(cfg:Dict)->Dict:
+    return {key:val for key,val in cfg.items() if key not in NON_RESULT_KEYS}
+
+class ResultCache:
+    '''
+    Content addressed store of simulation results
+    Every entry is a directory named by its key, holding the result json, the log and a meta.json
+    Entries are written atomically so concurrent sweep workers can share one cache
+    '''
+
+    def __init__(self,root:str):
+        self.root = root
+        self.entries_dir = os.path.join(root,"entries")
+        self.trace_hash_dir = os.path.join(root,"trace_hashes")
+        os.makedirs(self.entries_dir,exist_ok=True)
+        os.makedirs(self.trace_hash_dir,exist_ok=True)
+        self.version = simulator_version()
+
+    def trace_hash(self,filename:str)->str:
+        '''
+        Hash of the trace contents
+        Traces are large, so the hash is remembered for as long as the file size and mtime do not change
+        '''
+        st = os.stat(filename)
+        stamp = hashlib.sha256(f"{os.path.abspath(filename)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+        memo = os.path.join(self.trace_hash_dir,stamp)
+        if os.path.exists(memo):
+            with open(memo) as file:
+                return file.read().strip()
+        digest = hash_file(filename)
+        tmp = f"{memo}.{os.getpid()}"
+        with open(tmp,"w") as file:
+            file.write(digest)
+        os.replace(tmp,memo)
+        return digest
+
+    def key(self,trace_files:List[str],cfg:Dict)->str:
+        '''
+        Key of a run: trace contents, normalized config, topology and simulator version
+        '''
+        h = hashlib.sha256()
+        h.update(self.version.encode())
+        for trace in trace_files:
+            h.update(self.trace_hash(trace).encode())
+        h.update(json.dumps(normalize_config(cfg),sort_keys=True).encode())
+        if "Edgelist" in cfg and os.path.exists(cfg["Edgelist"]):
+            h.update(hash_file(cfg["Edgelist"]).encode())
+        return h.hexdigest()
+
+    def entry_dir(self,key:str)->str:
+        return os.path.join(self.entries_dir,key)
+
+    def fetch(self,key:str,result_file:str,log_file:str=None)->bool:
+        '''
+        Copy a cached result (and log) to where the run would have written it
+        Returns False on a miss
+        '''
+        entry = self.entry_dir(key)
+        meta_file = os.path.join(entry,"meta.json")
+        if not os.path.exists(meta_file):
+            return False
+        shutil.copyfile(os.path.join(entry,"result.json"),result_file)
+        if log_file != None and os.path.exists(os.path.join(entry,"log.txt")):
+            shutil.copyfile(os.path.join(entry,"log.txt"),log_file)
+        #Touch the entry so eviction knows it is still in use
+        os.utime(meta_file)
+        return True
+
+    def store(self,key:str,result_file:str,log_file:str=None,meta:Dict=None):
+        '''
+        Add the result of a finished run to the cache
+        '''
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            return
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp,exist_ok=True)
+        shutil.copyfile(result_file,os.path.join(tmp,"result.json"))
+        if log_file != None and os.path.exists(log_file):
+            shutil.copyfile(log_file,os.path.join(tmp,"log.txt"))
+        meta = dict(meta) if meta else dict()
+        meta["Created"] = time.time()
+        meta["Simulator version"] = self.version
+        with open(os.path.join(tmp,"meta.json"),"w") as file:
+            json.dump(meta,file,indent=4)
+        try:
+            os.rename(tmp,entry)
+        except OSError:
+            #Another worker stored the same key first
+            shutil.rmtree(tmp,ignore_errors=True)
+
+    def drop(self,key:str):
+        shutil.rmtree(self.entry_dir(key),ignore_errors=True)
+
+    def index(self)->Dict[str,Dict]:
+        '''
+        Metadata of every cached result, with size and last use time
+        '''
+        entries = dict()
+        for key in os.listdir(self.entries_dir):
+            entry = self.entry_dir(key)
+            meta_file = os.path.join(entry,"meta.json")
+            if not os.path.exists(meta_file):
+                continue
+            with open(meta_file) as file:
+                meta = json.load(file)
+            meta["Last used"] = os.path.getmtime(meta_file)
+            meta["Size"] = sum(os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry))
+            entries[key] = meta
+        return entries
+
+    def evict(self,max_age:float=None,max_bytes:int=None)->int:
+        '''
+        Drop entries unused for longer than max_age seconds, then least recently used entries until under max_bytes
+        Returns the number of entries removed
+        '''
+        entries = self.index()
+        now = time.time()
+        removed = []
+        if max_age != None:
+            removed += [key for key,meta in entries.items() if now - meta["Last used"] > max_age]
+        if max_bytes != None:
+            remaining = sorted([key for key in entries.keys() if key not in removed],key=lambda key: entries[key]["Last used"])
+            total = sum(entries[key]["Size"] for key in remaining)
+            while remaining and total > max_bytes:
+                key = remaining.pop(0)
+                total -= entries[key]["Size"]
+                removed.append(key)
+        for key in removed:
+            self.drop(key)
+        return len(removed)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Inspect and trim the sweep result cache")
+    parser.add_argument("root")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+    sub.add_parser("list")
+    evict_parser = sub.add_parser("evict")
+    evict_parser.add_argument("--max-age-days",type=float,default=None)
+    evict_parser.add_argument("--max-size-mb",type=float,default=None)
+    sub.add_parser("clear")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.root)
+    if args.cmd == "list":
+        for key,meta in sorted(cache.index().items(),key=lambda item: item[1]["Created"]):
+            current = "" if meta["Simulator version"] == cache.version else " (stale version)"
+            print(f"{key[:16]} {time.ctime(meta['Created'])} {meta['Size']:>10}B {meta.get('Trace')} {meta.get('Values')}{current}")
+    elif args.cmd == "evict":
+        max_age = args.max_age_days * 86400 if args.max_age_days != None else None
+        max_bytes = int(args.max_size_mb * (1 << 20)) if args.max_size_mb != None else None
+        print(f"Evicted {cache.evict(max_age,max_bytes)} entries")
+    elif args.cmd == "clear":
+        print(f"Evicted {cache.evict(max_age=-1)} entries")
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+from typing import Dict, List
+
+#Config entries that get their own indexed column, everything else is queryable through the params table
+RUN_COLUMNS = {
+    "Num hosts": "num_hosts",
+    "Num switches": "num_switches",
+    "Host num lines": "host_num_lines",
+    "Device num lines": "device_num_lines",
+    "Switch num lines": "switch_num_lines",
+    "Placement policy": "placement_policy",
+    "Migration policy": "migration_policy",
+    "Edgelist": "edgelist"
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL,
+    trace TEXT,
+    trace_size INTEGER,
+    requests INTEGER,
+    num_hosts INTEGER,
+    num_switches INTEGER,
+    host_num_lines INTEGER,
+    device_num_lines INTEGER,
+    switch_num_lines INTEGER,
+    placement_policy TEXT,
+    migration_policy TEXT,
+    edgelist TEXT,
+    runtime REAL,
+    peak_rss_kb INTEGER,
+    config TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_trace ON runs(trace);
+CREATE INDEX IF NOT EXISTS runs_policy ON runs(placement_policy, migration_policy);
+CREATE INDEX IF NOT EXISTS runs_sizes ON runs(host_num_lines, switch_num_lines, device_num_lines);
+CREATE TABLE IF NOT EXISTS params (
+    run_id INTEGER REFERENCES runs(id),
+    key TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS params_key ON params(key, value);
+CREATE INDEX IF NOT EXISTS params_run ON params(run_id);
+CREATE TABLE IF NOT EXISTS flow_records (
+    run_id INTEGER REFERENCES runs(id),
+    flow_type INTEGER,
+    improved INTEGER,
+    same INTEGER,
+    deteriorated INTEGER,
+    benefit INTEGER
+);
+CREATE INDEX IF NOT EXISTS flow_run ON flow_records(run_id, flow_type);
+CREATE TABLE IF NOT EXISTS migration_stats (
+    run_id INTEGER REFERENCES runs(id),
+    key TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS migration_run ON migration_stats(run_id, key);
+CREATE TABLE IF NOT EXISTS run_info (
+    run_id INTEGER REFERENCES runs(id),
+    key TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS info_key ON run_info(key, run_id);
+"""
+
+#Section of the run info holding what record_run needs, written to the result json of runs that record into a database
+RUN_RECORD = "Run record"
+
+def flatten_info(info:Dict,prefix:str="")->Dict[str,object]:
+    '''
+    Nested run info (convergence, heavy hitters, devices, regions...) as "Section/Key" entries
+    '''
+    flat = dict()
+    for key,val in info.items():
+        name = f"{prefix}{key}"
+        if isinstance(val,dict):
+            flat.update(flatten_info(val,f"{name}/"))
+        else:
+            flat[name] = val
+    return flat
+
+def _value_order(val:str):
+    '''
+    Sort numeric parameter values numerically and everything else as text
+    '''
+    v = json.loads(val)
+    if isinstance(v,(int,float)):
+        return (0,v,"")
+    return (1,0,val)
+
+#Pool workers write at the same time, sqlite serializes them, we just have to wait our turn
+BUSY_TIMEOUT = 120
+
+class ResultsDB:
+    '''
+    One sqlite database holding the results of every run of a sweep
+    '''
+
+    def __init__(self,filename:str):
+        self.conn = sqlite3.connect(filename,timeout=BUSY_TIMEOUT)
+        #WAL lets readers query while workers are still writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def record_run(self,cfg:Dict,trace_files:List[str],flow_records:Dict,migration_stats:Dict,requests:int,runtime:float,peak_rss_kb:int,run_info:Dict=None)->int:
+        '''
+        Store one finished run in a single transaction, returns the run id
+        '''
+        info = flatten_info({key:val for key,val in (run_info or dict()).items() if key != RUN_RECORD})
+        columns = {col:cfg.get(key) for key,col in RUN_COLUMNS.items()}
+        columns.update({
+            "created": time.time(),
+            "trace": ",".join(trace_files),
+            "trace_size": sum(os.path.getsize(t) for t in trace_files),
+            "requests": requests,
+            "runtime": runtime,
+            "peak_rss_kb": peak_rss_kb,
+            "config": json.dumps(cfg,sort_keys=True)
+        })
+        with self.conn:
+            cur = self.conn.execute(f"INSERT INTO runs ({','.join(columns.keys())}) VALUES ({','.join('?'*len(columns))})",list(columns.values()))
+            run_id = cur.lastrowid
+            self.conn.executemany("INSERT INTO params VALUES (?,?,?)",
+                                  [(run_id,key,json.dumps(val)) for key,val in cfg.items()])
+            self.conn.executemany("INSERT INTO flow_records VALUES (?,?,?,?,?,?)",
+                                  [(run_id,int(flow_type),stats["Improved"],stats["Same"],stats["Deteriorated"],stats["Benefit"])
+                                   for flow_type,stats in flow_records.items()])
+            self.conn.executemany("INSERT INTO migration_stats VALUES (?,?,?)",
+                                  [(run_id,key,val) for key,val in migration_stats.items()])
+            self.conn.executemany("INSERT INTO run_info VALUES (?,?,?)",
+                                  [(run_id,key,json.dumps(val)) for key,val in info.items()])
+        return run_id
+
+    def record_output(self,cfg:Dict,trace_files:List[str],result_file:str)->int:
+        '''
+        Store a run from its result json (e.g. one fetched from the result cache)
+        Returns None when the json was written by a run that did not record into a database
+        '''
+        with open(result_file) as file:
+            result = json.load(file)
+        run_info = result.pop("Run info",dict())
+        if RUN_RECORD not in run_info:
+            return None
+        record = run_info[RUN_RECORD]
+        return self.record_run(cfg,trace_files,result,record["Migration stats"],record["Requests"],record["Runtime"],record["Peak RSS KB"],run_info)
+
+    def pivot(self,param:str,flow_type:int=-1,metric:str="benefit",info:str=None)->Dict[str,Dict[str,float]]:
+        '''
+        Benefit (or average benefit per transaction) for every trace against the values of one config parameter
+        With info, a numeric run info entry (e.g. "Regions/Capacity savings") instead of the flow records
+        '''
+        if info != None:
+            value = "CAST(i.value AS REAL)"
+            source = "JOIN run_info i ON i.run_id = r.id AND i.key = ?"
+            selector = info
+        elif metric in ["benefit","avg"]:
+            value = "f.benefit" if metric == "benefit" else "CAST(f.benefit AS REAL)/MAX(f.improved+f.same+f.deteriorated,1)"
+            source = "JOIN flow_records f ON f.run_id = r.id AND f.flow_type = ?"
+            selector = flow_type
+        else:
+            print(f"Unknown metric {metric}")
+            exit(2)
+        rows = self.conn.execute(f"""
+            SELECT r.trace, p.value, AVG({value})
+            FROM runs r
+            JOIN params p ON p.run_id = r.id AND p.key = ?
+            {source}
+            GROUP BY r.trace, p.value""",(param,selector)).fetchall()
+        table: Dict[str,Dict[str,float]] = dict()
+        for trace,val,benefit in rows:
+            table.setdefault(trace,dict())[val] = benefit
+        return table
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Query the sweep results database")
+    parser.add_argument("db")
+    sub = parser.add_subparsers(dest="cmd",required=True)
+    pivot_parser = sub.add_parser("pivot",help="Benefit per trace against the values of a config parameter")
+    pivot_parser.add_argument("param",help='Config key, e.g. "Host num lines"')
+    pivot_parser.add_argument("--flow",type=int,default=-1,help="Flow type, -1 is the overall record")
+    pivot_parser.add_argument("--metric",choices=["benefit","avg"],default="benefit")
+    pivot_parser.add_argument("--info",default=None,help='Pivot a run info entry instead, e.g. "Regions/Capacity savings"')
+    runs_parser = sub.add_parser("runs",help="List stored runs")
+    sql_parser = sub.add_parser("sql",help="Run an arbitrary query")
+    sql_parser.add_argument("query")
+    args = parser.parse_args()
+
+    db = ResultsDB(args.db)
+    if args.cmd == "pivot":
+        table = db.pivot(args.param,args.flow,args.metric,args.info)
+        values = sorted({val for row in table.values() for val in row.keys()},key=_value_order)
+        print(f"{'Trace':<40}" + "".join(f"{v:>16}" for v in values))
+        for trace,row in sorted(table.items()):
+            print(f"{os.path.basename(trace):<40}" + "".join(f"{row[v]:>16.4f}" if v in row else f"{'-':>16}" for v in values))
+    elif args.cmd == "runs":
+        for row in db.conn.execute("SELECT id, trace, placement_policy, migration_policy, host_num_lines, switch_num_lines, runtime, peak_rss_kb FROM runs ORDER BY id"):
+            print(row)
+    elif args.cmd == "sql":
+        for row in db.conn.execute(args.query):
+            print(row)
@@ -5,10 +5,15 @@ import multiprocessing
 from typing import List, Tuple, Dict, Set
 import json
 import time
+from result_cache import ResultCache
 
 SCRATCHSPACE = "./scratchspace/cachesize"
 PYTHON = "/mnt/nvme/umeshsum/cxl-net/venvpypy/bin/pypy3"
 VENV_COMMAND = "source venvpypy/bin/activate"
+#Results of earlier sweeps, only new (trace, config) points get simulated
+RESULT_CACHE = "./scratchspace/result_cache"
+RESULT_CACHE_MAX_AGE_DAYS = 30
+RESULT_CACHE_MAX_SIZE_MB = 4096
 
 def run_command(cmd: str, outfile:str="temp.txt"):
     
@@ -16,7 +21,8 @@ def run_command(cmd: str, outfile:str="temp.txt"):
     print(cmd_args)
     # print(cmd)
     with open(outfile,"w") as file:
-        subprocess.run(cmd_args,stdout=file,stderr=file)
+        proc = subprocess.run(cmd_args,stdout=file,stderr=file)
+    return proc.returncode
         # subprocess.run(cmd_args)
     # subprocess.run(cmd,shell=True)
 
@@ -41,9 +47,30 @@ def generate_config_and_run(config_template:str,entries_to_change:List[str],valu
     for entry,value in zip(entries_to_change,values):
         cfg[entry] = value
 
+    log_file = os.path.join(SCRATCHSPACE,f"log_{file_prefix}_{values_to_str(values)}.txt")
+    
+    #With a results database in the template every run lands there, the json and log only pass through the cache
+    use_db = cfg.get("Results db",None) != None
+    
     #Change output filename
     cfg["Output json"] = os.path.join(SCRATCHSPACE,f"result_{file_prefix}_{values_to_str(values)}.json")
-
+    
+    #Skip the simulation if this exact point was run before
+    cache = ResultCache(RESULT_CACHE)
+    key = cache.key([tracefile],cfg)
+    if cache.fetch(key,cfg["Output json"],log_file):
+        if not use_db:
+            print(f"Cached result for {tracefile} {values}")
+            return
+        from results_db import ResultsDB
+        if ResultsDB(cfg["Results db"]).record_output(cfg,[tracefile],cfg["Output json"]) != None:
+            print(f"Cached result for {tracefile} {values} recorded in {cfg['Results db']}")
+            os.remove(cfg["Output json"])
+            os.remove(log_file)
+            return
+        #Cached by a run without a database, it lacks the run record, simulate again
+        cache.drop(key)
+    
     new_cfg_filename = f"{file_prefix}_{values_to_str(values)}.json"
     
     #Write out the new config file
@@ -51,21 +78,27 @@ def generate_config_and_run(config_template:str,entries_to_change:List[str],valu
     with open(cfg_file,"w") as file:
         json.dump(cfg,file,indent=4)
         
-    log_file = os.path.join(SCRATCHSPACE,f"log_{file_prefix}_{values_to_str(values)}.txt")
-        
     #Ready the command we want to run
     cmd = f"{PYTHON} static_allocation.py {cfg_file} {tracefile}"
     print(cmd)
     #run command
 
     start = time.time()
-    run_command(cmd,outfile=log_file)
+    returncode = run_command(cmd,outfile=log_file)
     end = time.time()
     elapsed = end - start
     #Append execution time to the logfile
     with open(log_file,"a") as file:
         file.write(f"Time: {elapsed}s")
     
+    #Only successful runs are worth remembering
+    if returncode == 0 and os.path.exists(cfg["Output json"]):
+        cache.store(key,cfg["Output json"],log_file,{"Trace":tracefile,"Entries":entries_to_change,"Values":values})
+        if use_db:
+            #Runtime and results are in the database, the log is only interesting if the run failed
+            os.remove(cfg["Output json"])
+            os.remove(log_file)
+    
     #Remove the config file, we already have the config information in the log
     os.remove(cfg_file)
     
@@ -88,6 +121,9 @@ if __name__ == '__main__':
     # values = [[23,[23]],[27,[27]],[31,[31]],[23,[23,27,31,16]],[31,[16]]]
     values = [[1024,1024],[4096,4096],[16384,16384],[65536,65536]]
     
+    #Keep the result cache bounded
+    ResultCache(RESULT_CACHE).evict(RESULT_CACHE_MAX_AGE_DAYS*86400,RESULT_CACHE_MAX_SIZE_MB*(1 << 20))
+    
     args = []
     
     for trace in tracefiles:
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import traceback
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+DEFAULT_SOCKET = "/tmp/cxl-net-sim.sock"
+#How often a worker reports progress back to the client
+PROGRESS_EVERY = 100000
+#Rough size of one parsed request in memory (list slot, tuple and address int), to size the trace cache
+REQUEST_BYTES = 100
+
+##############################################
+#Worker side
+#Workers are long lived processes so the interpreter (and pypy's JIT) stays warm between jobs
+#Topologies and parsed traces are cached per worker
+##############################################
+
+_progress_queue = None
+_topologies: Dict[Tuple, object] = dict()
+_traces: "OrderedDict[Tuple, List[Tuple]]" = OrderedDict()
+_trace_cache_limit = 0
+
+def _init_worker(progress_queue,trace_cache_limit:int):
+    global _progress_queue, _trace_cache_limit
+    _progress_queue = progress_queue
+    _trace_cache_limit = trace_cache_limit
+
+def _file_key(filename:str)->Tuple:
+    '''
+    Cache key that changes whenever the file is rewritten
+    '''
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+def _get_network(cfg):
+    from static_allocation import build_network
+    key = (_file_key(cfg.edgelist), cfg.num_hosts, cfg.num_devices, cfg.num_switches)
+    if key not in _topologies:
+        _topologies[key] = build_network(cfg)
+    return _topologies[key]
+
+def _get_requests(trace_files:List[str],cfg):
+    '''
+    Parsed requests of a single trace, cut to the trace start and end, are kept in memory up to the cache limit (in requests)
+    Per host traces are merged on the fly every time
+    '''
+    from static_allocation import trace_requests
+
+    if len(trace_files) != 1:
+        return trace_requests(cfg,trace_files)
+
+    key = (_file_key(trace_files[0]), cfg.trace_start, cfg.trace_end)
+    if key in _traces:
+        _traces.move_to_end(key)
+        return _traces[key]
+
+    requests = list(trace_requests(cfg,trace_files))
+    if len(requests) <= _trace_cache_limit:
+        _traces[key] = requests
+        #Evict least recently used traces beyond the limit
+        while sum(len(r) for r in _traces.values()) > _trace_cache_limit:
+            _traces.popitem(last=False)
+    return requests
+
+def run_job(jobid:int,cwd:str,config_file:str,trace_files:List[str],log_file:str=None):
+    '''
+    Equivalent of running static_allocation.py on the config and traces from the directory cwd
+    '''
+    from static_allocation import Config, run_simulation
+
+    #Relative paths in the config (edgelist, output json) resolve like a direct invocation would
+    os.chdir(cwd)
+    try:
+        with open(log_file if log_file else os.devnull,"w") as log, contextlib.redirect_stdout(log):
+            start = time.time()
+            cfg = Config(config_file)
+            progress = lambda reqid: _progress_queue.put((jobid,reqid,time.time()-start))
+            simulator = run_simulation(cfg,trace_files,_get_network(cfg),_get_requests(trace_files,cfg),progress,PROGRESS_EVERY)
+            elapsed = time.time() - start
+            print(f"Time: {elapsed}s")
+    except SystemExit as e:
+        #The simulator bails out with exit() on bad configs, dont let that take the worker down
+        raise RuntimeError(f"Simulator exited with status {e.code}")
+
+    return {
+        "Requests": simulator.reqid,
+        "Time": elapsed,
+        "Output json": cfg.output_json,
+        "Flow records": simulator.flow_records,
+        "Migration stats": simulator.migration_stats
+    }
+
+##############################################
+#Daemon side
+##############################################
+
+class SimDaemon:
+
+    def __init__(self,socket_path:str,num_workers:int,trace_cache_limit:int):
+        self.socket_path = socket_path
+        self.progress_queue = multiprocessing.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,initializer=_init_worker,initargs=(self.progress_queue,trace_cache_limit))
+        self.num_workers = num_workers
+        self.next_jobid = 0
+        #Progress subscribers for running and queued jobs
+        self.listeners: Dict[int,asyncio.Queue] = dict()
+        self.stats = {"Submitted":0, "Completed":0, "Failed":0}
+        self.server = None
+
+    async def forward_progress(self):
+        '''
+        Move progress messages from the worker processes to the client connections waiting on them
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await loop.run_in_executor(None,self.progress_queue.get)
+            if msg == None:
+                break
+            jobid, reqid, elapsed = msg
+            if jobid in self.listeners:
+                self.listeners[jobid].put_nowait({"type":"progress","job":jobid,"requests":reqid,"elapsed":elapsed})
+
+    async def send(self,writer:asyncio.StreamWriter,msg:Dict):
+        writer.write((json.dumps(msg)+"\n").encode())
+        await writer.drain()
+
+    async def run(self,msg:Dict,writer:asyncio.StreamWriter):
+        jobid = self.next_jobid
+        self.next_jobid += 1
+        self.stats["Submitted"] += 1
+        listener = asyncio.Queue()
+        self.listeners[jobid] = listener
+        await self.send(writer,{"type":"queued","job":jobid})
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor,run_job,jobid,msg["cwd"],msg["config"],msg["traces"],msg.get("log"))
+        try:
+            #Stream progress until the job finishes
+            while not future.done():
+                getter = asyncio.ensure_future(listener.get())
+                await asyncio.wait([future,getter],return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    await self.send(writer,getter.result())
+                else:
+                    getter.cancel()
+        except ConnectionError:
+            #Client went away, the job still runs to completion but nobody gets the reply
+            writer = None
+            await asyncio.wait([future])
+        finally:
+            del self.listeners[jobid]
+
+        try:
+            reply = {"type":"result","job":jobid,**future.result()}
+            self.stats["Completed"] += 1
+        except Exception as e:
+            self.stats["Failed"] += 1
+            reply = {"type":"error","job":jobid,"error":"".join(traceback.format_exception(type(e),e,e.__traceback__))}
+        if writer != None:
+            await self.send(writer,reply)
+
+    async def handle_client(self,reader:asyncio.StreamReader,writer:asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            msg = json.loads(line)
+            if msg["cmd"] == "run":
+                await self.run(msg,writer)
+            elif msg["cmd"] == "status":
+                await self.send(writer,{"type":"status","workers":self.num_workers,"active":len(self.listeners),**self.stats})
+            elif msg["cmd"] == "shutdown":
+                await self.send(writer,{"type":"shutdown"})
+                self.server.close()
+            else:
+                await self.send(writer,{"type":"error","error":f"Unknown command {msg['cmd']}"})
+        except ConnectionError:
+            #Client went away, the job still runs to completion
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle_client,path=self.socket_path)
+        forwarder = asyncio.ensure_future(self.forward_progress())
+        print(f"Listening on {self.socket_path} with {self.num_workers} workers")
+        try:
+            async with self.server:
+                await self.server.wait_closed()
+        finally:
+            #Wake up the forwarder so the loop can shut down
+            self.progress_queue.put(None)
+            await forwarder
+            self.executor.shutdown(cancel_futures=True)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+##############################################
+#Client side
+##############################################
+
+async def request(socket_path:str,msg:Dict,quiet:bool=False)->Dict:
+    '''
+    Send one command and print the streamed replies, returns the final reply
+    '''
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write((json.dumps(msg)+"\n").encode())
+    await writer.drain()
+    reply = None
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        reply = json.loads(line)
+        if reply["type"] == "progress":
+            if not quiet:
+                print(f"Job {reply['job']}: {reply['requests']} requests in {reply['elapsed']:.1f}s",file=sys.stderr)
+        elif reply["type"] == "queued":
+            if not quiet:
+                print(f"Job {reply['job']} queued",file=sys.stderr)
+        else:
+            break
+    writer.close()
+    return reply
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Persistent simulation daemon for static_allocation.py jobs")
+    parser.add_argument("--socket",default=DEFAULT_SOCKET)
+    sub = parser.add_subparsers(dest="cmd",required=True)
+    serve_parser = sub.add_parser("serve",help="Start the daemon")
+    serve_parser.add_argument("--workers",type=int,default=os.cpu_count())
+    serve_parser.add_argument("--trace-cache",type=int,default=512,help="Memory for parsed traces cached per worker, in MB")
+    run_parser = sub.add_parser("run",help="Submit a job and wait for its results, same arguments as static_allocation.py")
+    run_parser.add_argument("config")
+    run_parser.add_argument("traces",nargs="+")
+    run_parser.add_argument("--log",default=None,help="Simulator console output goes here")
+    sub.add_parser("status")
+    sub.add_parser("shutdown")
+    args = parser.parse_args()
+
+    if args.cmd == "serve":
+        daemon = SimDaemon(args.socket,args.workers,args.trace_cache*(1 << 20)//REQUEST_BYTES)
+        asyncio.run(daemon.serve())
+    elif args.cmd == "run":
+        #The daemon may run in a different directory, the job runs from ours
+        msg = {"cmd":"run",
+               "cwd":os.getcwd(),
+               "config":args.config,
+               "traces":args.traces,
+               "log":args.log}
+        reply = asyncio.run(request(args.socket,msg))
+        if reply == None or reply["type"] == "error":
+            print(reply["error"] if reply else "Daemon closed the connection",file=sys.stderr)
+            exit(1)
+        print(f"Overall: {reply['Flow records']['-1']}")
+        print(reply["Migration stats"])
+        print(f"Time: {reply['Time']}s")
+    else:
+        print(json.dumps(asyncio.run(request(args.socket,{"cmd":args.cmd})),indent=4))
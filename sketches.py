@@ -0,0 +1,145 @@
+import math
+import heapq
+from typing import Dict, List, Tuple
+
+MASK64 = (1 << 64) - 1
+
+def mix64(x:int)->int:
+    '''
+    splitmix64 finalizer, spreads line addresses (which are mostly small and sequential) over 64 bits
+    '''
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+class HyperLogLog:
+    '''
+    Distinct count estimate in 2^precision bytes, standard error about 1.04/sqrt(2^precision)
+    Takes already mixed 64 bit hashes
+    '''
+
+    def __init__(self,precision:int=14):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213/(1 + 1.079/self.m)
+
+    def add(self,h:int):
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        #Position of the first set bit in the remaining bits
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self)->int:
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        #Small range correction
+        if estimate <= 2.5*self.m and zeros > 0:
+            estimate = self.m * math.log(self.m/zeros)
+        return int(estimate)
+
+class SpaceSaving:
+    '''
+    Top-k heavy hitters in a fixed number of counters
+    Any item with true count above total/capacity is guaranteed to be kept, counts overestimate by at most the error
+    '''
+
+    def __init__(self,capacity:int=1024):
+        self.capacity = capacity
+        self.counts: Dict[int,int] = dict()
+        self.errors: Dict[int,int] = dict()
+        #Lazy min heap of (count, item), stale entries are skipped when popped
+        self.heap: List[Tuple[int,int]] = []
+
+    def add(self,item,weight:int=1):
+        if item in self.counts:
+            self.counts[item] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+            heapq.heappush(self.heap,(weight,item))
+            return
+        #Replace the smallest counter
+        while True:
+            count, victim = heapq.heappop(self.heap)
+            if self.counts.get(victim) == count:
+                break
+            if victim in self.counts:
+                heapq.heappush(self.heap,(self.counts[victim],victim))
+        del self.counts[victim]
+        del self.errors[victim]
+        self.counts[item] = count + weight
+        self.errors[item] = count
+        heapq.heappush(self.heap,(count + weight,item))
+
+    def top(self,k:int)->List[Tuple[object,int,int]]:
+        '''
+        (item, count, maximum overestimate) of the k largest counters
+        '''
+        items = sorted(self.counts.items(),key=lambda item: item[1],reverse=True)[:k]
+        return [(item,count,self.errors[item]) for item,count in items]
+
+class CountMinSketch:
+    '''
+    Frequency estimate of any item in depth*width counters, never underestimates
+    With probability 1-exp(-depth) the overestimate is at most e*total/width
+    '''
+
+    def __init__(self,width:int=1 << 14,depth:int=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0]*width for i in range(depth)]
+        self.seeds = [mix64(i + 1) for i in range(depth)]
+
+    def cells(self,item):
+        h = hash(item) & MASK64
+        return [mix64(h ^ seed) % self.width for seed in self.seeds]
+
+    def add(self,item,weight:int=1):
+        for row,cell in zip(self.rows,self.cells(item)):
+            row[cell] += weight
+
+    def estimate(self,item)->int:
+        return min(row[cell] for row,cell in zip(self.rows,self.cells(item)))
+
+class HeavyHitters:
+    '''
+    Most frequent items of a stream in bounded memory: space saving finds the candidates,
+    count-min tightens their counts. Exact mode keeps a plain dict, for small runs
+    '''
+
+    def __init__(self,exact:bool=False,counters:int=1024,width:int=1 << 14,depth:int=4):
+        self.exact = exact
+        self.total = 0
+        if exact:
+            self.counts: Dict[object,int] = dict()
+        else:
+            self.candidates = SpaceSaving(counters)
+            self.sketch = CountMinSketch(width,depth)
+
+    def add(self,item,weight:int=1):
+        self.total += weight
+        if self.exact:
+            self.counts[item] = self.counts.get(item,0) + weight
+        else:
+            self.candidates.add(item,weight)
+            self.sketch.add(item,weight)
+
+    def estimate(self,item)->int:
+        if self.exact:
+            return self.counts.get(item,0)
+        return self.sketch.estimate(item)
+
+    def top(self,k:int)->List[Tuple[object,int]]:
+        '''
+        (item, count) of the k most frequent items, counts are upper bounds unless exact
+        '''
+        if self.exact:
+            return sorted(self.counts.items(),key=lambda item: item[1],reverse=True)[:k]
+        #Rank the candidates by their tighter estimate
+        candidates = [(item,min(count,self.sketch.estimate(item))) for item,count,error in self.candidates.top(self.candidates.capacity)]
+        return sorted(candidates,key=lambda item: item[1],reverse=True)[:k]
@@ -0,0 +1,233 @@
+import sys
+import json
+import argparse
+from typing import Dict, List, Set
+from traces import read_trace
+
+#Host cache sizes in lines reported by default, the usual "Host num lines" sweep
+DEFAULT_SIZES = [1024, 4096, 16384, 65536]
+#A line that was never in the cache (or was invalidated) is at infinite distance
+COLD = float('inf')
+
+class StackDistance:
+    '''
+    LRU stack distances of one access stream (Mattson), in O(log n) per access
+    Every live key has a mark at the time of its last access in a Fenwick tree,
+    the stack distance of a key is the number of marks after its own
+    Time is renumbered when the tree is full, so the tree stays proportional to the number of live keys
+    '''
+
+    MIN_CAPACITY = 64
+
+    def __init__(self):
+        self.capacity = self.MIN_CAPACITY
+        self.tree = [0]*(self.capacity + 1)
+        self.last: Dict[int,int] = dict()
+        self.time = 0
+
+    def _update(self,pos:int,delta:int):
+        pos += 1
+        while pos <= self.capacity:
+            self.tree[pos] += delta
+            pos += pos & -pos
+
+    def _prefix(self,pos:int)->int:
+        '''
+        Marks at times 0..pos
+        '''
+        pos += 1
+        total = 0
+        while pos > 0:
+            total += self.tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _compact(self):
+        order = sorted(self.last.items(),key=lambda item: item[1])
+        self.capacity = max(self.MIN_CAPACITY,2*len(order))
+        self.tree = [0]*(self.capacity + 1)
+        self.last = dict()
+        for t,(key,_) in enumerate(order):
+            self.last[key] = t
+            self._update(t,1)
+        self.time = len(order)
+
+    def depth(self,key:int):
+        '''
+        Stack distance of key without touching it
+        '''
+        t = self.last.get(key)
+        if t == None:
+            return COLD
+        return len(self.last) - self._prefix(t)
+
+    def access(self,key:int):
+        '''
+        Stack distance of key, then move it to the top of the stack
+        '''
+        distance = self.depth(key)
+        if distance != COLD:
+            self._update(self.last[key],-1)
+        if self.time == self.capacity:
+            if distance != COLD:
+                del self.last[key]
+            self._compact()
+        self.last[key] = self.time
+        self._update(self.time,1)
+        self.time += 1
+        return distance
+
+class HostCacheModel:
+    '''
+    Stack distances of one host for one cache geometry, one stack per set
+    '''
+
+    def __init__(self,num_sets:int):
+        self.num_sets = num_sets
+        self.sets: Dict[int,StackDistance] = dict()
+
+    def stack(self,line:int)->StackDistance:
+        setid = line % self.num_sets
+        s = self.sets.get(setid)
+        if s == None:
+            s = StackDistance()
+            self.sets[setid] = s
+        return s
+
+class StackDistanceAnalysis:
+    '''
+    Host cache miss ratio for every capacity in one pass over a trace, including coherence invalidations
+    A write invalidates the line in every other host, so the next access there misses at any capacity
+    A miss is expected to be flow 11 (request for an invalid line) when no other host still holds the line,
+    which for LRU hosts of capacity C means every other holder has it at stack distance C or more
+    Invalidated lines keep their place in the stack, while a real cache would reuse the freed way,
+    so misses are slightly overestimated on write heavy sharing. Directory evictions are not modelled
+    '''
+
+    def __init__(self,line_size:int=64,assoc:int=16,sizes:List[int]=DEFAULT_SIZES):
+        self.offset_bits = line_size.bit_length() - 1
+        self.assoc = assoc
+        self.sizes = sizes
+        #Fully associative geometry plus one per size at the given associativity
+        self.geometries: List[int] = [1] + [max(size//assoc,1) for size in sizes]
+
+        self.requests = 0
+        self.host_requests: Dict[int,int] = dict()
+        self.hosts: Dict[int,List[HostCacheModel]] = dict()
+        #Hosts with a valid copy of each line
+        self.holders: Dict[int,Set[int]] = dict()
+        #Lines each host lost to another host's write
+        self.invalidated: Dict[int,Set[int]] = dict()
+
+        #Fully associative: log2 buckets of distance, bucket b holds distances with bit length b
+        self.own_hist: Dict[int,Dict[int,int]] = dict()
+        self.flow11_hist: Dict[int,int] = dict()
+        #Set associative: misses and flow 11 misses per host per size
+        self.misses: Dict[int,List[int]] = dict()
+        self.flow11: List[int] = [0]*len(sizes)
+
+    def models(self,hostid:int)->List[HostCacheModel]:
+        if hostid not in self.hosts:
+            self.hosts[hostid] = [HostCacheModel(num_sets) for num_sets in self.geometries]
+            self.host_requests[hostid] = 0
+            self.own_hist[hostid] = dict()
+            self.misses[hostid] = [0]*len(self.sizes)
+        return self.hosts[hostid]
+
+    def add(self,addr:int,op:str,hostid:int):
+        line = addr >> self.offset_bits
+        self.requests += 1
+        self.host_requests[hostid] = self.host_requests.get(hostid,0) + 1
+        models = self.models(hostid)
+        holders = self.holders.setdefault(line,set())
+        others = [self.hosts[g] for g in holders if g != hostid]
+
+        #A line another host invalidated is still in our stack, but it is a miss at any size
+        invalidated = hostid not in holders and line in self.invalidated.get(hostid,())
+        if invalidated:
+            self.invalidated[hostid].discard(line)
+        for idx,model in enumerate(models):
+            own = model.stack(line).access(line)
+            if invalidated:
+                own = COLD
+            #Closest copy in any other host, it survives in hosts larger than its depth
+            other = min((g[idx].stack(line).depth(line) for g in others),default=COLD)
+            if idx == 0:
+                bucket = own.bit_length() if own != COLD else -1
+                self.own_hist[hostid][bucket] = self.own_hist[hostid].get(bucket,0) + 1
+                closest = min(own,other)
+                bucket = closest.bit_length() if closest != COLD else -1
+                self.flow11_hist[bucket] = self.flow11_hist.get(bucket,0) + 1
+            else:
+                if own >= self.assoc:
+                    self.misses[hostid][idx-1] += 1
+                    if other >= self.assoc:
+                        self.flow11[idx-1] += 1
+
+        if op == 'W':
+            for g in holders:
+                if g != hostid:
+                    self.invalidated.setdefault(g,set()).add(line)
+            holders.clear()
+        holders.add(hostid)
+
+    def curve(self,hist:Dict[int,int],total:int,capacities:List[int])->List[float]:
+        '''
+        Fraction of accesses at distance capacity or more, for each power of two capacity
+        '''
+        curve = []
+        for capacity in capacities:
+            k = capacity.bit_length() - 1
+            #Distance d misses when d >= 2^k, i.e. its bit length is more than k
+            misses = sum(count for bucket,count in hist.items() if bucket == -1 or bucket > k)
+            curve.append(misses/total if total else 0)
+        return curve
+
+    def summary(self)->Dict:
+        max_bucket = max([b for hist in self.own_hist.values() for b in hist.keys()] + [1])
+        capacities = [1 << k for k in range(max_bucket + 1)]
+        overall_hist: Dict[int,int] = dict()
+        for hist in self.own_hist.values():
+            for bucket,count in hist.items():
+                overall_hist[bucket] = overall_hist.get(bucket,0) + count
+
+        return {
+            "Requests": self.requests,
+            "Assoc": self.assoc,
+            "Fully associative": {
+                "Capacities": capacities,
+                "Miss ratio": self.curve(overall_hist,self.requests,capacities),
+                "Flow 11 rate": self.curve(self.flow11_hist,self.requests,capacities),
+                "Per host miss ratio": {hostid:self.curve(self.own_hist[hostid],self.host_requests[hostid],capacities)
+                                        for hostid in sorted(self.own_hist.keys())}
+            },
+            "Set associative": {size:{
+                "Sets": self.geometries[idx+1],
+                "Miss ratio": sum(m[idx] for m in self.misses.values())/self.requests if self.requests else 0,
+                "Flow 11 rate": self.flow11[idx]/self.requests if self.requests else 0,
+                "Per host miss ratio": {hostid:self.misses[hostid][idx]/self.host_requests[hostid] for hostid in sorted(self.misses.keys())}
+            } for idx,size in enumerate(self.sizes)}
+        }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="One pass host cache miss ratio curves and expected flow 11 rate")
+    parser.add_argument("trace")
+    parser.add_argument("--output",default=None,help="Summary json, printed if not given")
+    parser.add_argument("--line-size",type=int,default=64)
+    parser.add_argument("--assoc",type=int,default=16)
+    parser.add_argument("--sizes",default=",".join(str(s) for s in DEFAULT_SIZES),help="Host num lines to report, comma separated")
+    args = parser.parse_args()
+
+    analysis = StackDistanceAnalysis(args.line_size,args.assoc,[int(s) for s in args.sizes.split(',')])
+    for addr,op,hostid in read_trace(args.trace):
+        analysis.add(addr,op,hostid)
+        if analysis.requests % 1000000 == 0:
+            print(analysis.requests,file=sys.stderr)
+
+    summary = analysis.summary()
+    if args.output != None:
+        with open(args.output,"w") as file:
+            json.dump(summary,file,indent=4)
+    else:
+        print(json.dumps(summary,indent=4))
@@ -1,15 +1,30 @@
 import sys
 import os
+import copy
+import time
+import resource
 import networkx as nx
-import matplotlib.pyplot as plt
 from cache.cachesim import DirectoryEntry, HostCache, SnoopFilter, BaseCache, debug_print, OpType, DirectoryState
 from cache import cachesim
 from typing import List, Dict, Set, Tuple
 import json
+from traces import read_trace, merge_host_traces, estimate_requests
+from telemetry import Telemetry
+from sketches import HeavyHitters
+from interleave import Interleave
 
 # cachesim.DEBUG = True
 cachesim.ADDR_WIDTH = 64
 
+#Flows of evictions, a request may cause several of them on top of its own flow
+EVICTION_FLOWS = [1, 2, 3, 4, 5]
+#Flows where the line is held by another host, these are what make a line contended
+CONTENDED_FLOWS = [6, 7, 8, 10]
+#Region entries are kept under the region number with this bit set, so they spread over sets like lines and never meet a real line address
+REGION_KEY_BIT = 1 << 63
+#Requests between samples of directory usage in region mode
+REGION_SAMPLE_EVERY = 10000
+
 class CXLNet:
 
     def __init__(self,num_hosts:int,num_devices:int,num_switches:int):
@@ -34,6 +49,11 @@ class CXLNet:
         
         self.intermediate = None
         self.intermediate_path = []
+        #Path from the intermediate switch to every device, filled on first use
+        self.intermediate_paths: Dict[int,List[int]] = dict()
+        
+        #All pairs hop counts, filled in by build_distance_table once the topology is final
+        self.dist: Dict[int,Dict[int,int]] = None
 
 
     def connect(self,nodeA:str,nodeB:str):
@@ -52,43 +72,44 @@ class CXLNet:
         self.G.add_edge(nodeA,nodeB)
 
     def draw(self):
-        positions = nx.nx_pydot.graphviz_layout(self.G)
-        # nx.draw(self.G,pos=positions,with_label)
-        
-        print(self.host_ids)
-        print(self.device_ids)
-        print(self.switch_ids)
+        #Plotting is only imported when a picture is requested
+        from visualization import draw_topology
+        draw_topology(self,'CXL_Topology.png',device_color='Yellow')
 
-        # print(list(self.G.nodes()))
-        # print(list(self.G.edges()))
-
-        node_colors = []
-        for nodeid in self.nodeids:
-            if nodeid in self.host_ids:
-                node_colors.append('Red')
-            elif nodeid in self.device_ids:
-                node_colors.append('Yellow')
-            elif nodeid in self.switch_ids:
-                node_colors.append('Green')
-
-        print(node_colors)
-        
-        nx.draw_networkx(self.G,pos=positions,nodelist=self.nodeids,node_color=node_colors,with_labels=True)
-        plt.savefig('CXL_Topology.png')
-        # nx.drawing.nx_pydot.graphviz_layout(self.G, "CXL_Topology.dot")
+    def build_distance_table(self):
+        '''
+        Precompute hop counts between every pair of nodes
+        Must be called again if the graph is modified afterwards
+        '''
+        self.dist = dict(nx.all_pairs_shortest_path_length(self.G))
+    
+    def view(self):
+        '''
+        Shallow copy of the network which shares the graph and distance table
+        Lets several engines with different intermediate switches use one topology
+        '''
+        return copy.copy(self)
+    
+    def distance(self,nodeA,nodeB):
+        '''
+        Hop count between two nodes, from the distance table if available
+        '''
+        if self.dist != None:
+            return self.dist[nodeA][nodeB]
+        return nx.shortest_path_length(self.G,source=nodeA,target=nodeB)
 
     def cost(self,nodeA,nodeB):
         '''
         Cost of traversing the path
         Right now I just count number of hops
         '''
-        path_length = nx.shortest_path_length(self.G,source=nodeA,target=nodeB)
+        path_length = self.distance(nodeA,nodeB)
         if path_length == 0:
             print(f"Nothing to traverse between {nodeA} and {nodeB}")
             exit(1)
         return path_length
 
-    def set_intermediate(self,nodeid:int,path:List[int]):
+    def set_intermediate(self,nodeid:int,path:List[int],device_paths:Dict[int,List[int]]=None):
         '''
         Set an intermediate node. Any message from host to device will have to travel through here
         The path from intermediate to device is already known and fixed
@@ -96,6 +117,20 @@ class CXLNet:
         assert nodeid in self.switch_ids, f"Unknown node {nodeid}"
         self.intermediate = nodeid
         self.intermediate_path = path
+        #The configured path is the one to the first device, the others default to a shortest path
+        self.intermediate_paths = {self.device_ids[0]:path}
+        if device_paths != None:
+            self.intermediate_paths.update(device_paths)
+
+    def device_path(self,device_id:int)->List[int]:
+        '''
+        Path from the intermediate switch to a device
+        '''
+        path = self.intermediate_paths.get(device_id)
+        if path == None:
+            path = nx.shortest_path(self.G,source=self.intermediate,target=device_id)
+            self.intermediate_paths[device_id] = path
+        return path
 
     def host2dir_path(self,host:int,dir:int):
         '''
@@ -110,7 +145,7 @@ class CXLNet:
         debug_print(f"Path: {nodes}")
         cost = 0
         for window in zip(nodes,nodes[1:]):
-            cost += nx.shortest_path_length(self.G,source=window[0],target=window[1])
+            cost += self.distance(window[0],window[1])
         debug_print(f"Path: {nodes}, Cost: {cost}")
         return cost            
             
@@ -118,13 +153,13 @@ class CXLNet:
         '''
         Given one node and a list of nodes, find the node closest
         '''
-        return min(dest, key=lambda node: nx.shortest_path_length(self.G, source, node))
+        return min(dest, key=lambda node: self.distance(source, node))
     
     def furthest_node(self,source:int,dest:List[int]):
         '''
         Given one node and a list of nodes, find the node furthest away
         '''
-        return max(dest, key=lambda node: nx.shortest_path_length(self.G, source, node))
+        return max(dest, key=lambda node: self.distance(source, node))
         
 class DirectoryEntryExtended(DirectoryEntry):
 
@@ -135,6 +170,31 @@ class DirectoryEntryExtended(DirectoryEntry):
     def __str__(self):
         return f"{self.state},{self.sharers},{self.owner} on {self.dir_location}"
 
+class ReplicaEntry:
+    '''
+    Read-only copy of a shared directory entry on a switch, it takes a way but the primary entry keeps the sharer list
+    '''
+
+    def __str__(self):
+        return "Replica"
+
+class RegionEntry(DirectoryEntry):
+    '''
+    One directory entry for an aligned region of lines, sharers and owner summarize every cached line of the region
+    '''
+
+    def __init__(self,base:int):
+        super().__init__()
+        self.base = base
+        #Lines of the region cached by each host, and how many hosts cache each line
+        self.lines: Dict[int,int] = dict()
+        self.present: Dict[int,int] = dict()
+        #Writes that invalidated lines other than the one written
+        self.false_sharing = 0
+
+    def __str__(self):
+        return f"{self.state},{self.sharers},{self.owner} for region {hex(self.base)}"
+
 class CXLHost(HostCache):
     
     def allocate(self,addr):
@@ -199,6 +259,8 @@ class CXLDevice(SnoopFilter):
         '''        
         self.switches = switches
         self.num_switches = len(switches)
+        #Switches may also hold replicas of shared entries, see CoherenceEngine.set_replication
+        self.replicated = False
     
     def allocate(self,addr,data):
         '''
@@ -270,6 +332,8 @@ class CXLDevice(SnoopFilter):
         
         for switchid,switch in self.switches.items():
             if switch.search_set(tag,setid):
+                if self.replicated and isinstance(switch.get_line(addr),ReplicaEntry):
+                    continue
                 return switchid
 
         return None
@@ -302,12 +366,25 @@ class CoherenceEngine:
     
     def __init__(self, hosts: List[CXLHost], device: CXLDevice, switches: Dict[int,CXLSwitch]):
         self.hosts = hosts
+        #First device, all of them are in devices and every line has its home device, see set_devices
         self.device = device
+        self.devices: Dict[int,CXLDevice] = {device.id:device}
+        self.interleave = Interleave([device])
         self.switches = switches
         
         self.net: CXLNet = None
         
         self.reqid = 0
+        
+        #Optional periodic status file
+        self.telemetry: Telemetry = None
+        
+        #Flow type of the last path recorded, evictions a request causes may come after its own flow
+        self.last_flow: int = None
+        #Flow of the request itself, never an eviction flow
+        self.request_flow: int = None
+        #Path of a request served by the line's directory entry with the slots the entry sits in, before removing the intermediate
+        self.request_template: Tuple[List[int],List[int]] = None
     
         #Different communication flows for which we can track hops
         self.communication_flows = {
@@ -333,8 +410,10 @@ class CoherenceEngine:
                                  } 
                              for key in self.communication_flows.keys()}
         
-        #Data about which host or host pairs are doing most of the communication
-        self.communicating_hosts: Dict[Set[int],int] = dict()
+        #Data about which host or host pairs are doing most of the communication, and which lines cause it
+        #Both are sketches by default, see set_heavy_hitters
+        self.communicating_hosts = HeavyHitters()
+        self.contended_lines = HeavyHitters()
         
         #Data about migration
         self.migration_stats: Dict[str,int] = {
@@ -342,6 +421,80 @@ class CoherenceEngine:
             "Migration cost": 0,
             "One copy diff host": 0
         }
+        
+        #Load and flows of every device
+        self.device_stats: Dict[int,Dict] = dict()
+        self.reset_device_stats()
+        
+        #Switches holding replicas of each shared line, off unless set_replication is called
+        self.replication = False
+        self.replicas: Dict[int,List[int]] = dict()
+        self.replication_stats: Dict[str,int] = {
+            "Replicas created": 0,
+            "Replica reads": 0,
+            "Read hops saved": 0,
+            "Update hops": 0,
+            "Replica invalidations": 0,
+            "Invalidation hops": 0,
+            "Replica evictions": 0,
+            "Replicas skipped": 0
+        }
+        
+        #One entry per aligned region instead of per line, off unless set_region_tracking is called
+        self.region_size: int = None
+        #Regions whose lines diverged and are tracked line by line again, with the number of line entries left
+        self.split_regions: Dict[int,int] = dict()
+        self.region_stats: Dict[str,int] = {
+            "Splits": 0,
+            "Split line entries": 0,
+            "Regions rejoined": 0,
+            "False sharing events": 0,
+            "False sharing invalidations": 0,
+            "Region eviction lines": 0,
+            "Silent evictions": 0
+        }
+        #Sums of directory entries in use and lines they track, over the samples
+        self.directory_usage: Dict[str,int] = {"Samples":0,"Entries":0,"Lines":0}
+        
+        #Migrate the entries of neighbouring lines with the same holders together, off unless set_bulk_migration is called
+        self.bulk_size: int = None
+        #Lines moved along with a neighbour, from and to where, until their own next migration decision
+        self.bulk_moved: Dict[int,Tuple[int,int]] = dict()
+        #At that decision, from where the line was the policy would have moved it there (saved), left it (not needed)
+        #or moved it somewhere else. Early benefit is the hops requests before it gained over the line's old location
+        self.bulk_stats: Dict[str,int] = {
+            "Bulk decisions": 0,
+            "Entries moved together": 0,
+            "Skipped full": 0,
+            "Migrations saved": 0,
+            "Not needed": 0,
+            "Wanted elsewhere": 0,
+            "Requests before own decision": 0,
+            "Early benefit": 0
+        }
+    
+    def set_devices(self,devices:List[CXLDevice],interleave:Interleave):
+        '''
+        Spread lines over several devices, each with its own snoop filter
+        '''
+        self.device = devices[0]
+        self.devices = {device.id:device for device in devices}
+        self.interleave = interleave
+        self.reset_device_stats()
+    
+    def reset_device_stats(self):
+        self.device_stats = {deviceid:{
+                                "Requests":0,
+                                "Migration count":0,
+                                "Flows":{key:{"Count":0,"Benefit":0} for key in self.communication_flows.keys()}
+                             }
+                             for deviceid in self.devices.keys()}
+    
+    def home(self,addr:int)->CXLDevice:
+        '''
+        Device that holds the line and its directory entry when it is not on a switch
+        '''
+        return self.interleave.home(addr)
     
     def set_placement_policy(self,policy:str):
         self.placement_policy_name = policy
@@ -349,13 +502,60 @@ class CoherenceEngine:
     def set_migration_policy(self,policy:str):
         self.migration_policy_name = policy
     
+    def set_replication(self,max_replicas:int,min_sharers:int):
+        '''
+        Replicate shared entries on switches next to clusters of at least min_sharers sharers, up to max_replicas per line
+        '''
+        if self.migration_policy_name not in ['adaptive','sssp']:
+            print(f"Replicating shared entries needs adaptive or sssp migration, not {self.migration_policy_name}")
+            exit(2)
+        self.replication = True
+        self.max_replicas = max_replicas
+        self.replica_min_sharers = min_sharers
+        for device in self.devices.values():
+            device.replicated = True
+    
+    def set_region_tracking(self,region_size:int,line_size:int,split_threshold:int):
+        '''
+        Track aligned regions of region_size bytes with one entry, a region goes back to line entries once writes
+        to it have invalidated lines other than the one written split_threshold times
+        '''
+        if region_size & (region_size - 1) != 0 or not 256 <= region_size <= 4096 or region_size <= line_size:
+            print(f"Region size {region_size} should be a power of two between 256 and 4096 bytes, larger than a line")
+            exit(2)
+        self.region_size = region_size
+        self.line_size = line_size
+        self.region_shift = region_size.bit_length() - 1
+        self.line_shift = line_size.bit_length() - 1
+        self.split_threshold = split_threshold
+    
+    def set_bulk_migration(self,block_size:int,line_size:int):
+        '''
+        Every migration also moves the entries of the other lines of its block_size block that are in the same place with the same holders
+        '''
+        if block_size & (block_size - 1) != 0 or block_size <= line_size:
+            print(f"Bulk migration size {block_size} should be a power of two larger than a line")
+            exit(2)
+        self.bulk_size = block_size
+        self.bulk_line_size = line_size
+        self.bulk_shift = block_size.bit_length() - 1
+        self.bulk_line_shift = line_size.bit_length() - 1
+    
+    def set_heavy_hitters(self,exact:bool,counters:int,width:int,depth:int):
+        '''
+        Exact counts keep every host group and line, sketches keep counters candidates and a width*depth count-min
+        '''
+        self.communicating_hosts = HeavyHitters(exact,counters,width,depth)
+        self.contended_lines = HeavyHitters(exact,counters,width,depth)
+    
     def describe(self):
         '''
         Print out a system description with node ids
         '''
         for host in self.hosts:
             print(f"{host.id}: Host")
-        print(f"{self.device.id}: Device")
+        for device in self.devices.values():
+            print(f"{device.id}: Device")
         for switch in self.switches.values():
             print(f"{switch.id}: Switch")
         
@@ -365,7 +565,7 @@ class CoherenceEngine:
         '''
         self.net=net
 
-    def static_path_benefit(self,in_network_path:List[int],base_path:List[int],path_type:int):
+    def static_path_benefit(self,in_network_path:List[int],base_path:List[int],path_type:int,device_id:int):
         '''
         Record or assess the benefits from static allocation
         '''
@@ -383,15 +583,21 @@ class CoherenceEngine:
         
         #Record this path flow
         self.flow_records[path_type]["Benefit"] += base_cost - in_network_cost
+        self.last_flow = path_type
+        if path_type not in EVICTION_FLOWS:
+            self.request_flow = path_type
+        stats = self.device_stats[device_id]["Flows"][path_type]
+        stats["Count"] += 1
+        stats["Benefit"] += base_cost - in_network_cost
         
         #Find the set of hosts involved in this transaction
-        involved_hosts = tuple(set(base_path).intersection(self.net.host_ids))
-        if involved_hosts not in self.communicating_hosts.keys():
-            self.communicating_hosts[involved_hosts] = 1
-        else:
-            self.communicating_hosts[involved_hosts] += 1
+        involved_hosts = tuple(sorted(set(base_path).intersection(self.net.host_ids)))
+        self.communicating_hosts.add(involved_hosts)
 
-    def remove_intermediate(self,addr:int, path: List[int]):
+    def remove_intermediate(self,addr:int, path: List[int], dir_slots: List[int]=None):
+        device = self.home(addr)
+        if dir_slots != None:
+            self.request_template = (path,dir_slots)
         #If the migration policy is fully adaptive, we dont have to worry about any intermediate switch
         #So all paths between host and device will be the shortest paths and will not be host -> i -> device
         #To implement this, we can take a path that involved the intermediate, and then translate it as follows
@@ -402,50 +608,159 @@ class CoherenceEngine:
         
         if self.migration_policy_name != 'adaptive':
             return path
-        elif self.device.find_directory_location(addr) == None:
+        elif device.find_directory_location(addr) == None:
             return path
-        elif self.device.find_directory_location(addr) == self.net.intermediate:
+        elif device.find_directory_location(addr) == self.net.intermediate:
             return path
         else:
             new_path = [node for node in path if node != self.net.intermediate]
             debug_print(f"Removing intermediate from path {path} -> {new_path}")
             return new_path
+    
+    def place_directory(self,template:List[int],dir_slots:List[int],dir_id:int)->List[int]:
+        '''
+        The path of a request template with its directory entry on dir_id, as remove_intermediate would give it
+        '''
+        path = [dir_id if k in dir_slots else node for k,node in enumerate(template)]
+        if self.migration_policy_name == 'adaptive' and dir_id != self.net.intermediate:
+            path = [node for node in path if node != self.net.intermediate]
+        return path
 
+    def replica_read(self,addr:int,requestor:int,closest_sharer:int,dir_id:int)->List[int]:
+        '''
+        Path of a new sharer served by the cheapest replica, None when going to the primary entry costs no more
+        The replica tells the primary about the new sharer off the critical path
+        '''
+        replicas = self.replicas.get(addr)
+        if not replicas:
+            return None
+        i = self.net.intermediate
+        primary_cost = self.net.path_cost(self.remove_intermediate(addr,[requestor,i,dir_id,closest_sharer,i,dir_id,requestor]))
+        best_path, best_cost, replica = None, primary_cost, None
+        for switchid in replicas:
+            path = [requestor,i,switchid,closest_sharer,i,switchid,requestor]
+            if self.migration_policy_name == 'adaptive' and switchid != i:
+                path = [node for node in path if node != i]
+            cost = self.net.path_cost(path)
+            if cost < best_cost:
+                best_path, best_cost, replica = path, cost, switchid
+        if best_path == None:
+            return None
+        self.replication_stats["Replica reads"] += 1
+        self.replication_stats["Read hops saved"] += primary_cost - best_cost
+        self.replication_stats["Update hops"] += self.net.distance(replica,dir_id)
+        return best_path
+    
+    def replica_distance(self,hostid:int,location:int)->int:
+        '''
+        Hops from a host to a directory location, through the intermediate switch unless migration is adaptive
+        '''
+        if self.migration_policy_name == 'adaptive':
+            return self.net.distance(hostid,location)
+        return self.net.distance(hostid,self.net.intermediate) + self.net.distance(self.net.intermediate,location)
+    
+    def place_replica(self,addr:int,dentry:DirectoryEntry,dir_id:int,requestor:int):
+        '''
+        Replicate a shared entry on the switch next to the requestor, if enough sharers are closer to it than to any copy
+        Replicas take free ways or those of other replicas, never those of primary entries
+        '''
+        replicas = self.replicas.get(addr,[])
+        if not self.replication or len(replicas) >= self.max_replicas:
+            return
+        if self.migration_policy_name == 'adaptive':
+            candidates = self.net.switch_ids
+        else:
+            candidates = [node for node in self.net.device_path(self.home(addr).id) if node in self.switches]
+        candidate = min(candidates,key=lambda node: self.replica_distance(requestor,node))
+        locations = [dir_id] + replicas
+        if candidate in locations:
+            return
+        cluster = [hostid for hostid in dentry.sharers if self.replica_distance(hostid,candidate) < min(self.replica_distance(hostid,loc) for loc in locations)]
+        if len(cluster) < self.replica_min_sharers:
+            return
+        switch = self.switches[candidate]
+        replacement_addr = switch.allocate(addr,ReplicaEntry())
+        if replacement_addr != None:
+            if not isinstance(switch.get_line(replacement_addr),ReplicaEntry):
+                self.replication_stats["Replicas skipped"] += 1
+                return
+            self.drop_replica(replacement_addr,candidate)
+            self.replication_stats["Replica evictions"] += 1
+            temp = switch.allocate(addr,ReplicaEntry())
+            assert temp == None, f"Replica allocation on {candidate} failed"
+        self.replicas.setdefault(addr,[]).append(candidate)
+        self.replication_stats["Replicas created"] += 1
+        debug_print(f"Replicated {hex(addr)} on {candidate}, copies {self.replicas[addr]}")
+    
+    def drop_replica(self,addr:int,switchid:int):
+        self.switches[switchid].evict(addr)
+        self.replicas[addr].remove(switchid)
+        if not self.replicas[addr]:
+            del self.replicas[addr]
+    
+    def invalidate_replicas(self,addr:int,dir_id:int,path:List[int]=None)->List[int]:
+        '''
+        Drop every replica of a line that is written or deleted
+        A write also waits for the furthest replica, which is added to its path right after the directory
+        '''
+        replicas = self.replicas.pop(addr,None)
+        if not replicas:
+            return path
+        for switchid in replicas:
+            self.switches[switchid].evict(addr)
+            self.replication_stats["Invalidation hops"] += 2*self.net.distance(dir_id,switchid)
+        self.replication_stats["Replica invalidations"] += len(replicas)
+        if path == None:
+            return None
+        k = path.index(dir_id)
+        return path[:k+1] + [self.net.furthest_node(dir_id,replicas),dir_id] + path[k+1:]
+    
+    def replication_report(self)->Dict:
+        report = {**self.replication_stats,"Live replicas":sum(len(r) for r in self.replicas.values())}
+        print(f"Replication: {report}")
+        return report
+    
     def handle_host_eviction(self,addr:int,dentry:DirectoryEntry,evicting_host:int):
         '''
         When a host chooses to evict an entry, need to update device about it
         '''
         if addr == None:
             return
+        if self.region_size != None and (addr >> self.region_shift) not in self.split_regions:
+            self.region_host_eviction(addr,evicting_host)
+            return
+        device = self.home(addr)
         
         debug_print(f"Replacing {hex(addr)} from {evicting_host}")
         debug_print(f"Current state {hex(addr)}:{dentry}")
         
         i = self.net.intermediate
         
-        dir_node_id = self.device.find_directory_location(addr)
+        dir_node_id = device.find_directory_location(addr)
         assert dir_node_id != None, f"Couldnt find directory entry of {hex(addr)} to modify after evicting from host {evicting_host}"
-        assert dir_node_id == self.device.id or dir_node_id in self.net.switch_ids, f"{dir_node_id} not device or switch"
-        dir_holder = self.device.resolve_object(dir_node_id)
+        assert dir_node_id == device.id or dir_node_id in self.net.switch_ids, f"{dir_node_id} not device or switch"
+        dir_holder = device.resolve_object(dir_node_id)
         tag,setid,blk = dir_holder.split_addr(addr)
         #Remove from owner
         if dentry.state == DirectoryState.A:
             #Calculate path
             #owner -> device -> owner
-            path = self.remove_intermediate(addr,[dentry.owner,i,self.device.id,i,dentry.owner])
-            base_path = [dentry.owner,self.device.id,dentry.owner]
-            self.static_path_benefit(path,base_path,1)
+            path = self.remove_intermediate(addr,[dentry.owner,i,device.id,i,dentry.owner])
+            base_path = [dentry.owner,device.id,dentry.owner]
+            self.static_path_benefit(path,base_path,1,device.id)
             debug_print("Path Type 1")
             self.hosts[dentry.owner].evict(addr)
             #Since there is no host with valid copy left, remove directory entry
             dir_holder.evict(addr)
+            self.count_line_entry(addr,-1)
+            self.bulk_moved.pop(addr,None)
         elif dentry.state == DirectoryState.S:
             if len(dentry.sharers) == 1:
                 lone_sharer = True
             else:
                 lone_sharer = False
             #Calculate path
-            furthest_sharer = self.net.furthest_node(self.device.id,dentry.sharers)
+            furthest_sharer = self.net.furthest_node(device.id,dentry.sharers)
             #Remove from sharer list
             dir_holder.remove_sharer(addr,evicting_host)
             #Remove from host
@@ -453,17 +768,20 @@ class CoherenceEngine:
             #If it was a lone sharer, evict entry from directory
             if lone_sharer:
                 dir_holder.evict(addr)
+                self.count_line_entry(addr,-1)
+                self.bulk_moved.pop(addr,None)
+                self.invalidate_replicas(addr,dir_node_id)
                 #Path
                 #Evicting host -> device -> Evicting host
-                path = self.remove_intermediate(addr,[evicting_host,i,self.device.id,i,evicting_host])
-                base_path = [evicting_host,self.device.id,evicting_host]
-                self.static_path_benefit(path,base_path,2)
+                path = self.remove_intermediate(addr,[evicting_host,i,device.id,i,evicting_host])
+                base_path = [evicting_host,device.id,evicting_host]
+                self.static_path_benefit(path,base_path,2,device.id)
                 debug_print("Path Type 2")
             else:
                 #Evicting host -> dir location -> evicting host
                 path = self.remove_intermediate(addr,[evicting_host,i,dir_node_id,i,evicting_host])
                 base_path = [evicting_host,dir_node_id,evicting_host]
-                self.static_path_benefit(path,base_path,3)
+                self.static_path_benefit(path,base_path,3,device.id)
                 debug_print("Path Type 3")
                 
             
@@ -474,18 +792,28 @@ class CoherenceEngine:
         
         if addr == None:
             return
+        device = self.home(addr)
         
         debug_print(f"Replacing {hex(addr)} from {location}")
         debug_print(f"Current state {hex(addr)}:{dentry}")
         
+        #A replica goes without touching the hosts, its primary entry still tracks them
+        if isinstance(dentry,ReplicaEntry):
+            self.drop_replica(addr,location)
+            self.replication_stats["Replica evictions"] += 1
+            return
+        if isinstance(dentry,RegionEntry):
+            self.region_directory_eviction(addr,dentry,location)
+            return
+        
         i = self.net.intermediate
         
         if dentry.state == DirectoryState.A:
             #Calculate path
             #dir location -> owner -> device
-            path = self.remove_intermediate(addr,[location,i,dentry.owner,i,self.device.id])
-            base_path = [self.device.id,dentry.owner,self.device.id]
-            self.static_path_benefit(path,base_path,4)
+            path = self.remove_intermediate(addr,[location,i,dentry.owner,i,device.id])
+            base_path = [device.id,dentry.owner,device.id]
+            self.static_path_benefit(path,base_path,4,device.id)
             debug_print("Path Type 4")
             #Evict from owner
             self.hosts[dentry.owner].evict(addr)
@@ -493,51 +821,53 @@ class CoherenceEngine:
             #Calculate path
             #dir location -> furthest sharer -> device
             furthest_sharer = self.net.furthest_node(location,dentry.sharers)
-            path = self.remove_intermediate(addr,[location,i,furthest_sharer,i,self.device.id])
-            base_path = [self.device.id,furthest_sharer,self.device.id]
-            self.static_path_benefit(path,base_path,5)
+            path = self.remove_intermediate(addr,[location,i,furthest_sharer,i,device.id])
+            base_path = [device.id,furthest_sharer,device.id]
+            self.static_path_benefit(path,base_path,5,device.id)
             debug_print("Path Type 5")
             #Evict from all sharers
             for hostid in dentry.sharers:
                 self.hosts[hostid].evict(addr)
+            self.invalidate_replicas(addr,location)
                 
         #Remove line from directory
-        if location == self.device.id:
-            self.device.evict(addr)
+        if location == device.id:
+            device.evict(addr)
         else:
             self.switches[location].evict(addr)
+        self.count_line_entry(addr,-1)
+        self.bulk_moved.pop(addr,None)
         
     def placement_policy(self,addr:int,optype:OpType,requestor:int,intermediate_path:List[int],reqid:int):
         '''
         Function implements the placement policy. It returns the node id where we need to allocate the entry for a new line that was previously in the invalid state
         '''
+        device = self.home(addr)
         
         #Choose between multiple placement policies
         if self.placement_policy_name == "modulo":
         #Randomly place on device or switches
         #Choose based on modulus
-            possible_dir_locations = intermediate_path + [self.device.id]
+            possible_dir_locations = intermediate_path + [device.id]
             return possible_dir_locations[reqid % len(possible_dir_locations)]
         elif self.placement_policy_name == "default":
         #Choose only the device as possible directory location    
-            return self.device.id    
+            return device.id    
         else:
             print("Unknown placement policy")
             exit(2)
     
-    def migration_policy(self,addr:int,requestor:int):
+    def migration_target(self,addr:int,requestor:int,dentry:DirectoryEntry,dir_loc:int)->int:
         '''
-        This function is called every transaction and performs migration of directory entry
+        Where the migration policy moves an entry that is at dir_loc, None to leave it there
         '''
+        device = self.home(addr)
         if self.migration_policy_name == "lazy":
-            #Get the directory entry
-            dentry:DirectoryEntry = self.device.find_directory_entry(addr)
-            dir_loc:int = self.device.find_directory_location(addr)
             #Migrate only if
             #1.Directory entry is currently on the device
             #2.There is only one current sharer
             #3.The sharer is different from the requestor
-            if self.device.find_directory_location(addr) == self.device.id and \
+            if dir_loc == device.id and \
                (len(dentry.sharers) == 1 or dentry.owner != None) and \
                (requestor not in dentry.sharers or requestor != dentry.owner):
                 
@@ -548,117 +878,130 @@ class CoherenceEngine:
                 i = self.net.intermediate
                 current_holder = dentry.owner if dentry.state == DirectoryState.A else dentry.sharers[0]
                 costs:Dict[int,int] = dict()
-                for switchid in self.net.intermediate_path:
+                for switchid in self.net.device_path(device.id):
                     cost = self.net.path_cost([requestor,i,switchid,current_holder,i,switchid,requestor])
                     costs[switchid] = cost
                 #Find the switch that requires the minimum cost
-                selected_switch: CXLSwitch = min(costs,key=costs.get)
-                debug_print(f"Lazy migrating {hex(addr)} from {dir_loc} to {selected_switch}")
-                #Now allocate entry on this switch
-                replacement_addr = self.switches[selected_switch].allocate(addr,dentry)
-                #Handle the replacement                    
-                if replacement_addr != None:
-                    self.handle_directory_eviction(replacement_addr,self.switches[selected_switch].get_line(replacement_addr),selected_switch)
-                    #Now reattempt to allocate line
-                    temp = self.switches[selected_switch].allocate(addr,dentry)
-                    assert temp == None, f"Directory allocation on {selected_switch.id} failed"
-                #Remove original entry on device
-                self.device.evict(addr)
-                #Migration count
-                self.migration_stats["Migration count"] += 1
-                return selected_switch
-            else:
-                return None 
-        elif self.migration_policy_name == 'sssp':
-            #This policy assumes we can migrate for every single transaction
+                return min(costs,key=costs.get)
+            return None
+        elif self.migration_policy_name in ['sssp','adaptive']:
+            #These policies assume we can migrate for every single transaction
             #We dont need to have a single owner/sharer. If there are multiple sharers, we will migrate it then itself
-            #We dont count the number of migration hops either
-            #Just do the migration and assume our entries are now in a new location
-            #Get the directory entry
-            dentry:DirectoryEntry = self.device.find_directory_entry(addr)
-            dir_loc:int = self.device.find_directory_location(addr)
-            
-            #Need to find a switch to put the directory on
-            #Aliasing
-            i = self.net.intermediate
-            #We need a switch that on avg represents the closest path from switch to sharers
-            #avg_hops(switchid) = average(path:switchid->sharers)
-            
-            switch_sssp: Dict[int,int] = dict()
-            hosts_with_copies: List[int] = [requestor] + (dentry.sharers if dentry.state == DirectoryState.S else [dentry.owner])
-            for switchid in self.net.intermediate_path:
-                dist = 0
-                for hostid in hosts_with_copies:
-                    dist += self.net.path_cost([hostid,switchid])
-                switch_sssp[switchid] = dist/len(hosts_with_copies)
-            #Find the switch with the least avg sssp
-            new_location_id = min(switch_sssp,key=switch_sssp.get)
-            new_location = self.device.resolve_object(new_location_id)
-            #If new location is same as previous location return None
-            if new_location_id == dir_loc:
-                return None
-            print(f"SSSP migrating entry for {hex(addr)} from {dir_loc} to {new_location_id}")
-            #Now allocate entry on this switch
-            replacement_addr = new_location.allocate(addr,dentry)
-            #Handle the replacement                    
-            if replacement_addr != None:
-                self.handle_directory_eviction(replacement_addr,new_location.get_line(replacement_addr),new_location_id)
-                #Now reattempt to allocate line
-                temp = new_location.allocate(addr,dentry)
-                assert temp == None, f"Directory allocation on {new_location_id} failed"
-            #Remove original entry on device
-            self.device.resolve_object(dir_loc).evict(addr)
-            #Migration count
-            self.migration_stats["Migration count"] += 1
-            return new_location_id
-        elif self.migration_policy_name == 'adaptive':
-            #This policy assumes we can migrate for every single transaction
-            #Same as SSSP but we dont have any intermediate node, this is an implication for the routing policy
-            dentry:DirectoryEntry = self.device.find_directory_entry(addr)
-            dir_loc:int = self.device.find_directory_location(addr)
-            
-            #Need to find a switch to put the directory on
-            #Aliasing
-            i = self.net.intermediate
+            #sssp stays on the path through the intermediate switch, adaptive has no intermediate node and may use any switch
             #We need a switch that on avg represents the closest path from switch to sharers
             #avg_hops(switchid) = average(path:switchid->sharers)
-            
+            candidates = self.net.device_path(device.id) if self.migration_policy_name == 'sssp' else self.net.switch_ids
             switch_sssp: Dict[int,int] = dict()
             hosts_with_copies: List[int] = [requestor] + (dentry.sharers if dentry.state == DirectoryState.S else [dentry.owner])
-            for switchid in self.net.switch_ids:
+            for switchid in candidates:
                 dist = 0
                 for hostid in hosts_with_copies:
                     dist += self.net.path_cost([hostid,switchid])
                 switch_sssp[switchid] = dist/len(hosts_with_copies)
             #Find the switch with the least avg sssp
             new_location_id = min(switch_sssp,key=switch_sssp.get)
-            new_location = self.device.resolve_object(new_location_id)
-            #If new location is same as previous location return None
-            if new_location_id == dir_loc:
-                return None
-            print(f"Adaptive migrating entry for {hex(addr)} from {dir_loc} to {new_location_id}")
-            #Now allocate entry on this switch
-            replacement_addr = new_location.allocate(addr,dentry)
-            #Handle the replacement                    
-            if replacement_addr != None:
-                self.handle_directory_eviction(replacement_addr,new_location.get_line(replacement_addr),new_location_id)
-                #Now reattempt to allocate line
-                temp = new_location.allocate(addr,dentry)
-                assert temp == None, f"Directory allocation on {new_location_id} failed"
-            #Remove original entry on device
-            self.device.resolve_object(dir_loc).evict(addr)
-            #Migration count
-            self.migration_stats["Migration count"] += 1
-            return new_location_id
-        else:
+            #If new location is same as previous location there is nothing to do
+            return new_location_id if new_location_id != dir_loc else None
+        return None
+    
+    def migration_policy(self,addr:int,requestor:int):
+        '''
+        This function is called every transaction and performs migration of directory entry
+        '''
+        device = self.home(addr)
+        #Get the directory entry
+        dentry:DirectoryEntry = device.find_directory_entry(addr)
+        dir_loc:int = device.find_directory_location(addr)
+        if addr in self.bulk_moved:
+            #First decision for a line moved along with a neighbour, judged by what the policy would do from where it was
+            source_id, target_id = self.bulk_moved.pop(addr)
+            wanted = self.migration_target(addr,requestor,dentry,source_id)
+            if wanted == None:
+                self.bulk_stats["Not needed"] += 1
+            elif wanted == target_id:
+                self.bulk_stats["Migrations saved"] += 1
+            else:
+                self.bulk_stats["Wanted elsewhere"] += 1
+        new_location_id = self.migration_target(addr,requestor,dentry,dir_loc)
+        if new_location_id == None:
             return None
+        if self.migration_policy_name == "lazy":
+            debug_print(f"Lazy migrating {hex(addr)} from {dir_loc} to {new_location_id}")
+        else:
+            print(f"{'SSSP' if self.migration_policy_name == 'sssp' else 'Adaptive'} migrating entry for {hex(addr)} from {dir_loc} to {new_location_id}")
+        new_location = device.resolve_object(new_location_id)
+        #The primary entry takes the way of its own replica
+        if new_location_id in self.replicas.get(addr,[]):
+            self.drop_replica(addr,new_location_id)
+        #Now allocate entry on this switch
+        replacement_addr = new_location.allocate(addr,dentry)
+        #Handle the replacement                    
+        if replacement_addr != None:
+            self.handle_directory_eviction(replacement_addr,new_location.get_line(replacement_addr),new_location_id)
+            #Now reattempt to allocate line
+            temp = new_location.allocate(addr,dentry)
+            assert temp == None, f"Directory allocation on {new_location_id} failed"
+        #Remove original entry
+        device.resolve_object(dir_loc).evict(addr)
+        #Migration count
+        self.migration_stats["Migration count"] += 1
+        self.device_stats[device.id]["Migration count"] += 1
+        self.bulk_migrate(addr,dentry,dir_loc,new_location_id)
+        return new_location_id
                 
+    def bulk_migrate(self,addr:int,dentry:DirectoryEntry,source_id:int,target_id:int):
+        '''
+        Move the entries of the other lines of the block of addr that were with it and have the same holders
+        Only free ways of the target are used, so moving them never evicts anything
+        '''
+        if self.bulk_size == None or addr & REGION_KEY_BIT:
+            return
+        device = self.home(addr)
+        source = device.resolve_object(source_id)
+        target = device.resolve_object(target_id)
+        holders = sorted(dentry.sharers) if dentry.state == DirectoryState.S else [dentry.owner]
+        block = addr >> self.bulk_shift << self.bulk_shift
+        moved = 0
+        for line in range(block,block + self.bulk_size,self.bulk_line_size):
+            if line >> self.bulk_line_shift == addr >> self.bulk_line_shift or not source.check_hit(line):
+                continue
+            #A line homed on another device cannot go to this one
+            if target_id not in self.switches and self.home(line).id != target_id:
+                continue
+            nentry = source.get_line(line)
+            if isinstance(nentry,(ReplicaEntry,RegionEntry)) or nentry.state != dentry.state:
+                continue
+            if (sorted(nentry.sharers) if nentry.state == DirectoryState.S else [nentry.owner]) != holders:
+                continue
+            if target_id in self.replicas.get(line,[]):
+                self.drop_replica(line,target_id)
+            #A full set hands back a victim and allocates nothing
+            if target.allocate(line,nentry) != None:
+                self.bulk_stats["Skipped full"] += 1
+                continue
+            source.evict(line)
+            self.bulk_moved[line] = (source_id,target_id)
+            moved += 1
+        if moved > 0:
+            debug_print(f"Moved {moved} entries of the block of {hex(addr)} along to {target_id}")
+            self.bulk_stats["Bulk decisions"] += 1
+            self.bulk_stats["Entries moved together"] += moved
+    
+    def bulk_report(self)->Dict:
+        report = {"Block size":self.bulk_size,**self.bulk_stats,"Pending":len(self.bulk_moved)}
+        print(f"Bulk migration: {report}")
+        return report
+    
     def verify_line(self,addr):
         '''
         Invariants for a single line
         '''
+        if addr & REGION_KEY_BIT:
+            self.verify_region(addr)
+            return
+        device = self.home(addr)
         # Fetch the line
-        dentry: DirectoryEntry = self.device.find_directory_entry(addr)
+        dentry: DirectoryEntry = device.find_directory_entry(addr)
         # Invariants
         assert dentry != None, f"Line for {hex(addr)} does not exist"
         assert dentry.owner == None or len(dentry.sharers) == 0, f"{dentry} invalid state"
@@ -680,35 +1023,42 @@ class CoherenceEngine:
                     assert not host.check_hit(addr), f"Line {hex(addr)} found in {host.id} which is not a sharer {dentry.sharers}"
         #Make sure directory entry is in only one location
         num_dirs = 0
-        if self.device.check_hit(addr):
+        if device.check_hit(addr):
             num_dirs += 1
         for switchid,switch in self.switches.items():
-            if switch.check_hit(addr):
+            if switch.check_hit(addr) and not isinstance(switch.get_line(addr),ReplicaEntry):
                 num_dirs += 1
         assert num_dirs == 1, f"Line for {addr} found in {num_dirs} location instead of one"
+        for switchid in self.replicas.get(addr,[]):
+            assert dentry.state == DirectoryState.S, f"Replica of {hex(addr)} on {switchid} in state {dentry.state}"
+            assert isinstance(self.switches[switchid].get_line(addr),ReplicaEntry), f"Replica of {hex(addr)} missing on {switchid}"
     
     def verify_system_state(self):
         '''
         Perform lots of checks on the current system
         '''
-        for cacheset in self.device.entries:
-            for tag,line in cacheset.items():
-                self.verify_line(line.addr)
+        for device in self.devices.values():
+            for cacheset in device.entries:
+                for tag,line in cacheset.items():
+                    self.verify_line(line.addr)
         for switch in self.switches.values():
             for cacheset in switch.entries:
                 for tag,line in cacheset.items():
                     self.verify_line(line.addr)
+        if self.region_size != None:
+            self.verify_split_regions()
         
         # Check LRU of all nodes
         for hostid in self.net.host_ids:
             self.hosts[hostid].verify_lru()
-        self.device.verify_lru()
+        for device in self.devices.values():
+            device.verify_lru()
         for switchid in self.net.switch_ids:
             self.switches[switchid].verify_lru()
         
         debug_print(f"System state verified")
         
-    def print_flow_records(self,filename:str):
+    def print_flow_records(self,filename:str,run_info:Dict=None):
         
         total_improved_count = 0
         total_same_count = 0
@@ -735,8 +1085,12 @@ class CoherenceEngine:
             "AVG Benefit" : total_benefit/(total_improved_count+total_same_count+total_deteriorated_count)
         }
         
-        with open(filename,"w") as file:
-            json.dump(self.flow_records,file,indent=4)
+        if filename != None:
+            with open(filename,"w") as file:
+                if run_info != None:
+                    json.dump({**self.flow_records,"Run info":run_info},file,indent=4)
+                else:
+                    json.dump(self.flow_records,file,indent=4)
         
         #Print aggregate results
         print(f"Total Improved: {total_improved_count}")
@@ -744,13 +1098,376 @@ class CoherenceEngine:
         print(f"Total Deteriorated: {total_deteriorated_count}")
         print(f"Overall AVG benefit: {total_benefit/(total_improved_count+total_same_count+total_deteriorated_count)}")
     
-    def print_communicating_hosts(self):
-        
-        sorted_data = dict(sorted(self.communicating_hosts.items(),key=lambda item: item[1], reverse=True))
+    def print_communicating_hosts(self,top:int=20):
         
-        for hostset,count in sorted_data.items():
+        for hostset,count in self.communicating_hosts.top(top):
             print(f"{hostset}:{count}")
     
+    def heavy_hitter_report(self,top:int)->Dict:
+        '''
+        Most communicating host groups and most contended lines, counts are upper bounds unless exact
+        '''
+        report = {
+            "Exact": self.communicating_hosts.exact,
+            "Top host groups": [{"Hosts":list(hostset),"Transactions":count} for hostset,count in self.communicating_hosts.top(top)],
+            "Contended lines": [{"Address":hex(addr),"Transactions":count} for addr,count in self.contended_lines.top(top)]
+        }
+        print("Top communicating host groups")
+        for entry in report["Top host groups"]:
+            print(f"{entry['Hosts']}:{entry['Transactions']}")
+        print("Most contended lines")
+        for entry in report["Contended lines"]:
+            print(f"{entry['Address']}:{entry['Transactions']}")
+        return report
+
+    def device_report(self)->Dict:
+        '''
+        Load, migrations and flows of every device, to see how evenly the interleave spreads them
+        '''
+        total = max(self.reqid,1)
+        report = dict()
+        for deviceid,stats in self.device_stats.items():
+            report[f"D{deviceid - self.net.num_hosts}"] = {
+                "Requests": stats["Requests"],
+                "Load share": stats["Requests"]/total,
+                "Migration count": stats["Migration count"],
+                "Benefit": sum(flow["Benefit"] for flow in stats["Flows"].values()),
+                "Flows": {key:flow for key,flow in stats["Flows"].items() if flow["Count"] > 0}
+            }
+        print("Per device load")
+        for label,entry in report.items():
+            print(f"{label}: {entry['Requests']} requests ({entry['Load share']:.3f}), {entry['Migration count']} migrations, benefit {entry['Benefit']}")
+        return report
+
+    def region_key(self,addr:int)->int:
+        '''
+        Directory address of the region holding addr
+        '''
+        return REGION_KEY_BIT | ((addr >> self.region_shift) << self.line_shift)
+    
+    def region_lines(self,entry:RegionEntry)->range:
+        return range(entry.base,entry.base + self.region_size,self.line_size)
+    
+    def hold_line(self,entry:RegionEntry,hostid:int,addr:int):
+        '''
+        Account a line of the region newly cached by a host
+        '''
+        line = addr >> self.line_shift << self.line_shift
+        entry.lines[hostid] = entry.lines.get(hostid,0) + 1
+        entry.present[line] = entry.present.get(line,0) + 1
+    
+    def drop_line(self,entry:RegionEntry,hostid:int,addr:int)->int:
+        '''
+        Account a line of the region no longer cached by a host, returns the lines of the region it still caches
+        '''
+        line = addr >> self.line_shift << self.line_shift
+        entry.lines[hostid] -= 1
+        entry.present[line] -= 1
+        if entry.present[line] == 0:
+            del entry.present[line]
+        if entry.lines[hostid] == 0:
+            del entry.lines[hostid]
+            return 0
+        return entry.lines[hostid]
+    
+    def invalidate_region_host(self,entry:RegionEntry,hostid:int)->int:
+        '''
+        Invalidate every line of the region cached by a host, returns how many there were
+        '''
+        count = 0
+        for line in self.region_lines(entry):
+            if self.hosts[hostid].check_hit(line):
+                self.hosts[hostid].evict(line)
+                self.drop_line(entry,hostid,line)
+                count += 1
+        return count
+    
+    def allocate_on_host(self,hostid:int,addr:int):
+        replacement_addr = self.hosts[hostid].allocate(addr)
+        #If there is any replacement, handle it
+        if replacement_addr != None:
+            self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),hostid)
+            #Now reattempt to allocate line
+            temp = self.hosts[hostid].allocate(addr)
+            assert temp == None, f"Host allocation on {hostid} failed"
+    
+    def count_line_entry(self,addr:int,delta:int):
+        '''
+        Line entries left in a split region, the region gets one entry again once none is left
+        '''
+        if self.region_size == None:
+            return
+        region = addr >> self.region_shift
+        self.split_regions[region] += delta
+        if self.split_regions[region] == 0:
+            del self.split_regions[region]
+            self.region_stats["Regions rejoined"] += 1
+    
+    def false_sharing(self,entry:RegionEntry,hostids:List[int],addr:int)->bool:
+        '''
+        Count the lines other than addr that a write would invalidate on these hosts
+        Returns True instead when the region has already done so split_threshold times, it should then split
+        '''
+        lines = sum(entry.lines.get(hostid,0) - (1 if self.hosts[hostid].check_hit(addr) else 0) for hostid in hostids)
+        if lines == 0:
+            return False
+        if entry.false_sharing >= self.split_threshold:
+            return True
+        entry.false_sharing += 1
+        self.region_stats["False sharing events"] += 1
+        self.region_stats["False sharing invalidations"] += lines
+        return False
+    
+    def split_region(self,key:int,entry:RegionEntry,location:int):
+        '''
+        Replace a region entry with an exact entry for every cached line of the region, where the region entry was
+        '''
+        self.home(key).resolve_object(location).evict(key)
+        lines = sorted(entry.present.keys())
+        self.split_regions[entry.base >> self.region_shift] = len(lines)
+        self.region_stats["Splits"] += 1
+        self.region_stats["Split line entries"] += len(lines)
+        debug_print(f"Splitting region {hex(entry.base)} into {len(lines)} lines")
+        for line in lines:
+            dentry = DirectoryEntry()
+            if entry.state == DirectoryState.A:
+                dentry.state = DirectoryState.A
+                dentry.sharers = []
+                dentry.owner = entry.owner
+            else:
+                dentry.state = DirectoryState.S
+                dentry.sharers = [hostid for hostid in entry.sharers if self.hosts[hostid].check_hit(line)]
+                dentry.owner = None
+            #A region entry on a device goes to the home device of each line
+            target_id = location if location in self.switches else self.home(line).id
+            target = self.home(line).resolve_object(target_id)
+            replacement_addr = target.allocate(line,dentry)
+            if replacement_addr != None:
+                self.handle_directory_eviction(replacement_addr,target.get_line(replacement_addr),target_id)
+                temp = target.allocate(line,dentry)
+                assert temp == None, f"Directory allocation on {target_id} failed"
+    
+    def region_path(self,key:int,requestor:int,target:int,dir_id:int,new_dest:int)->List[int]:
+        '''
+        requestor -> dir -> target -> dir -> requestor, through the device first if the entry just migrated
+        '''
+        device = self.home(key)
+        i = self.net.intermediate
+        if new_dest != None:
+            return self.remove_intermediate(key,[requestor,i,device.id,new_dest,target,i,new_dest,requestor])
+        return self.remove_intermediate(key,[requestor,i,dir_id,target,i,dir_id,requestor])
+    
+    def region_host_eviction(self,addr:int,evicting_host:int):
+        '''
+        A host evicting a line of a region only tells the directory when it was its last line of the region
+        '''
+        key = self.region_key(addr)
+        device = self.home(key)
+        i = self.net.intermediate
+        dir_node_id = device.find_directory_location(key)
+        assert dir_node_id != None, f"Couldnt find region entry of {hex(addr)} to modify after evicting from host {evicting_host}"
+        dir_holder = device.resolve_object(dir_node_id)
+        entry: RegionEntry = dir_holder.get_line(key)
+        self.hosts[evicting_host].evict(addr)
+        if self.drop_line(entry,evicting_host,addr) > 0:
+            self.region_stats["Silent evictions"] += 1
+            return
+        if entry.state == DirectoryState.A:
+            #owner -> device -> owner
+            path = self.remove_intermediate(key,[evicting_host,i,device.id,i,evicting_host])
+            base_path = [evicting_host,device.id,evicting_host]
+            self.static_path_benefit(path,base_path,1,device.id)
+            dir_holder.evict(key)
+        else:
+            entry.sharers.remove(evicting_host)
+            if len(entry.sharers) == 0:
+                dir_holder.evict(key)
+                #Evicting host -> device -> Evicting host
+                path = self.remove_intermediate(key,[evicting_host,i,device.id,i,evicting_host])
+                base_path = [evicting_host,device.id,evicting_host]
+                self.static_path_benefit(path,base_path,2,device.id)
+            else:
+                #Evicting host -> dir location -> evicting host
+                path = self.remove_intermediate(key,[evicting_host,i,dir_node_id,i,evicting_host])
+                base_path = [evicting_host,dir_node_id,evicting_host]
+                self.static_path_benefit(path,base_path,3,device.id)
+    
+    def region_directory_eviction(self,key:int,entry:RegionEntry,location:int):
+        '''
+        Evicting a region entry invalidates every cached line of the region
+        '''
+        device = self.home(key)
+        i = self.net.intermediate
+        if entry.state == DirectoryState.A:
+            #dir location -> owner -> device
+            path = self.remove_intermediate(key,[location,i,entry.owner,i,device.id])
+            base_path = [device.id,entry.owner,device.id]
+            self.static_path_benefit(path,base_path,4,device.id)
+            holders = [entry.owner]
+        else:
+            #dir location -> furthest sharer -> device
+            furthest_sharer = self.net.furthest_node(location,entry.sharers)
+            path = self.remove_intermediate(key,[location,i,furthest_sharer,i,device.id])
+            base_path = [device.id,furthest_sharer,device.id]
+            self.static_path_benefit(path,base_path,5,device.id)
+            holders = entry.sharers[:]
+        for hostid in holders:
+            self.region_stats["Region eviction lines"] += self.invalidate_region_host(entry,hostid)
+        device.resolve_object(location).evict(key)
+    
+    def serve_region_req(self, addr:int, optype: OpType, requestor: int)->bool:
+        '''
+        Serve a request with the entry of its region, returns False if the region had to split and the line entries should serve it
+        '''
+        key = self.region_key(addr)
+        device = self.home(key)
+        i = self.net.intermediate
+        location = device.find_directory_location(key)
+        
+        if location == None:
+            #First cached line of the region, one entry covers all of it
+            entry = RegionEntry(addr >> self.region_shift << self.region_shift)
+            if optype == OpType.READ:
+                entry.state = DirectoryState.S
+                entry.sharers = [requestor]
+                entry.owner = None
+            else:
+                entry.state = DirectoryState.A
+                entry.sharers = []
+                entry.owner = requestor
+            destination_id = self.placement_policy(key,optype,requestor,self.net.device_path(device.id),self.reqid)
+            destination = device.resolve_object(destination_id)
+            replacement_addr = destination.allocate(key,entry)
+            if replacement_addr != None:
+                self.handle_directory_eviction(replacement_addr,destination.get_line(replacement_addr),destination_id)
+                temp = destination.allocate(key,entry)
+                assert temp == None, f"Directory allocation on {destination_id} failed"
+            self.hold_line(entry,requestor,addr)
+            self.allocate_on_host(requestor,addr)
+            #requestor -> device -> requestor
+            path = self.remove_intermediate(key,[requestor,i,device.id,i,requestor])
+            base_path = [requestor,device.id,requestor]
+            self.static_path_benefit(path,base_path,11,device.id)
+            return True
+        
+        dir_holder = device.resolve_object(location)
+        entry: RegionEntry = dir_holder.get_line(key)
+        debug_print(f"Current state: {entry}")
+        holds = self.hosts[requestor].check_hit(addr)
+        
+        if (entry.state == DirectoryState.A and entry.owner == requestor) or \
+           (entry.state == DirectoryState.S and requestor in entry.sharers and optype == OpType.READ):
+            #The requestor already has permission for the whole region, a line it does not cache comes straight from memory
+            if not holds:
+                memory = self.home(addr).id
+                self.static_path_benefit([requestor,memory,requestor],[requestor,memory,requestor],11,memory)
+                self.hold_line(entry,requestor,addr)
+                self.allocate_on_host(requestor,addr)
+            return True
+        
+        new_dest = None
+        if entry.state == DirectoryState.A:
+            old_owner = entry.owner
+            #Split before counting, the lines are then served and counted one by one
+            if optype == OpType.WRITE and self.false_sharing(entry,[old_owner],addr):
+                self.split_region(key,entry,location)
+                return False
+            if dir_holder.id == device.id:
+                self.migration_stats["One copy diff host"] += 1
+            if optype == OpType.READ:
+                #The owner keeps its lines of the region, as shared
+                new_dest = self.migration_policy(key,requestor)
+                path = self.region_path(key,requestor,old_owner,dir_holder.id,new_dest)
+                base_path = [requestor,device.id,old_owner,device.id,requestor]
+                self.static_path_benefit(path,base_path,6,device.id)
+                entry.sharers = [old_owner,requestor]
+                entry.owner = None
+                entry.state = DirectoryState.S
+            else:
+                new_dest = self.migration_policy(key,requestor)
+                path = self.region_path(key,requestor,old_owner,dir_holder.id,new_dest)
+                base_path = [requestor,device.id,old_owner,device.id,requestor]
+                self.static_path_benefit(path,base_path,7,device.id)
+                self.invalidate_region_host(entry,old_owner)
+                entry.owner = requestor
+        else:
+            others = [hostid for hostid in entry.sharers if hostid != requestor]
+            if optype == OpType.WRITE and len(others) > 0 and self.false_sharing(entry,others,addr):
+                self.split_region(key,entry,location)
+                return False
+            if len(entry.sharers) == 1 and requestor not in entry.sharers and dir_holder.id == device.id:
+                self.migration_stats["One copy diff host"] += 1
+            if optype == OpType.READ:
+                closest_sharer = self.net.closest_node(requestor,entry.sharers)
+                new_dest = self.migration_policy(key,requestor)
+                path = self.region_path(key,requestor,closest_sharer,dir_holder.id,new_dest)
+                base_path = [requestor,device.id,closest_sharer,device.id,requestor]
+                self.static_path_benefit(path,base_path,8,device.id)
+                entry.sharers.append(requestor)
+            else:
+                if len(others) == 0:
+                    #requestor -> dir -> requestor
+                    path = self.remove_intermediate(key,[requestor,i,dir_holder.id,i,requestor])
+                    base_path = [requestor,device.id,requestor]
+                    self.static_path_benefit(path,base_path,9,device.id)
+                else:
+                    farthest_sharer = self.net.furthest_node(requestor,entry.sharers)
+                    new_dest = self.migration_policy(key,requestor)
+                    path = self.region_path(key,requestor,farthest_sharer,dir_holder.id,new_dest)
+                    base_path = [requestor,device.id,farthest_sharer,device.id,requestor]
+                    self.static_path_benefit(path,base_path,10,device.id)
+                    for hostid in others:
+                        self.invalidate_region_host(entry,hostid)
+                entry.sharers = []
+                entry.owner = requestor
+                entry.state = DirectoryState.A
+        
+        if new_dest != None:
+            dir_holder = device.resolve_object(new_dest)
+        dir_holder.set_line(key,entry)
+        if not holds:
+            self.hold_line(entry,requestor,addr)
+            self.allocate_on_host(requestor,addr)
+        return True
+    
+    def sample_directory_usage(self):
+        '''
+        Directory entries in use and the lines they track, one per line entry and every cached line of a region entry
+        '''
+        entries = 0
+        lines = 0
+        for holder in list(self.devices.values()) + list(self.switches.values()):
+            for cacheset in holder.entries:
+                for tag,line in cacheset.items():
+                    data = holder.get_line(line.addr)
+                    if isinstance(data,ReplicaEntry):
+                        continue
+                    entries += 1
+                    lines += len(data.present) if isinstance(data,RegionEntry) else 1
+        self.directory_usage["Samples"] += 1
+        self.directory_usage["Entries"] += entries
+        self.directory_usage["Lines"] += lines
+        return entries, lines
+    
+    def region_report(self)->Dict:
+        '''
+        Directory capacity saved by region entries, against one entry per tracked line, and what region tracking cost
+        '''
+        entries, lines = self.sample_directory_usage()
+        usage = self.directory_usage
+        report = {
+            "Region size": self.region_size,
+            "Split threshold": self.split_threshold,
+            "Entries": entries,
+            "Lines tracked": lines,
+            "Capacity savings": 1 - entries/lines if lines else 0,
+            "Mean capacity savings": 1 - usage["Entries"]/usage["Lines"] if usage["Lines"] else 0,
+            "Split regions": len(self.split_regions),
+            **self.region_stats
+        }
+        print(f"Regions: {report}")
+        return report
+    
     def process_req(self, addr:int, optype: OpType, requestor: int):
         '''
         Process request one by one
@@ -769,8 +1486,54 @@ class CoherenceEngine:
 
         if self.reqid % 10000 == 0:
             print(self.reqid)
+        self.last_flow = None
+        self.request_flow = None
+        self.request_template = None
+        self.device_stats[self.home(addr).id]["Requests"] += 1
+        #Moved along with a neighbour and not yet decided on by itself
+        moved_early = self.bulk_moved.get(addr,None)
+        
+        #Regions with one entry are served as a whole, the others line by line
+        if self.region_size != None and (addr >> self.region_shift) not in self.split_regions and self.serve_region_req(addr,optype,requestor):
+            self.verify_region_request(addr,optype,requestor)
+        else:
+            self.serve_line_req(addr,optype,requestor)
+            #Verification checks
+            self.verify_request(addr,optype,requestor)
+        
+        if self.request_flow in CONTENDED_FLOWS:
+            self.contended_lines.add(addr)
+        
+        #Hops saved by the entry being in place before the line's own migration decision, against its old location
+        #Only the directory slots of the request move, a request that migrated the entry went through the device either way
+        if moved_early != None and self.request_flow != None:
+            source_id, target_id = moved_early
+            self.bulk_stats["Requests before own decision"] += 1
+            if self.request_template != None:
+                template, dir_slots = self.request_template
+                old_path = self.place_directory(template,dir_slots,source_id)
+                new_path = self.place_directory(template,dir_slots,target_id)
+                self.bulk_stats["Early benefit"] += self.net.path_cost(old_path) - self.net.path_cost(new_path)
+        
+        if self.region_size != None and self.reqid % REGION_SAMPLE_EVERY == 0:
+            self.sample_directory_usage()
+        
+        if self.reqid % 1000000 == 0:
+            self.verify_system_state()
+
+        self.reqid += 1
+        
+        if self.telemetry != None:
+            self.telemetry.tick()
+    
+    def serve_line_req(self, addr:int, optype: OpType, requestor: int):
+        '''
+        Serve a request with one directory entry per line
+        '''
         hit = False
-        switchid = self.device.search_entry_switch(addr)
+        #Home device of the line, it decides placement and migration of the entry
+        device = self.home(addr)
+        switchid = device.search_entry_switch(addr)
         dir_holder = None
         
         #Needed for path costs
@@ -778,14 +1541,14 @@ class CoherenceEngine:
         path_cost = 0
         
         #Check if entry exists on switch or device
-        if self.device.search_entry_device(addr):
+        if device.search_entry_device(addr):
             hit = True
             debug_print(f"Entry found in device")
-            dir_holder = self.device
+            dir_holder = device
         elif switchid != None:
             hit = True
             debug_print(f"Entry found on switch {switchid}")
-            dir_holder = self.device.switches[switchid]
+            dir_holder = device.switches[switchid]
         else:
             debug_print(f"Line {hex(addr)} not found")
             
@@ -797,14 +1560,14 @@ class CoherenceEngine:
             if self.migration_policy_name == 'perfect':
                 new_location = self.migration_policy(addr,requestor)
                 if new_location != None:
-                    dir_holder = self.device.resolve_object(self.device.find_directory_location(addr))
+                    dir_holder = device.resolve_object(device.find_directory_location(addr))
             #Otherwise lazy migration is implemented later on
             #Check state and process accordingly
             assert dentry.state != DirectoryState.I
             #If line is in Modified state
             if dentry.state == DirectoryState.A:
                 old_owner = dentry.owner
-                if requestor != dentry.owner and dir_holder.id == self.device.id:
+                if requestor != dentry.owner and dir_holder.id == device.id:
                     self.migration_stats["One copy diff host"] += 1
                 #If requestor is also owner, pass
                 if requestor == dentry.owner:
@@ -818,17 +1581,17 @@ class CoherenceEngine:
                         new_dest = self.migration_policy(addr,requestor)
                         if new_dest != None:
                             #Assign new dir holder
-                            dir_holder = self.device.resolve_object(new_dest)
-                            assert self.device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
+                            dir_holder = device.resolve_object(new_dest)
+                            assert device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
                             #requestor -> i -> device -> new dir -> owner -> i -> new dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,self.device.id,new_dest,old_owner,i,new_dest,requestor])
+                            path = self.remove_intermediate(addr,[requestor,i,device.id,new_dest,old_owner,i,new_dest,requestor])
                         else:    
                             #If no migration then
-                            assert self.device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
+                            assert device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
                             #requestor -> i -> dir -> owner -> i -> dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,old_owner,i,dir_holder.id,requestor])
-                        base_path = [requestor,self.device.id,old_owner,self.device.id,requestor]
-                        path_cost = self.static_path_benefit(path,base_path,6)
+                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,old_owner,i,dir_holder.id,requestor],[2,5])
+                        base_path = [requestor,device.id,old_owner,device.id,requestor]
+                        path_cost = self.static_path_benefit(path,base_path,6,device.id)
                         #Change owner to sharer
                         dentry.sharers.append(dentry.owner)
                         #Remove owner
@@ -839,7 +1602,7 @@ class CoherenceEngine:
                         replacement_addr = self.hosts[requestor].allocate(addr)
                         #If there is any replacement, handle it
                         if replacement_addr != None:
-                            self.handle_host_eviction(replacement_addr,self.device.find_directory_entry(replacement_addr),requestor)
+                            self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),requestor)
                             #Now reattempt to allocate line
                             temp = self.hosts[requestor].allocate(addr)
                             assert temp == None, f"Host allocation on {requestor} failed"
@@ -852,23 +1615,23 @@ class CoherenceEngine:
                         new_dest = self.migration_policy(addr,requestor)
                         if new_dest != None:
                             #Assign new dir holder
-                            dir_holder = self.device.resolve_object(new_dest)
-                            assert self.device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
+                            dir_holder = device.resolve_object(new_dest)
+                            assert device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
                             #requestor -> i -> device -> new dir -> owner -> i -> new dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,self.device.id,new_dest,old_owner,i,new_dest,requestor])
+                            path = self.remove_intermediate(addr,[requestor,i,device.id,new_dest,old_owner,i,new_dest,requestor])
                         else:    
                             #If no migration then
-                            assert self.device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
+                            assert device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
                             #requestor -> i -> dir -> owner -> i -> dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,old_owner,i,dir_holder.id,requestor])
-                        base_path = [requestor,self.device.id,old_owner,self.device.id,requestor]
-                        path_cost = self.static_path_benefit(path,base_path,7)
+                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,old_owner,i,dir_holder.id,requestor],[2,5])
+                        base_path = [requestor,device.id,old_owner,device.id,requestor]
+                        path_cost = self.static_path_benefit(path,base_path,7,device.id)
                         debug_print("Path Type 7")
                         #Allocate on requestor
                         replacement_addr = self.hosts[requestor].allocate(addr)
                         #If there is any replacement, handle it
                         if replacement_addr != None:
-                            self.handle_host_eviction(replacement_addr,self.device.find_directory_entry(replacement_addr),requestor)
+                            self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),requestor)
                             #Now reattempt to allocate line
                             temp = self.hosts[requestor].allocate(addr)
                             assert temp == None, f"Host allocation on {destination.id} failed"
@@ -880,7 +1643,7 @@ class CoherenceEngine:
                     dir_holder.set_line(addr,dentry)
             elif dentry.state == DirectoryState.S:
                 old_sharer_list = dentry.sharers[:]
-                if len(dentry.sharers) == 1 and requestor not in dentry.sharers and dir_holder.id == self.device.id:
+                if len(dentry.sharers) == 1 and requestor not in dentry.sharers and dir_holder.id == device.id:
                     self.migration_stats["One copy diff host"] += 1
                 #If operation is read
                 if optype == OpType.READ:
@@ -892,27 +1655,30 @@ class CoherenceEngine:
                         #Calculate path
                         old_owner = dentry.sharers[0]
                         closest_sharer = self.net.closest_node(requestor,old_sharer_list)
-                        #If we do migration, then the dir_holder will change
-                        new_dest = self.migration_policy(addr,requestor)
-                        if new_dest != None:
+                        #A replica closer than the primary entry serves the read, and the entry stays where it is
+                        replica_path = self.replica_read(addr,requestor,closest_sharer,dir_holder.id)
+                        new_dest = self.migration_policy(addr,requestor) if replica_path == None else None
+                        if replica_path != None:
+                            path = replica_path
+                        elif new_dest != None:
                             #Assign new dir holder
-                            dir_holder = self.device.resolve_object(new_dest)
-                            assert self.device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
+                            dir_holder = device.resolve_object(new_dest)
+                            assert device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
                             #requestor -> i -> device -> new dir -> owner -> i -> new dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,self.device.id,new_dest,old_owner,i,new_dest,requestor])
+                            path = self.remove_intermediate(addr,[requestor,i,device.id,new_dest,old_owner,i,new_dest,requestor])
                         else:    
                             #If no migration then
-                            assert self.device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
+                            assert device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
                             #requestor -> i -> dir -> closest sharer -> i -> dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,closest_sharer,i,dir_holder.id,requestor])
-                        base_path = [requestor,self.device.id,closest_sharer,self.device.id,requestor]
-                        path_cost = self.static_path_benefit(path,base_path,8)
+                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,closest_sharer,i,dir_holder.id,requestor],[2,5])
+                        base_path = [requestor,device.id,closest_sharer,device.id,requestor]
+                        path_cost = self.static_path_benefit(path,base_path,8,device.id)
                         debug_print("Path Type 8")
                         #Allocate on the requesting host
                         replacement_addr = self.hosts[requestor].allocate(addr)
                         #If there is any replacement, handle it
                         if replacement_addr != None:
-                            self.handle_host_eviction(replacement_addr,self.device.find_directory_entry(replacement_addr),requestor)
+                            self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),requestor)
                             #Now reattempt to allocate line
                             temp = self.hosts[requestor].allocate(addr)
                             assert temp == None, f"Host allocation on {destination.id} failed"
@@ -920,6 +1686,8 @@ class CoherenceEngine:
                         dentry.sharers.append(requestor)
                         #Write the updated entry
                         dir_holder.set_line(addr,dentry)
+                        if self.replication:
+                            self.place_replica(addr,dentry,dir_holder.id,requestor)
                 #If operation is write
                 else:
                     #Requestor already has line and is only sharer
@@ -927,9 +1695,10 @@ class CoherenceEngine:
                         # Requestor only needs permission, not data
                         #Calculate path
                         #requestor -> dir -> requestor
-                        path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,i,requestor])
-                        base_path = [requestor,self.device.id,requestor]
-                        path_cost = self.static_path_benefit(path,base_path,9)
+                        path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,i,requestor],[2])
+                        path = self.invalidate_replicas(addr,dir_holder.id,path)
+                        base_path = [requestor,device.id,requestor]
+                        path_cost = self.static_path_benefit(path,base_path,9,device.id)
                         debug_print("Path Type 9")
                     else:
                         old_owner = dentry.sharers[0]
@@ -939,17 +1708,18 @@ class CoherenceEngine:
                         farthest_sharer = self.net.furthest_node(requestor,old_sharer_list)
                         if new_dest != None:
                             #Assign new dir holder
-                            dir_holder = self.device.resolve_object(new_dest)
-                            assert self.device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
+                            dir_holder = device.resolve_object(new_dest)
+                            assert device.find_directory_location(addr) == new_dest, f"Migration of {hex(addr)} from {dir_holder} to {new_dest} unsuccessful"
                             #requestor -> i -> device -> new dir -> owner -> i -> new dir -> requestor
-                            path = self.remove_intermediate(addr,[requestor,i,self.device.id,new_dest,old_owner,i,new_dest,requestor])
+                            path = self.remove_intermediate(addr,[requestor,i,device.id,new_dest,old_owner,i,new_dest,requestor])
                         else:    
                             #If no migration then
-                            assert self.device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
+                            assert device.find_directory_location(addr) == dir_holder.id, f"Entry for {hex(addr)} not found in {dir_holder}"
                             #req -> dir -> furthest sharer -> dir -> req
-                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,farthest_sharer,i,dir_holder.id,requestor])
-                        base_path = [requestor,self.device.id,farthest_sharer,self.device.id,requestor]
-                        path_cost = self.static_path_benefit(path,base_path,10)
+                            path = self.remove_intermediate(addr,[requestor,i,dir_holder.id,farthest_sharer,i,dir_holder.id,requestor],[2,5])
+                        path = self.invalidate_replicas(addr,dir_holder.id,path)
+                        base_path = [requestor,device.id,farthest_sharer,device.id,requestor]
+                        path_cost = self.static_path_benefit(path,base_path,10,device.id)
                         debug_print("Path Type 10")
                         
                         if requestor not in dentry.sharers:
@@ -958,7 +1728,7 @@ class CoherenceEngine:
                             replacement_addr = self.hosts[requestor].allocate(addr)
                             #If there is any replacement, handle it
                             if replacement_addr != None:
-                                self.handle_host_eviction(replacement_addr,self.device.find_directory_entry(replacement_addr),requestor)
+                                self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),requestor)
                                 #Now reattempt to allocate line
                                 temp = self.hosts[requestor].allocate(addr)
                                 assert temp == None, f"Host allocation on {destination.id} failed"
@@ -980,9 +1750,9 @@ class CoherenceEngine:
             #We dont have the directory entry
             #Need to allocate it
             #Find the destination to allocate
-            destination_id = self.placement_policy(addr,optype,requestor,self.net.intermediate_path,self.reqid)
+            destination_id = self.placement_policy(addr,optype,requestor,self.net.device_path(device.id),self.reqid)
             #Get destination object
-            destination = self.device.resolve_object(destination_id)
+            destination = device.resolve_object(destination_id)
             #Allocate on the destination
             dentry = DirectoryEntry()
             if optype == OpType.READ:
@@ -993,6 +1763,8 @@ class CoherenceEngine:
                 dentry.state = DirectoryState.A
                 dentry.sharers = []
                 dentry.owner = requestor
+            #Counted before any replacement, evicting the other lines of a split region must not rejoin it while this one goes in
+            self.count_line_entry(addr,1)
             replacement_addr = destination.allocate(addr,dentry)
             # #Handle the replacement                    
             if replacement_addr != None:
@@ -1003,20 +1775,24 @@ class CoherenceEngine:
             #Give host copy of the line
             replacement_addr = self.hosts[requestor].allocate(addr)
             if replacement_addr != None:
-                self.handle_host_eviction(replacement_addr,self.device.find_directory_entry(replacement_addr),requestor)
+                self.handle_host_eviction(replacement_addr,self.home(replacement_addr).find_directory_entry(replacement_addr),requestor)
                 #Now reattempt to allocate line
                 temp = self.hosts[requestor].allocate(addr)
                 assert temp == None, f"Host allocation on {destination.id} failed"
                 
             #Calculate path
             #requestor -> device -> requestor
-            path = self.remove_intermediate(addr,[requestor,i,self.device.id,i,requestor])
-            base_path = [requestor,self.device.id,requestor]
-            path_cost = self.static_path_benefit(path,base_path,11)
+            path = self.remove_intermediate(addr,[requestor,i,device.id,i,requestor])
+            base_path = [requestor,device.id,requestor]
+            path_cost = self.static_path_benefit(path,base_path,11,device.id)
             debug_print("Path Type 11")
-            
-        #Verification checks
-        dentry = self.device.find_directory_entry(addr)
+    
+    def verify_request(self,addr:int,optype:OpType,requestor:int):
+        '''
+        Invariants that must hold for the line right after a request was served
+        '''
+        device = self.home(addr)
+        dentry = device.find_directory_entry(addr)
         #Lots of em
         #Check state
         assert not (dentry.owner != None and len(dentry.sharers) > 0), f"Line has owner {dentry.owner} and sharers {dentry.sharers} at the same time"
@@ -1041,25 +1817,78 @@ class CoherenceEngine:
             for hostid in dentry.sharers:
                 assert self.hosts[hostid].check_hit(addr), f"Host {hostid} is sharer, but does not have copy of the line"
         #Line should not simultaneously exist on switch and device at the same time
-        switchid = self.device.search_entry_switch(addr)
-        assert not (self.device.search_entry_switch(addr) != None and self.device.search_entry_device(addr) == True), f"Entry for {hex(addr)} found on switch and device"
-        
-        if self.reqid % 1000000 == 0:
-            self.verify_system_state()
+        switchid = device.search_entry_switch(addr)
+        assert not (device.search_entry_switch(addr) != None and device.search_entry_device(addr) == True), f"Entry for {hex(addr)} found on switch and device"
 
-        self.reqid += 1
+    def verify_region(self,key:int):
+        '''
+        Invariants for a region entry: its summary and line counts match what the hosts cache
+        '''
+        device = self.home(key)
+        entry: RegionEntry = device.find_directory_entry(key)
+        assert isinstance(entry,RegionEntry), f"Region entry {hex(key)} not found"
+        assert (entry.state == DirectoryState.A and entry.owner != None and len(entry.sharers) == 0) or \
+               (entry.state == DirectoryState.S and entry.owner == None and len(entry.sharers) != 0), \
+                f"Invalid combo, State {entry.state}, Owner {entry.owner}, Sharers {entry.sharers}"
+        assert (entry.base >> self.region_shift) not in self.split_regions, f"Region {hex(entry.base)} has an entry but is split"
+        lines: Dict[int,int] = dict()
+        present: Dict[int,int] = dict()
+        for line in self.region_lines(entry):
+            for host in self.hosts:
+                if host.check_hit(line):
+                    lines[host.id] = lines.get(host.id,0) + 1
+                    present[line] = present.get(line,0) + 1
+        assert lines == entry.lines, f"Region {hex(entry.base)} counts {entry.lines} but hosts cache {lines}"
+        assert present == entry.present, f"Region {hex(entry.base)} lines {entry.present} but hosts cache {present}"
+        if entry.state == DirectoryState.A:
+            assert list(lines.keys()) == [entry.owner], f"Region {hex(entry.base)} owned by {entry.owner} but cached by {list(lines.keys())}"
+        else:
+            assert sorted(lines.keys()) == sorted(entry.sharers), f"Region {hex(entry.base)} shared by {entry.sharers} but cached by {list(lines.keys())}"
+        num_dirs = 1 if device.check_hit(key) else 0
+        for switch in self.switches.values():
+            if switch.check_hit(key):
+                num_dirs += 1
+        assert num_dirs == 1, f"Region {hex(entry.base)} found in {num_dirs} locations instead of one"
+    
+    def verify_split_regions(self):
+        '''
+        Every split region counts exactly the line entries held for it, and no region with line entries is whole
+        '''
+        counts: Dict[int,int] = dict()
+        for holder in list(self.devices.values()) + list(self.switches.values()):
+            for cacheset in holder.entries:
+                for tag,line in cacheset.items():
+                    if not isinstance(line.data,(RegionEntry,ReplicaEntry)):
+                        region = line.addr >> self.region_shift
+                        counts[region] = counts.get(region,0) + 1
+        split = {region:count for region,count in self.split_regions.items() if count != 0}
+        assert counts == split, f"Line entries per region {counts} but split regions count {split}"
+    
+    def verify_region_request(self,addr:int,optype:OpType,requestor:int):
+        '''
+        Invariants that must hold for the region right after a request was served by its region entry
+        '''
+        entry: RegionEntry = self.home(self.region_key(addr)).find_directory_entry(self.region_key(addr))
+        assert entry != None, f"Region entry of {hex(addr)} cannot be found"
+        assert self.hosts[requestor].check_hit(addr), f"Requestor {requestor} does not have a copy of {hex(addr)}"
+        assert entry.lines.get(requestor,0) > 0, f"Requestor {requestor} not counted in region {hex(entry.base)}"
+        assert (optype == OpType.READ and (requestor in entry.sharers or requestor == entry.owner)) or \
+               (optype == OpType.WRITE and entry.state == DirectoryState.A and requestor == entry.owner), \
+                f"Requestor {requestor} not owner {entry.owner} not in sharers {entry.sharers}"
 
 class Config:
     '''
     Class which holds the configuration parameters we need for the simulation
     '''
-    def __init__(self,filename):
+    def __init__(self,filename:str=None,d:Dict=None):
         '''
         Parse a json file and update the config parameters
+        Alternatively take an already parsed config dict
         '''
-        with open(filename) as file:
-            d = json.load(file)
-            self.d = d
+        if filename != None:
+            with open(filename) as file:
+                d = json.load(file)
+        self.d = d
 
         self.num_hosts = d["Num hosts"]
         self.host_line_size = d["Host line size"]
@@ -1074,11 +1903,58 @@ class Config:
         self.switch_assoc = d["Switch assoc"]
         self.intermediate = d["Intermediate switch"]
         self.intermediate_path = d["Intermediate path"]
-        self.output_json = d["Output json"]
+        self.output_json = d.get("Output json",None)
         self.placement_policy = d["Placement policy"]
         self.migration_policy = d["Migration policy"]
         self.edgelist = d["Edgelist"]
         self.debug = d["Debug"]
+        #Memory spread over several devices, numbered after the hosts, lines go to them by the interleave
+        #Devices take ids num_hosts..num_hosts+num_devices-1 and the switches follow, so every switch id moves up by
+        #num_devices-1 against a one device topology (see topologies/mesh_4x4_2dev.edgelist and example_config_2dev.json)
+        self.num_devices = d.get("Num devices",1)
+        self.interleave = d.get("Interleave","line")
+        self.interleave_page_size = d.get("Interleave page size",4096)
+        #Only for the xor interleave, device bit i is the parity of the address under mask i
+        self.interleave_masks = [int(mask,16) if isinstance(mask,str) else mask for mask in d.get("Interleave masks",None) or []] or None
+        #Path from the intermediate switch to each device, keyed by device id, shortest paths when not given
+        self.intermediate_paths = {int(key):path for key,path in d.get("Intermediate paths",{}).items()}
+        #Replicas of shared entries on switches near clusters of sharers, adaptive and sssp only
+        self.replicate_shared = d.get("Replicate shared",False)
+        self.max_replicas = d.get("Max replicas",2)
+        self.replica_min_sharers = d.get("Replica min sharers",2)
+        #One directory entry per aligned region of this many bytes instead of per line
+        self.region_size = d.get("Region size",None)
+        self.region_split_threshold = d.get("Region split threshold",1)
+        #Migrate the entries of the other lines of the block (bytes) with matching holders in the same decision
+        self.bulk_migration_size = d.get("Bulk migration size",None)
+        #Only used when one trace per host is given
+        self.trace_merge_policy = d.get("Trace merge policy","timestamp")
+        self.trace_merge_weights = d.get("Trace merge weights",None)
+        #Only requests [start, end) of a combined trace, found through its index (trace_index.py)
+        self.trace_start = d.get("Trace start",0)
+        self.trace_end = d.get("Trace end",None)
+        #Rendering needs matplotlib, pydot and graphviz, so it is off unless asked for
+        self.draw_topology = d.get("Draw topology",False)
+        #Sqlite database collecting the results of many runs
+        self.results_db = d.get("Results db",None)
+        #Periodic status file, rate limited by wall clock
+        self.telemetry_file = d.get("Telemetry file",None)
+        self.telemetry_interval = d.get("Telemetry interval",5.0)
+        #'phases' for per phase timers, 'cprofile' for a pstats dump
+        self.profile = d.get("Profile",None)
+        self.profile_output = d.get("Profile output","profile.json" if self.profile == "phases" else "profile.pstats")
+        #Stop once the flow records have converged, off unless a tolerance is given
+        self.convergence_tolerance = d.get("Convergence tolerance",None)
+        self.convergence_min_requests = d.get("Convergence min requests",1000000)
+        self.convergence_window = d.get("Convergence window",10000)
+        self.convergence_confidence = d.get("Convergence confidence",0.95)
+        #Communicating host groups and contended lines, sketched unless exact is asked for
+        self.heavy_hitters_exact = d.get("Heavy hitters exact",False)
+        self.heavy_hitter_counters = d.get("Heavy hitter counters",1024)
+        self.count_min_width = d.get("Count-min width",1 << 14)
+        self.count_min_depth = d.get("Count-min depth",4)
+        #How many to report in the output json, none unless given
+        self.heavy_hitter_top = d.get("Heavy hitter top",None)
 
     def print(self):
         #Write the config onto console
@@ -1088,22 +1964,170 @@ class Config:
             print(f"{key}:{val}")
         print("#####################")
 
-if __name__ == "__main__":
+def build_network(cfg:Config)->CXLNet:
+    '''
+    Build the topology described by the config, with the distance table already computed
+    '''
+    N = CXLNet(num_hosts=cfg.num_hosts,num_devices=cfg.num_devices,num_switches=cfg.num_switches)
+    #Build the network topology
+    #Read from egdelist
+    N.G = nx.read_edgelist(cfg.edgelist,edgetype=int,nodetype=int)
+    N.build_distance_table()
+    return N
+
+def build_engine(cfg:Config,N:CXLNet)->CoherenceEngine:
+    '''
+    Build hosts, device and switches for the config and attach them to the topology
+    The topology is shared, only the intermediate switch is private to this engine
+    '''
+    hosts = [CXLHost(cfg.host_line_size,cfg.host_num_lines,cfg.host_assoc,i) for i in range(cfg.num_hosts)]
+    devices = [CXLDevice(cfg.device_line_size,cfg.device_num_lines,cfg.device_assoc,i) for i in N.device_ids]
+    switches = {i:CXLSwitch(cfg.switch_line_size,cfg.switch_num_lines,cfg.switch_assoc,i) for i in N.switch_ids}
     
-    config_file = sys.argv[1]
-    trace_file = sys.argv[2]
+    #Switch capacity is shared by the entries of all devices
+    for device in devices:
+        device.set_switches(switches)
     
-    cfg = Config(config_file)
+    net = N.view()
+    net.set_intermediate(cfg.intermediate,cfg.intermediate_path,cfg.intermediate_paths)
+    
+    simulator = CoherenceEngine(hosts, devices[0], switches)
+    if len(devices) > 1:
+        simulator.set_devices(devices,Interleave(devices,cfg.interleave,cfg.device_line_size,cfg.interleave_page_size,cfg.interleave_masks))
+    simulator.add_network(net)
+    simulator.set_placement_policy(cfg.placement_policy)
+    simulator.set_migration_policy(cfg.migration_policy)
+    if cfg.replicate_shared:
+        simulator.set_replication(cfg.max_replicas,cfg.replica_min_sharers)
+    if cfg.region_size != None:
+        simulator.set_region_tracking(cfg.region_size,cfg.host_line_size,cfg.region_split_threshold)
+    if cfg.bulk_migration_size != None:
+        simulator.set_bulk_migration(cfg.bulk_migration_size,cfg.host_line_size)
+    simulator.set_heavy_hitters(cfg.heavy_hitters_exact,cfg.heavy_hitter_counters,cfg.count_min_width,cfg.count_min_depth)
+    if cfg.telemetry_file != None:
+        simulator.telemetry = Telemetry(simulator,cfg.telemetry_file,cfg.telemetry_interval)
+    return simulator
+
+def trace_requests(cfg:Config,trace_files:List[str]):
+    '''
+    Requests of the run as (address, OpType, host id), a combined trace is cut to the trace start and end
+    '''
+    if len(trace_files) == 1:
+        requests = read_trace(trace_files[0],cfg.trace_start,cfg.trace_end)
+    else:
+        if cfg.trace_start != 0 or cfg.trace_end != None:
+            print("Trace start and end need one combined trace")
+            exit(2)
+        #Per host traces are merged on the fly, host id is the position on the command line
+        requests = merge_host_traces(trace_files,cfg.trace_merge_policy,cfg.trace_merge_weights)
+    return ((addr,OpType.READ if op == 'R' else OpType.WRITE,hostid) for addr,op,hostid in requests)
+
+def run_simulation(cfg:Config,trace_files:List[str],N:CXLNet=None,requests=None,progress=None,progress_every:int=100000)->CoherenceEngine:
+    '''
+    Run the config over the traces and report the results, the topology and requests are built here unless given
+    progress(reqid) is called every progress_every requests
+    '''
+    start = time.time()
     cfg.print()
     
     #Specify debug
     cachesim.DEBUG = cfg.debug
     
-    hosts = [CXLHost(cfg.host_line_size,cfg.host_num_lines,cfg.host_assoc,i) for i in range(cfg.num_hosts)]
-    device = CXLDevice(cfg.device_line_size,cfg.device_num_lines,cfg.device_assoc,cfg.num_hosts)
-    switches = {i:CXLSwitch(cfg.switch_line_size,cfg.switch_num_lines,cfg.switch_assoc,i) for i in range(cfg.num_hosts+1,cfg.num_hosts+1+cfg.num_switches)}
+    if N == None:
+        N = build_network(cfg)
+        if cfg.draw_topology:
+            N.draw()
+    
+    simulator = build_engine(cfg,N)
+    simulator.describe()
+    
+    if requests == None:
+        requests = trace_requests(cfg,trace_files)
+    
+    if simulator.telemetry != None:
+        simulator.telemetry.total_requests = sum(estimate_requests(t,start=cfg.trace_start,end=cfg.trace_end) for t in trace_files)
     
-    device.set_switches(switches)
+    convergence = None
+    if cfg.convergence_tolerance != None:
+        from convergence import ConvergenceMonitor
+        convergence = ConvergenceMonitor(simulator,cfg.convergence_tolerance,cfg.convergence_min_requests,cfg.convergence_window,cfg.convergence_confidence)
+    
+    if cfg.profile == "phases":
+        from profiler import PhaseProfiler
+        phase_profiler = PhaseProfiler()
+        phase_profiler.attach(simulator)
+    elif cfg.profile == "cprofile":
+        import cProfile
+        deep_profiler = cProfile.Profile()
+        deep_profiler.enable()
+    
+    for addr,rw,hostid in requests:
+        simulator.process_req(addr,rw,hostid)
+        if convergence != None and convergence.tick():
+            print(f"Flow records converged after {simulator.reqid} requests, stopping")
+            break
+        if progress != None and simulator.reqid % progress_every == 0:
+            progress(simulator.reqid)
+    
+    if cfg.profile == "phases":
+        phase_profiler.write(cfg.profile_output)
+    elif cfg.profile == "cprofile":
+        import pstats
+        deep_profiler.disable()
+        deep_profiler.dump_stats(cfg.profile_output)
+        pstats.Stats(deep_profiler).sort_stats("cumulative").print_stats(30)
+    
+    if simulator.telemetry != None:
+        simulator.telemetry.close()
+    print(f"Finished processing requests without triggering any assertions")
+    
+    #Process the cost benefit data
+    
+    run_info = dict()
+    if convergence != None:
+        run_info["Convergence"] = convergence.report(sum(estimate_requests(t,start=cfg.trace_start,end=cfg.trace_end) for t in trace_files))
+    if cfg.heavy_hitter_top != None:
+        run_info["Heavy hitters"] = simulator.heavy_hitter_report(cfg.heavy_hitter_top)
+    if len(simulator.devices) > 1:
+        run_info["Devices"] = simulator.device_report()
+    if simulator.replication:
+        run_info["Replication"] = simulator.replication_report()
+    if simulator.region_size != None:
+        run_info["Regions"] = simulator.region_report()
+    if simulator.bulk_size != None:
+        run_info["Bulk migration"] = simulator.bulk_report()
+    if cfg.results_db != None:
+        #Everything the database keeps, so a cached result json can be recorded again (run_experiment.py)
+        from results_db import RUN_RECORD
+        #ru_maxrss is in KB on Linux
+        run_info[RUN_RECORD] = {
+            "Requests": simulator.reqid,
+            "Runtime": time.time() - start,
+            "Peak RSS KB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "Migration stats": simulator.migration_stats
+        }
+    print(simulator.print_flow_records(cfg.output_json,run_info if run_info else None))
+    # simulator.print_communicating_hosts()
+    
+    print(simulator.migration_stats)
+    
+    if simulator.migration_policy_name == 'lazy':
+        assert simulator.migration_stats["Migration count"] == simulator.migration_stats["One copy diff host"], f"Missed migration opportunity"
+    
+    if cfg.results_db != None:
+        from results_db import ResultsDB
+        record = run_info[RUN_RECORD]
+        ResultsDB(cfg.results_db).record_run(cfg.d,trace_files,simulator.flow_records,simulator.migration_stats,simulator.reqid,
+                                             record["Runtime"],record["Peak RSS KB"],run_info)
+    return simulator
+
+if __name__ == "__main__":
+    
+    config_file = sys.argv[1]
+    #Either one combined trace or one trace per host
+    trace_files = sys.argv[2:]
+    
+    cfg = Config(config_file)
     
     # N = CXLNet(num_hosts=cfg.num_hosts,num_devices=1,num_switches=cfg.num_switches)
     # #Build the network topology
@@ -1112,11 +2136,6 @@ if __name__ == "__main__":
     #          (0,8),(1,5),(2,6),(3,7),(4,11)]
     # N.G.add_edges_from(edges)
     
-    N = CXLNet(num_hosts=cfg.num_hosts,num_devices=1,num_switches=cfg.num_switches)
-    #Build the network topology
-    #Read from egdelist
-    N.G = nx.read_edgelist(cfg.edgelist,edgetype=int,nodetype=int)
-    
     # edges = [
     #     (17,18),(18,19),(19,20),(21,22),(22,23),(23,24),(25,26),(26,27),(27,28),(29,30),(30,31),(31,32),
     #     (17,21),(18,22),(19,23),(20,24),(21,25),(22,26),(23,27),(24,28),(25,29),(26,30),(27,31),(28,32),
@@ -1147,39 +2166,4 @@ if __name__ == "__main__":
     #     ]
     # N.G.add_edges_from(edges)
     
-    N.draw()
-    
-    N.set_intermediate(cfg.intermediate,cfg.intermediate_path)
-    
-    simulator = CoherenceEngine(hosts, device, switches)
-    simulator.add_network(N)
-    simulator.set_placement_policy(cfg.placement_policy)
-    simulator.set_migration_policy(cfg.migration_policy)
-    simulator.describe()
-    
-    with open(trace_file) as file:
-        while True:
-            line = file.readline()
-            if not line:
-                break
-            s = line.split(' ')
-            addr = int(s[0],16)
-            rw = OpType.READ if s[1] == 'R' else OpType.WRITE
-            hostid = int(s[2].strip())
-            
-            simulator.process_req(addr,rw,hostid)
-    print(f"Finished processing requests without triggering any assertions")
-    
-    #Process the cost benefit data
-    
-    print(simulator.print_flow_records(cfg.output_json))
-    # simulator.print_communicating_hosts()
-    
-    print(simulator.migration_stats)
-    
-    if simulator.migration_policy_name == 'lazy':
-        assert simulator.migration_stats["Migration count"] == simulator.migration_stats["One copy diff host"], f"Missed migration opportunity"
-        
-    
-    
-    
\ No newline at end of file
+    run_simulation(cfg,trace_files)
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import itertools
+import subprocess
+from typing import Dict, List
+from result_cache import ResultCache
+from run_experiment import values_to_str
+
+POLL_INTERVAL = 0.5
+PROGRESS_INTERVAL = 10
+
+class Job:
+    '''
+    One (trace, config) point of a sweep
+    '''
+
+    def __init__(self,trace:str,params:Dict,cfg:Dict,scratchspace:str):
+        self.trace = trace
+        self.params = params
+        self.cfg = cfg
+        prefix = os.path.basename(trace).replace('.trace','')
+        self.name = f"{prefix}_{values_to_str(params.values())}" if params else prefix
+        self.cfg_file = os.path.join(scratchspace,f"{self.name}.json")
+        self.log_file = os.path.join(scratchspace,f"log_{self.name}.txt")
+        self.telemetry_file = os.path.join(scratchspace,f"telemetry_{self.name}.json")
+        self.attempts = 0
+        self.proc: subprocess.Popen = None
+        self.start = None
+        self.cost = 0
+        self.memory_mb = 0
+        #Times a smaller job was started ahead of this one because this one did not fit
+        self.bypassed = 0
+
+    def cache_lines(self)->int:
+        '''
+        Total directory and cache capacity, which is what drives both run time and memory
+        '''
+        c = self.cfg
+        return c["Num hosts"]*c["Host num lines"] + c["Device num lines"] + c["Num switches"]*c["Switch num lines"]
+
+class Sweep:
+    '''
+    Expand a sweep specification into jobs and run them longest first under a memory budget
+    '''
+
+    def __init__(self,spec:Dict):
+        self.spec = spec
+        self.python = spec.get("Python",sys.executable)
+        self.workers = spec.get("Workers",os.cpu_count())
+        self.memory_budget = spec.get("Memory budget MB",None)
+        self.retries = spec.get("Retries",1)
+        #A job that did not fit may be bypassed this many times, then nothing else starts until it does fit
+        self.max_bypass = spec.get("Max bypass",4)
+        self.scratchspace = spec.get("Scratchspace","./scratchspace/sweep")
+        model = spec.get("Memory model",dict())
+        self.base_mb = model.get("Base MB",200)
+        self.bytes_per_line = model.get("Bytes per line",600)
+        self.cache = ResultCache(spec["Result cache"]) if "Result cache" in spec else None
+        os.makedirs(self.scratchspace,exist_ok=True)
+
+        with open(spec["Config template"]) as file:
+            self.template = json.load(file)
+
+        self.jobs = self.expand()
+
+    def points(self)->List[Dict]:
+        '''
+        Cartesian product of the grid, with the zipped parameters varying together as one more axis
+        '''
+        grid = self.spec.get("Grid",dict())
+        zipped = self.spec.get("Zip",dict())
+        axes = [[{key:val} for val in vals] for key,vals in grid.items()]
+        if zipped:
+            lengths = {len(vals) for vals in zipped.values()}
+            assert len(lengths) == 1, f"Zipped parameters must have the same number of values {zipped}"
+            axes.append([dict(zip(zipped.keys(),row)) for row in zip(*zipped.values())])
+        points = []
+        for combo in itertools.product(*axes):
+            point = dict()
+            for d in combo:
+                point.update(d)
+            points.append(point)
+        return points
+
+    def expand(self)->List[Job]:
+        jobs = []
+        for trace in self.spec["Traces"]:
+            for point in self.points():
+                cfg = dict(self.template)
+                cfg.update(point)
+                job = Job(trace,point,cfg,self.scratchspace)
+                #Per job even with a results database, the result cache stores this file
+                cfg["Output json"] = os.path.join(self.scratchspace,f"result_{job.name}.json")
+                cfg["Telemetry file"] = job.telemetry_file
+                #Longest first: run time grows with the trace and with the capacity that has to be searched
+                job.cost = os.path.getsize(trace) * job.cache_lines()
+                job.memory_mb = self.spec.get("Job memory MB",self.base_mb + self.bytes_per_line*job.cache_lines()/(1 << 20))
+                jobs.append(job)
+        jobs.sort(key=lambda job: job.cost,reverse=True)
+        return jobs
+
+    def launch(self,job:Job):
+        with open(job.cfg_file,"w") as file:
+            json.dump(job.cfg,file,indent=4)
+        job.attempts += 1
+        job.start = time.time()
+        log = open(job.log_file,"w")
+        job.proc = subprocess.Popen([self.python,"static_allocation.py",job.cfg_file,job.trace],stdout=log,stderr=log)
+        log.close()
+
+    def finish(self,job:Job)->bool:
+        '''
+        Wrap up a job whose process exited, returns True if it succeeded
+        '''
+        elapsed = time.time() - job.start
+        with open(job.log_file,"a") as file:
+            file.write(f"Time: {elapsed}s")
+        os.remove(job.cfg_file)
+        if os.path.exists(job.telemetry_file):
+            os.remove(job.telemetry_file)
+        ok = job.proc.returncode == 0
+        if ok and self.cache != None:
+            self.cache.store(self.cache.key([job.trace],job.cfg),job.cfg["Output json"],job.log_file,{"Trace":job.trace,"Values":job.params})
+        job.proc = None
+        return ok
+
+    def fetch_cached(self,job:Job)->bool:
+        '''
+        Take the result of a job from the cache, and record it in the results database if there is one
+        '''
+        key = self.cache.key([job.trace],job.cfg)
+        if not self.cache.fetch(key,job.cfg["Output json"],job.log_file):
+            return False
+        if job.cfg.get("Results db",None) == None:
+            return True
+        from results_db import ResultsDB
+        if ResultsDB(job.cfg["Results db"]).record_output(job.cfg,[job.trace],job.cfg["Output json"]) != None:
+            return True
+        #Cached by a run without a database, it lacks the run record, simulate again
+        self.cache.drop(key)
+        return False
+
+    def run(self):
+        pending: List[Job] = []
+        done_cost = 0
+        for job in self.jobs:
+            if self.cache != None and self.fetch_cached(job):
+                done_cost += job.cost
+                continue
+            pending.append(job)
+
+        total_cost = sum(job.cost for job in self.jobs)
+        #Only work done in this session tells us how fast we are going
+        ran_cost = 0
+        print(f"{len(self.jobs)} jobs, {len(self.jobs)-len(pending)} cached, {len(pending)} to run")
+
+        running: List[Job] = []
+        failed: List[Job] = []
+        completed = len(self.jobs) - len(pending)
+        start = time.time()
+        last_report = 0
+        while pending or running:
+            #Fill free slots with the longest job that fits in the remaining memory
+            memory_used = sum(job.memory_mb for job in running)
+            waiting: List[Job] = []
+            for job in list(pending):
+                if len(running) >= self.workers:
+                    break
+                fits = self.memory_budget == None or memory_used + job.memory_mb <= self.memory_budget
+                #A job larger than the whole budget still runs, but alone
+                if fits or not running:
+                    if not fits:
+                        print(f"{job.name} needs {job.memory_mb:.0f}MB, more than the budget, running it alone")
+                    pending.remove(job)
+                    self.launch(job)
+                    running.append(job)
+                    memory_used += job.memory_mb
+                    for waiter in waiting:
+                        waiter.bypassed += 1
+                    continue
+                #Memory held for a job bypassed too often, the running jobs drain until it fits
+                if job.bypassed >= self.max_bypass:
+                    break
+                waiting.append(job)
+
+            time.sleep(POLL_INTERVAL)
+
+            for job in list(running):
+                if job.proc.poll() == None:
+                    continue
+                running.remove(job)
+                if self.finish(job):
+                    completed += 1
+                    done_cost += job.cost
+                    ran_cost += job.cost
+                elif job.attempts <= self.retries:
+                    print(f"{job.name} failed (attempt {job.attempts}), retrying")
+                    #Back into the queue at its place in longest first order
+                    pending.append(job)
+                    pending.sort(key=lambda job: job.cost,reverse=True)
+                else:
+                    print(f"{job.name} failed after {job.attempts} attempts, see {job.log_file}")
+                    failed.append(job)
+                    done_cost += job.cost
+                    ran_cost += job.cost
+
+            now = time.time()
+            if now - last_report > PROGRESS_INTERVAL or not (pending or running):
+                last_report = now
+                self.report(completed,len(failed),len(running),len(pending),done_cost,ran_cost,total_cost,now-start)
+                self.report_telemetry(running)
+
+        return failed
+
+    def report(self,completed:int,failed:int,running:int,pending:int,done_cost:int,ran_cost:int,total_cost:int,elapsed:float):
+        '''
+        Progress in jobs, ETA extrapolated from the estimated cost simulated so far
+        '''
+        fraction = done_cost/total_cost if total_cost else 1
+        eta = elapsed*(total_cost-done_cost)/ran_cost if ran_cost > 0 else float('nan')
+        print(f"[{elapsed:8.0f}s] {completed} done, {failed} failed, {running} running, {pending} pending, "
+              f"{100*fraction:.1f}% of estimated work, ETA {eta:.0f}s")
+
+    def report_telemetry(self,running:List[Job]):
+        '''
+        Combine the status files of the running jobs
+        '''
+        statuses = []
+        for job in running:
+            try:
+                with open(job.telemetry_file) as file:
+                    statuses.append(json.load(file))
+            except (OSError, ValueError):
+                #Not written yet
+                continue
+        if not statuses:
+            return
+        rate = sum(s["Window requests/s"] for s in statuses)
+        rss = sum(s["RSS bytes"] for s in statuses)
+        remaining = [s["Projected remaining s"] for s in statuses if s["Projected remaining s"] != None]
+        longest = f", longest running job done in {max(remaining):.0f}s" if remaining else ""
+        print(f"           {len(statuses)} jobs reporting: {rate:.0f} requests/s, {rss/(1 << 30):.1f}GB RSS{longest}")
+
+if __name__ == '__main__':
+
+    #Usage: python sweep.py <sweep spec json>
+    with open(sys.argv[1]) as file:
+        spec = json.load(file)
+
+    sweep = Sweep(spec)
+    failed = sweep.run()
+    if failed:
+        exit(1)
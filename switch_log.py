@@ -0,0 +1,93 @@
+import os
+import json
+from typing import Dict, Iterator, List, Tuple
+
+#Bytes held before a write to disk
+BUFFER_BYTES = 1 << 20
+ADDR_ID_BYTES = 4
+
+#Binary log of ideal switch locations, one record per coherence event
+#  <prefix>.events     address id (4 bytes) + location bitmask (mask bytes), little endian
+#  <prefix>.addrs      the address of every id, 8 bytes each, in id order
+#  <prefix>.meta.json  mask width, bit labels and counts
+#Bit i of a mask is labels[i] in the metadata
+
+def file_names(prefix:str)->Tuple[str,str,str]:
+    return f"{prefix}.events", f"{prefix}.addrs", f"{prefix}.meta.json"
+
+class SwitchLocationWriter:
+    '''
+    Buffered writer of the switch location log, memory only grows with the number of distinct addresses
+    '''
+
+    def __init__(self,prefix:str,labels:List[str]):
+        self.prefix = prefix
+        self.labels = labels
+        self.mask_bytes = max((len(labels) + 7)//8,1)
+        events_file, addrs_file, _ = file_names(prefix)
+        self.events_file = open(events_file,"wb")
+        self.addrs_file = open(addrs_file,"wb")
+        self.events = bytearray()
+        self.addrs = bytearray()
+        self.addr_ids: Dict[int,int] = dict()
+        self.num_events = 0
+
+    def add(self,addr:int,mask:int):
+        addr_id = self.addr_ids.get(addr)
+        if addr_id == None:
+            addr_id = len(self.addr_ids)
+            self.addr_ids[addr] = addr_id
+            self.addrs += addr.to_bytes(8,"little")
+        self.events += addr_id.to_bytes(ADDR_ID_BYTES,"little")
+        self.events += mask.to_bytes(self.mask_bytes,"little")
+        self.num_events += 1
+        if len(self.events) >= BUFFER_BYTES:
+            self.flush()
+
+    def flush(self):
+        self.events_file.write(self.events)
+        self.addrs_file.write(self.addrs)
+        self.events = bytearray()
+        self.addrs = bytearray()
+
+    def close(self):
+        self.flush()
+        self.events_file.close()
+        self.addrs_file.close()
+        _, _, meta_file = file_names(self.prefix)
+        with open(meta_file,"w") as file:
+            json.dump({"Mask bytes":self.mask_bytes,
+                       "Labels":self.labels,
+                       "Events":self.num_events,
+                       "Addresses":len(self.addr_ids)},file,indent=4)
+
+def read_meta(prefix:str)->Dict:
+    _, _, meta_file = file_names(prefix)
+    with open(meta_file) as file:
+        return json.load(file)
+
+def read_events(prefix:str,chunk_events:int=1 << 22)->Iterator:
+    '''
+    Stream the log as (address ids, location bits) numpy arrays, bits is an events x labels matrix of 0/1
+    '''
+    import numpy as np
+    meta = read_meta(prefix)
+    mask_bytes = meta["Mask bytes"]
+    num_labels = len(meta["Labels"])
+    dtype = np.dtype([("addr","<u4"),("mask","u1",(mask_bytes,))])
+    events_file, _, _ = file_names(prefix)
+    with open(events_file,"rb") as file:
+        while True:
+            records = np.fromfile(file,dtype=dtype,count=chunk_events)
+            if len(records) == 0:
+                break
+            bits = np.unpackbits(records["mask"],axis=1,bitorder="little")[:,:num_labels]
+            yield records["addr"], bits
+
+def read_addresses(prefix:str):
+    import numpy as np
+    _, addrs_file, _ = file_names(prefix)
+    return np.fromfile(addrs_file,dtype="<u8")
+
+def exists(prefix:str)->bool:
+    return all(os.path.exists(f) for f in file_names(prefix))
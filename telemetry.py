@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import resource
+from typing import Dict
+
+#Only look at the clock every this many requests, time.time() per request is measurable at trace speed
+CHECK_EVERY = 1024
+
+def rss_bytes()->int:
+    '''
+    Current resident set size, falls back to the peak where /proc is not available
+    '''
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        #ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def occupancy(cache)->float:
+    '''
+    Fraction of the lines of a set associative structure that are in use
+    '''
+    capacity = len(cache.entries) * cache.assoc
+    if capacity == 0:
+        return 0
+    return sum(len(s) for s in cache.entries) / capacity
+
+def engine_structures(engine)->Dict[str,object]:
+    '''
+    Caches and directories of either simulator, by name
+    '''
+    structures = {f"H{host.id}":host for host in engine.hosts}
+    #CoherenceEngine calls its snoop filter device, TopLevelSimulator calls it snpf
+    device = getattr(engine,"device",None) or getattr(engine,"snpf",None)
+    devices = getattr(engine,"devices",{device.id:device})
+    if len(devices) == 1:
+        structures["Device"] = device
+    else:
+        for i,deviceid in enumerate(sorted(devices.keys())):
+            structures[f"D{i}"] = devices[deviceid]
+    for switchid,switch in getattr(engine,"switches",dict()).items():
+        structures[f"S{switchid}"] = switch
+    return structures
+
+class Telemetry:
+    '''
+    Periodically write a machine readable status file for a running simulation
+    The file is replaced atomically so sweep runners can read it at any time
+    '''
+
+    def __init__(self,engine,filename:str,interval:float=5.0,total_requests:int=None):
+        self.engine = engine
+        self.filename = filename
+        self.interval = interval
+        self.total_requests = total_requests
+
+        self.start = time.time()
+        self.last_time = self.start
+        self.last_reqid = 0
+        self.last_migrations = 0
+        self.countdown = CHECK_EVERY
+
+    def tick(self):
+        '''
+        Called once per request
+        '''
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = CHECK_EVERY
+        if time.time() - self.last_time >= self.interval:
+            self.write()
+
+    def migrations(self)->int:
+        stats = getattr(self.engine,"migration_stats",None)
+        return stats["Migration count"] if stats != None else 0
+
+    def status(self,finished:bool=False)->Dict:
+        now = time.time()
+        reqid = self.engine.reqid
+        migrations = self.migrations()
+        window = now - self.last_time
+        window_rate = (reqid - self.last_reqid)/window if window > 0 else 0
+        elapsed = now - self.start
+
+        structures = {name:occupancy(cache) for name,cache in engine_structures(self.engine).items()}
+        host_occupancy = [occ for name,occ in structures.items() if name[0] == 'H']
+
+        status = {
+            "Time": now,
+            "Elapsed": elapsed,
+            "Requests": reqid,
+            "Requests/s": reqid/elapsed if elapsed > 0 else 0,
+            "Window requests/s": window_rate,
+            "RSS bytes": rss_bytes(),
+            "Occupancy": structures,
+            "Mean host occupancy": sum(host_occupancy)/len(host_occupancy) if host_occupancy else 0,
+            "Migrations": migrations,
+            "Window migrations/request": (migrations - self.last_migrations)/(reqid - self.last_reqid) if reqid > self.last_reqid else 0,
+            "Total requests": self.total_requests,
+            "Projected remaining s": None,
+            "Finished": finished
+        }
+        if self.total_requests != None and window_rate > 0 and not finished:
+            status["Projected remaining s"] = max(self.total_requests - reqid,0)/window_rate
+
+        self.last_time = now
+        self.last_reqid = reqid
+        self.last_migrations = migrations
+        return status
+
+    def write(self,finished:bool=False):
+        tmp = f"{self.filename}.tmp"
+        with open(tmp,"w") as file:
+            json.dump(self.status(finished),file,indent=4)
+        os.replace(tmp,self.filename)
+
+    def close(self):
+        self.write(finished=True)
@@ -0,0 +1,321 @@
+import io
+import os
+import sys
+import gzip
+import json
+import zlib
+import argparse
+from typing import Dict, Iterator, List, Tuple
+from traces import Request, parse_line, BINARY_SUFFIX, binary_dtype
+
+#Sidecar index of a trace: where every segment of requests starts, and what it holds
+#  Start     request number of the first request of the segment
+#  Offset    byte offset to seek to, in the compressed file for gzip traces
+#  Skip      requests between Offset and Start, only non zero for gzip members longer than a segment
+#  Hosts     hosts issuing requests in the segment
+#  Min addr, Max addr  address range of the segment
+INDEX_SUFFIX = ".idx.json"
+COMPRESSED_SUFFIX = ".gz"
+#Requests per segment
+DEFAULT_EVERY = 1 << 16
+READ_CHUNK = 1 << 20
+
+def index_file(filename:str)->str:
+    return filename + INDEX_SUFFIX
+
+def trace_format(filename:str)->str:
+    if filename.endswith(BINARY_SUFFIX):
+        return "binary"
+    if filename.endswith(COMPRESSED_SUFFIX):
+        return "gzip"
+    return "text"
+
+class SegmentSummary:
+    '''
+    Running host set and address range of the segment being indexed
+    '''
+
+    def __init__(self,start:int,offset:int,skip:int):
+        self.start = start
+        self.offset = offset
+        self.skip = skip
+        self.hosts = set()
+        self.min_addr = None
+        self.max_addr = None
+
+    def add(self,addr:int,hostid:int):
+        self.hosts.add(hostid)
+        if self.min_addr == None or addr < self.min_addr:
+            self.min_addr = addr
+        if self.max_addr == None or addr > self.max_addr:
+            self.max_addr = addr
+
+    def to_dict(self)->Dict:
+        return {"Start":self.start,
+                "Offset":self.offset,
+                "Skip":self.skip,
+                "Hosts":sorted(self.hosts),
+                "Min addr":hex(self.min_addr) if self.min_addr != None else None,
+                "Max addr":hex(self.max_addr) if self.max_addr != None else None}
+
+def text_lines(filename:str)->Iterator[Tuple[int,bytes]]:
+    '''
+    (byte offset, line) of a plain text trace
+    '''
+    with open(filename,"rb") as file:
+        offset = 0
+        for line in file:
+            yield offset, line
+            offset += len(line)
+
+def gzip_lines(filename:str)->Iterator[Tuple[int,int,bytes]]:
+    '''
+    (offset of the gzip member the line starts in, lines since that member started, line) of a gzip trace
+    Only members that start on a line boundary are seek points, any other member continues the previous one
+    '''
+    with open(filename,"rb") as file:
+        member = 0
+        consumed = 0
+        since = 0
+        pending = b""
+        d = zlib.decompressobj(wbits=31)
+        data = file.read(READ_CHUNK)
+        while data:
+            out = d.decompress(data)
+            if d.eof:
+                #Member boundary, whatever is left over starts the next member
+                used = len(data) - len(d.unused_data)
+                data = d.unused_data
+                consumed += used
+            else:
+                consumed += len(data)
+                data = b""
+            lines = (pending + out).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield member, since, line + b"\n"
+                since += 1
+            if d.eof:
+                d = zlib.decompressobj(wbits=31)
+                if pending == b"":
+                    member = consumed
+                    since = 0
+            if not data:
+                data = file.read(READ_CHUNK)
+        pending += d.flush()
+        if pending:
+            yield member, since, pending
+
+def build_index(filename:str,every:int=DEFAULT_EVERY)->Dict:
+    '''
+    Scan the trace once and write its index next to it
+    '''
+    fmt = trace_format(filename)
+    segments: List[Dict] = []
+    requests = 0
+
+    if fmt == "binary":
+        import numpy as np
+        dtype = binary_dtype()
+        with open(filename,"rb") as file:
+            while True:
+                records = np.fromfile(file,dtype=dtype,count=every)
+                if len(records) == 0:
+                    break
+                segments.append({"Start":requests,
+                                 "Offset":requests*dtype.itemsize,
+                                 "Skip":0,
+                                 "Hosts":np.unique(records["host"]).tolist(),
+                                 "Min addr":hex(int(records["addr"].min())),
+                                 "Max addr":hex(int(records["addr"].max()))})
+                requests += len(records)
+    else:
+        if fmt == "gzip":
+            lines = gzip_lines(filename)
+        else:
+            lines = ((offset,0,line) for offset,line in text_lines(filename))
+        segment = None
+        for offset,skip,line in lines:
+            if not line.strip():
+                continue
+            if requests % every == 0:
+                if segment != None:
+                    segments.append(segment.to_dict())
+                segment = SegmentSummary(requests,offset,skip)
+            addr, op, hostid = parse_line(line.decode())
+            segment.add(addr,hostid)
+            requests += 1
+        if segment != None:
+            segments.append(segment.to_dict())
+
+    stat = os.stat(filename)
+    index = {"Trace":os.path.basename(filename),
+             "Format":fmt,
+             "Size":stat.st_size,
+             "Mtime":stat.st_mtime,
+             "Every":every,
+             "Requests":requests,
+             "Segments":segments}
+    with open(index_file(filename),"w") as file:
+        json.dump(index,file,indent=4)
+    return index
+
+def load_index(filename:str,every:int=DEFAULT_EVERY)->Dict:
+    '''
+    Index of a trace, rebuilt when missing or when the trace changed since it was written
+    '''
+    if os.path.exists(index_file(filename)):
+        with open(index_file(filename)) as file:
+            index = json.load(file)
+        stat = os.stat(filename)
+        if index["Size"] == stat.st_size and index["Mtime"] == stat.st_mtime:
+            return index
+        print(f"Index of {filename} is stale, rebuilding",file=sys.stderr)
+    return build_index(filename,every)
+
+def segment_of(index:Dict,reqid:int)->int:
+    '''
+    Segment holding request reqid
+    '''
+    if reqid < 0 or reqid >= index["Requests"]:
+        print(f"Request {reqid} out of range, {index['Trace']} has {index['Requests']} requests")
+        exit(2)
+    return reqid // index["Every"]
+
+def read_range(filename:str,start:int,end:int=None,index:Dict=None)->Iterator[Request]:
+    '''
+    Stream requests [start, end) of a trace, seeking to the segment holding start instead of reading from the beginning
+    '''
+    if index == None:
+        index = load_index(filename)
+    if end == None or end > index["Requests"]:
+        end = index["Requests"]
+    if start >= end:
+        return
+    segment = index["Segments"][segment_of(index,start)]
+    #Requests to read past before start
+    skip = segment["Skip"] + start - segment["Start"]
+    remaining = end - start
+
+    if index["Format"] == "binary":
+        import numpy as np
+        dtype = binary_dtype()
+        ops = ['R','W']
+        with open(filename,"rb") as file:
+            file.seek(segment["Offset"] + skip*dtype.itemsize)
+            while remaining > 0:
+                records = np.fromfile(file,dtype=dtype,count=min(remaining,READ_CHUNK))
+                if len(records) == 0:
+                    break
+                remaining -= len(records)
+                for addr,op,hostid in zip(records["addr"].tolist(),records["op"].tolist(),records["host"].tolist()):
+                    yield addr, ops[op], hostid
+        return
+
+    with open(filename,"rb") as raw:
+        raw.seek(segment["Offset"])
+        if index["Format"] == "gzip":
+            #GzipFile carries on through the following members
+            file = io.TextIOWrapper(gzip.GzipFile(fileobj=raw))
+        else:
+            file = io.TextIOWrapper(raw)
+        for line in file:
+            if not line.strip():
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            yield parse_line(line)
+            remaining -= 1
+            if remaining == 0:
+                break
+
+def split_ranges(index:Dict,parts:int)->List[Tuple[int,int]]:
+    '''
+    Contiguous [start, end) ranges of about the same number of requests, on segment boundaries so every worker starts with a seek
+    '''
+    num_segments = len(index["Segments"])
+    parts = max(min(parts,num_segments),1)
+    bounds = [index["Segments"][i*num_segments//parts]["Start"] for i in range(parts)] + [index["Requests"]]
+    return [(bounds[i],bounds[i+1]) for i in range(parts)]
+
+def find_segments(index:Dict,hostid:int=None,addr:int=None)->List[int]:
+    '''
+    Segments that may hold requests of a host and/or to an address, from the segment summaries
+    '''
+    found = []
+    for i,segment in enumerate(index["Segments"]):
+        if hostid != None and hostid not in segment["Hosts"]:
+            continue
+        if addr != None and (segment["Min addr"] == None or not int(segment["Min addr"],16) <= addr <= int(segment["Max addr"],16)):
+            continue
+        found.append(i)
+    return found
+
+def compress_blocked(filename:str,output:str,every:int=DEFAULT_EVERY)->Dict:
+    '''
+    Gzip a text trace as one member per segment, so every segment of the compressed trace is a seek point
+    The result is still an ordinary gzip file
+    '''
+    from traces import read_trace
+    with open(output,"wb") as file:
+        block = []
+        for addr,op,hostid in read_trace(filename):
+            block.append(f"{hex(addr)} {op} {hostid}\n")
+            if len(block) == every:
+                file.write(gzip.compress("".join(block).encode()))
+                block = []
+        if block:
+            file.write(gzip.compress("".join(block).encode()))
+    return build_index(output,every)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Seekable index of a trace")
+    sub = parser.add_subparsers(dest="command",required=True)
+
+    build_parser = sub.add_parser("build",help="Index a text, gzip or binary trace")
+    build_parser.add_argument("trace")
+    build_parser.add_argument("--every",type=int,default=DEFAULT_EVERY,help="Requests per segment")
+
+    show_parser = sub.add_parser("show",help="Segments holding a request, host or address")
+    show_parser.add_argument("trace")
+    show_parser.add_argument("--request",type=int,default=None)
+    show_parser.add_argument("--host",type=int,default=None)
+    show_parser.add_argument("--addr",default=None,help="Hex address")
+
+    slice_parser = sub.add_parser("slice",help="Write requests [start, end) in the combined text format")
+    slice_parser.add_argument("trace")
+    slice_parser.add_argument("start",type=int)
+    slice_parser.add_argument("end",type=int,nargs="?",default=None)
+
+    split_parser = sub.add_parser("split",help="Ranges for parallel workers")
+    split_parser.add_argument("trace")
+    split_parser.add_argument("parts",type=int)
+
+    compress_parser = sub.add_parser("compress",help="Gzip a trace with one member per segment, and index it")
+    compress_parser.add_argument("trace")
+    compress_parser.add_argument("output")
+    compress_parser.add_argument("--every",type=int,default=DEFAULT_EVERY,help="Requests per segment")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build_index(args.trace,args.every)
+        print(f"{index['Requests']} requests in {len(index['Segments'])} segments, written to {index_file(args.trace)}")
+    elif args.command == "show":
+        index = load_index(args.trace)
+        if args.request != None:
+            found = [segment_of(index,args.request)]
+        else:
+            found = find_segments(index,args.host,int(args.addr,16) if args.addr != None else None)
+        for i in found:
+            print(json.dumps(index["Segments"][i]))
+    elif args.command == "slice":
+        for addr,op,hostid in read_range(args.trace,args.start,args.end):
+            sys.stdout.write(f"{hex(addr)} {op} {hostid}\n")
+    elif args.command == "split":
+        for start,end in split_ranges(load_index(args.trace),args.parts):
+            print(f"{start} {end}")
+    elif args.command == "compress":
+        index = compress_blocked(args.trace,args.output,args.every)
+        print(f"{index['Requests']} requests in {len(index['Segments'])} gzip members, written to {args.output}")
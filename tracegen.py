@@ -0,0 +1,250 @@
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from typing import Dict, Tuple
+from traces import BINARY_SUFFIX, binary_dtype
+
+#Requests are generated a chunk at a time, every chunk has its own random stream derived from the seed and its index,
+#so chunks can be made in parallel and the trace only depends on the seed and the chunk size
+CHUNK = 1 << 20
+
+PRIVATE = 0
+SHARED = 1
+MIGRATORY = 2
+
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef",dtype=np.uint8)
+
+#How the parameters map onto the flows the coherence engine classifies
+#  Private lines: first touch is flow 11, a footprint larger than the host cache adds host evictions from owners (1)
+#  Shared lines: reads by the sharing group are flow 8, reads after a write are 6,
+#                writes are 10 (other sharers) or 9 (lone sharer), writes after another host's write are 7
+#                evicting shared lines gives 2 and 3
+#  Migratory lines: a read then a write by one host, handed from host to host, so 6 followed by 9 or 7
+#  A total footprint larger than the directories adds directory initiated evictions (4, 5)
+#  Temporal locality turns part of every category into cache hits that never reach the engine
+
+class TraceParams:
+    '''
+    Knobs of the synthetic workload, in cache lines and fractions of requests
+    '''
+
+    def __init__(self,d:Dict):
+        self.num_hosts = d.get("Num hosts",16)
+        self.requests = d.get("Requests",1 << 24)
+        self.seed = d.get("Seed",0)
+        self.line_size = d.get("Line size",64)
+        #Private lines per host
+        self.footprint = d.get("Footprint",4096)
+        self.shared_lines = d.get("Shared lines",16384)
+        #Number of hosts that share each shared line
+        self.sharing_degree = d.get("Sharing degree",4)
+        self.shared_fraction = d.get("Shared fraction",0.3)
+        self.migratory_lines = d.get("Migratory lines",1024)
+        self.migratory_fraction = d.get("Migratory fraction",0.1)
+        self.write_ratio = d.get("Write ratio",0.3)
+        self.shared_write_ratio = d.get("Shared write ratio",0.05)
+        #Probability that a request repeats the line and host of a recent request, and the mean distance back
+        self.reuse = d.get("Reuse",0.5)
+        self.reuse_distance = d.get("Reuse distance",64)
+
+        assert self.num_hosts <= np.iinfo(np.uint16).max, f"At most {np.iinfo(np.uint16).max} hosts"
+        assert 1 <= self.sharing_degree <= self.num_hosts, f"Sharing degree {self.sharing_degree} with {self.num_hosts} hosts"
+        assert self.shared_fraction + self.migratory_fraction <= 1, "Shared and migratory fractions add up to more than 1"
+
+class TraceGenerator:
+    '''
+    Vectorized synthetic trace generator
+    Requests are made in pairs so a migratory visit (read then write by one host) stays adjacent
+    '''
+
+    def __init__(self,params:TraceParams):
+        self.p = params
+        #Line layout: shared lines, then migratory lines, then the private region of every host
+        self.migratory_base = params.shared_lines
+        self.private_base = params.shared_lines + params.migratory_lines
+        self.groups = max(params.num_hosts // params.sharing_degree,1)
+        self.max_addr = (self.private_base + params.num_hosts*params.footprint) * params.line_size
+
+    def chunk(self,index:int,n:int)->Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        '''
+        n requests of chunk index as arrays of byte address, op (1 for write) and host
+        '''
+        p = self.p
+        rng = np.random.default_rng([p.seed,index])
+        units = (n + 1)//2
+        shape = (units,2)
+
+        u = rng.random(units)
+        category = np.where(u < p.migratory_fraction,MIGRATORY,np.where(u < p.migratory_fraction + p.shared_fraction,SHARED,PRIVATE))
+        category = np.repeat(category,2).reshape(shape)
+
+        #Private: any host, a line of its own region
+        private_host = rng.integers(p.num_hosts,size=shape)
+        private_line = self.private_base + private_host.astype(np.int64)*p.footprint + rng.integers(p.footprint,size=shape)
+        private_op = rng.random(shape) < p.write_ratio
+
+        #Shared: a line, then one of the hosts of its sharing group
+        shared_line = rng.integers(max(p.shared_lines,1),size=shape)
+        shared_host = ((shared_line % self.groups)*p.sharing_degree + rng.integers(p.sharing_degree,size=shape)) % p.num_hosts
+        shared_op = rng.random(shape) < p.shared_write_ratio
+
+        #Migratory: one line and one host per pair, read then write
+        migratory_line = np.repeat(self.migratory_base + rng.integers(max(p.migratory_lines,1),size=units),2).reshape(shape)
+        migratory_host = np.repeat(rng.integers(p.num_hosts,size=units),2).reshape(shape)
+        migratory_op = np.tile(np.array([False,True]),(units,1))
+
+        line = np.select([category == PRIVATE,category == SHARED],[private_line,shared_line],migratory_line).ravel()[:n]
+        host = np.select([category == PRIVATE,category == SHARED],[private_host,shared_host],migratory_host).ravel()[:n]
+        op = np.select([category == PRIVATE,category == SHARED],[private_op,shared_op],migratory_op).ravel()[:n]
+        category = category.ravel()[:n]
+
+        if p.reuse > 0:
+            line, host, op = self.add_reuse(rng,line,host,op,category)
+
+        return line*p.line_size, op.astype(np.uint8), host.astype(np.uint16)
+
+    def add_reuse(self,rng:np.random.Generator,line:np.ndarray,host:np.ndarray,op:np.ndarray,category:np.ndarray):
+        '''
+        Replace some requests with a repeat of an earlier request of the chunk, geometric distance back
+        Migratory pairs are left alone so their read and write stay together
+        '''
+        p = self.p
+        n = len(line)
+        idx = np.arange(n)
+        src = idx - rng.geometric(1/p.reuse_distance,size=n)
+        repeat = (rng.random(n) < p.reuse) & (src >= 0) & (category != MIGRATORY)
+        src = np.where(repeat,src,idx)
+        #A repeat of a repeat goes back to the original request, pointer jumping resolves the chains in log steps
+        while True:
+            nxt = src[src]
+            if np.array_equal(nxt,src):
+                break
+            src = nxt
+        rate = np.array([p.write_ratio,p.shared_write_ratio,p.write_ratio])[category[src]]
+        op = np.where(repeat,rng.random(n) < rate,op)
+        return line[src], host[src], op
+
+def format_text(addr:np.ndarray,op:np.ndarray,host:np.ndarray,width:int)->bytes:
+    '''
+    Render requests as '0xaddr R|W host' lines without a per request Python loop
+    Addresses are zero padded to width hex digits, hosts are plain decimal
+    '''
+    n = len(addr)
+    #Everything after the address, one entry per (host, op)
+    num_hosts = int(host.max()) + 1 if n else 1
+    suffixes = [f" {o} {h}\n".encode() for h in range(num_hosts) for o in "RW"]
+    suffix_len = np.array([len(s) for s in suffixes])
+    suffix_table = np.zeros((len(suffixes),suffix_len.max()),dtype=np.uint8)
+    for i,s in enumerate(suffixes):
+        suffix_table[i,:len(s)] = np.frombuffer(s,dtype=np.uint8)
+    code = host.astype(np.int64)*2 + op
+
+    row_len = 2 + width + suffix_len[code]
+    start = np.zeros(n,dtype=np.int64)
+    np.cumsum(row_len[:-1],out=start[1:])
+    buf = np.empty(int(row_len.sum()),dtype=np.uint8)
+
+    buf[start] = ord('0')
+    buf[start + 1] = ord('x')
+    for j in range(width):
+        buf[start + 2 + j] = HEX_DIGITS[(addr >> np.uint64(4*(width - 1 - j))) & np.uint64(0xF)]
+    #Suffixes differ in length, fill one length at a time
+    for length in np.unique(suffix_len):
+        rows = suffix_len[code] == length
+        base = start[rows] + 2 + width
+        codes = code[rows]
+        for k in range(length):
+            buf[base + k] = suffix_table[codes,k]
+    return buf.tobytes()
+
+#Worker state, set once per process by init_worker
+worker_gen: TraceGenerator = None
+worker_binary = False
+worker_width = 0
+
+def init_worker(params:TraceParams,binary:bool):
+    global worker_gen, worker_binary, worker_width
+    worker_gen = TraceGenerator(params)
+    worker_binary = binary
+    worker_width = max(1,(int(worker_gen.max_addr).bit_length() + 3)//4)
+
+def render_chunk(index:int)->bytes:
+    '''
+    One chunk of the trace in its final on disk form
+    '''
+    n = min(CHUNK,worker_gen.p.requests - index*CHUNK)
+    addr, op, host = worker_gen.chunk(index,n)
+    if worker_binary:
+        records = np.empty(n,dtype=binary_dtype())
+        records["addr"] = addr
+        records["op"] = op
+        records["host"] = host
+        return records.tobytes()
+    return format_text(addr.astype(np.uint64),op,host,worker_width)
+
+def generate(params:TraceParams,filename:str,workers:int=1)->int:
+    '''
+    Write the trace, binary if the filename ends in the binary suffix, returns the bytes written
+    The output does not depend on the number of workers
+    '''
+    binary = filename.endswith(BINARY_SUFFIX)
+    chunks = range((params.requests + CHUNK - 1)//CHUNK)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,initializer=init_worker,initargs=(params,binary))
+        #imap keeps chunk order
+        rendered = pool.imap(render_chunk,chunks)
+    else:
+        init_worker(params,binary)
+        rendered = map(render_chunk,chunks)
+    written = 0
+    with open(filename,"wb") as file:
+        for data in rendered:
+            file.write(data)
+            written += len(data)
+    if pool != None:
+        pool.close()
+    return written
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic trace, text or binary (.btrace)")
+    parser.add_argument("output")
+    parser.add_argument("--hosts",type=int,default=16)
+    parser.add_argument("--requests",type=int,default=1 << 24)
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--line-size",type=int,default=64)
+    parser.add_argument("--footprint",type=int,default=4096,help="Private lines per host")
+    parser.add_argument("--shared-lines",type=int,default=16384)
+    parser.add_argument("--sharing-degree",type=int,default=4)
+    parser.add_argument("--shared-fraction",type=float,default=0.3)
+    parser.add_argument("--migratory-lines",type=int,default=1024)
+    parser.add_argument("--migratory-fraction",type=float,default=0.1)
+    parser.add_argument("--write-ratio",type=float,default=0.3)
+    parser.add_argument("--shared-write-ratio",type=float,default=0.05)
+    parser.add_argument("--reuse",type=float,default=0.5,help="Probability of repeating a recent request")
+    parser.add_argument("--reuse-distance",type=float,default=64,help="Mean distance back of a repeat")
+    parser.add_argument("--workers",type=int,default=1)
+    args = parser.parse_args()
+
+    params = TraceParams({
+        "Num hosts": args.hosts,
+        "Requests": args.requests,
+        "Seed": args.seed,
+        "Line size": args.line_size,
+        "Footprint": args.footprint,
+        "Shared lines": args.shared_lines,
+        "Sharing degree": args.sharing_degree,
+        "Shared fraction": args.shared_fraction,
+        "Migratory lines": args.migratory_lines,
+        "Migratory fraction": args.migratory_fraction,
+        "Write ratio": args.write_ratio,
+        "Shared write ratio": args.shared_write_ratio,
+        "Reuse": args.reuse,
+        "Reuse distance": args.reuse_distance
+    })
+    start = time.time()
+    written = generate(params,args.output,args.workers)
+    elapsed = time.time() - start
+    print(f"Wrote {params.requests} requests, {written/(1 << 20):.0f}MB in {elapsed:.1f}s ({written/(1 << 20)/elapsed:.0f}MB/s)")
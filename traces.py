@@ -0,0 +1,216 @@
+import os
+import sys
+import heapq
+from typing import Iterator, List, Tuple
+
+#A request as handed to the simulators: (address, 'R' or 'W', host id)
+Request = Tuple[int, str, int]
+
+MERGE_POLICIES = ["timestamp", "round_robin", "skewed"]
+
+def parse_line(line:str)->Request:
+    '''
+    Parse one line of the combined trace format '0xaddr R|W hostid'
+    '''
+    s = line.split(' ')
+    return int(s[0],16), s[1], int(s[2].strip())
+
+#Binary traces hold the same requests as fixed size records, op is 0 for R and 1 for W
+BINARY_SUFFIX = ".btrace"
+BINARY_FIELDS = [("addr","<u8"),("op","u1"),("host","<u2")]
+BINARY_CHUNK = 1 << 20
+
+def binary_dtype():
+    #numpy is only needed for binary traces
+    import numpy as np
+    return np.dtype(BINARY_FIELDS)
+
+def read_binary_trace(filename:str)->Iterator[Request]:
+    '''
+    Stream requests from a binary trace, a chunk of records at a time
+    '''
+    import numpy as np
+    dtype = binary_dtype()
+    ops = ['R','W']
+    with open(filename,"rb") as file:
+        while True:
+            records = np.fromfile(file,dtype=dtype,count=BINARY_CHUNK)
+            if len(records) == 0:
+                break
+            for addr,op,hostid in zip(records["addr"].tolist(),records["op"].tolist(),records["host"].tolist()):
+                yield addr, ops[op], hostid
+
+def read_trace(filename:str,start:int=0,end:int=None)->Iterator[Request]:
+    '''
+    Stream requests from a combined trace file, text, gzip compressed text or binary
+    Requests [start, end) only are read through the trace index when a range is given
+    '''
+    if start > 0 or end != None:
+        from trace_index import read_range
+        yield from read_range(filename,start,end)
+        return
+    if filename.endswith(BINARY_SUFFIX):
+        yield from read_binary_trace(filename)
+        return
+    if filename.endswith(".gz"):
+        import gzip
+        file = gzip.open(filename,"rt")
+    else:
+        file = open(filename)
+    with file:
+        while True:
+            line = file.readline()
+            if not line:
+                break
+            yield parse_line(line)
+
+def estimate_requests(filename:str,sample_bytes:int=1<<20,start:int=0,end:int=None)->int:
+    '''
+    Estimate the number of requests in a trace from its size and the line length at its start
+    With start or end, the requests read_trace yields for that range, counted by the trace index
+    '''
+    from trace_index import index_file, load_index
+    if start > 0 or end != None:
+        total = load_index(filename)["Requests"]
+        return max(min(end if end != None else total,total) - start,0)
+    size = os.path.getsize(filename)
+    if filename.endswith(BINARY_SUFFIX):
+        return size // binary_dtype().itemsize
+    if os.path.exists(index_file(filename)):
+        #Rebuilt if the trace changed since it was indexed
+        return load_index(filename)["Requests"]
+    if filename.endswith(".gz"):
+        #Lines per compressed byte of the start of the trace
+        import zlib
+        with open(filename,"rb") as file:
+            compressed = file.read(sample_bytes)
+        d = zlib.decompressobj(wbits=31)
+        lines = d.decompress(compressed).count(b"\n")
+        used = len(compressed) - len(d.unused_data)
+        return int(size * lines / used) if used else 0
+    with open(filename,"rb") as file:
+        sample = file.read(sample_bytes)
+    lines = sample.count(b"\n")
+    if lines == 0:
+        return 1 if size > 0 else 0
+    return int(size * lines / len(sample))
+
+def read_host_trace(filename:str,hostid:int)->Iterator[Tuple[float,int,str,int]]:
+    '''
+    Stream requests from a per-host trace file
+    Lines are either 'timestamp 0xaddr R|W' or just '0xaddr R|W' when the tracer did not record time
+    Requests without a timestamp get None
+    '''
+    with open(filename) as file:
+        while True:
+            line = file.readline()
+            if not line:
+                break
+            s = line.split()
+            if len(s) == 0:
+                continue
+            if len(s) == 3:
+                yield float(s[0]), int(s[1],16), s[2], hostid
+            else:
+                yield None, int(s[0],16), s[1], hostid
+
+def merge_by_timestamp(streams:List[Iterator])->Iterator[Request]:
+    '''
+    k-way merge of per-host streams in global timestamp order
+    Only the head of every stream is held in memory, ties are broken by stream order
+    '''
+    def head(idx:int):
+        rec = next(streams[idx],None)
+        if rec != None and rec[0] == None:
+            print(f"Request without timestamp in stream {idx}, use round_robin or skewed merge policy")
+            exit(2)
+        return rec
+
+    heap = []
+    for idx in range(len(streams)):
+        rec = head(idx)
+        if rec != None:
+            heap.append((rec[0],idx,rec))
+    heapq.heapify(heap)
+
+    while heap:
+        ts, idx, rec = heap[0]
+        yield rec[1], rec[2], rec[3]
+        nxt = head(idx)
+        if nxt != None:
+            heapq.heapreplace(heap,(nxt[0],idx,nxt))
+        else:
+            heapq.heappop(heap)
+
+def merge_round_robin(streams:List[Iterator])->Iterator[Request]:
+    '''
+    Interleave per-host streams one request at a time ignoring timestamps
+    '''
+    active = list(streams)
+    while active:
+        still_active = []
+        for stream in active:
+            rec = next(stream,None)
+            if rec == None:
+                continue
+            still_active.append(stream)
+            yield rec[1], rec[2], rec[3]
+        active = still_active
+
+def merge_weighted(streams:List[Iterator],weights:List[int])->Iterator[Request]:
+    '''
+    Interleave per-host streams ignoring timestamps, skewed by per-stream weights
+    Uses smooth weighted round robin, so a stream with weight 3 issues three requests for every one of a stream with weight 1,
+    spread out rather than in bursts
+    '''
+    assert len(weights) == len(streams), f"{len(weights)} weights given for {len(streams)} traces"
+    assert all(w > 0 for w in weights), f"Merge weights must be positive {weights}"
+
+    active = {idx:weights[idx] for idx in range(len(streams))}
+    current = {idx:0 for idx in active.keys()}
+    while active:
+        total = sum(active.values())
+        for idx,w in active.items():
+            current[idx] += w
+        pick = max(active,key=lambda idx: current[idx])
+        current[pick] -= total
+        rec = next(streams[pick],None)
+        if rec == None:
+            #Stream exhausted, drop it from the rotation
+            del active[pick]
+            del current[pick]
+            continue
+        yield rec[1], rec[2], rec[3]
+
+def merge_host_traces(filenames:List[str],policy:str="timestamp",weights:List[int]=None,hostids:List[int]=None)->Iterator[Request]:
+    '''
+    Combine one trace per host into a single request stream without materializing the merged trace
+    Host ids default to the position of the file in the list
+    '''
+    if hostids == None:
+        hostids = list(range(len(filenames)))
+    assert len(hostids) == len(filenames), f"{len(hostids)} host ids given for {len(filenames)} traces"
+
+    streams = [read_host_trace(f,h) for f,h in zip(filenames,hostids)]
+
+    if policy == "timestamp":
+        return merge_by_timestamp(streams)
+    elif policy == "round_robin":
+        return merge_round_robin(streams)
+    elif policy == "skewed":
+        if weights == None:
+            print("Skewed merge policy needs merge weights")
+            exit(2)
+        return merge_weighted(streams,weights)
+    else:
+        print(f"Unknown merge policy {policy}, expected one of {MERGE_POLICIES}")
+        exit(2)
+
+if __name__ == '__main__':
+
+    #Write out the merged trace in the combined format
+    #Usage: python traces.py <policy>[:w0,w1,...] <host0 trace> <host1 trace> ...
+    policy, _, weight_str = sys.argv[1].partition(':')
+    weights = [int(w) for w in weight_str.split(',')] if weight_str else None
+    for addr,op,hostid in merge_host_traces(sys.argv[2:],policy,weights):
+        sys.stdout.write(f"{hex(addr)} {op} {hostid}\n")
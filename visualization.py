@@ -0,0 +1,44 @@
+import networkx as nx
+import matplotlib.pyplot as plt
+
+#Kept out of the simulators so that headless runs never import matplotlib or need pydot/graphviz
+#Import this module only when a picture is actually wanted
+
+def draw_topology(net,filename:str='CXL_Topology.png',host_color:str='Red',device_color:str='Blue',switch_color:str='Green'):
+    '''
+    Render a CXLNet (from either simulator) with graphviz layout and save it
+    '''
+    positions = nx.nx_pydot.graphviz_layout(net.G)
+
+    print(net.host_ids)
+    print(net.device_ids)
+    print(net.switch_ids)
+
+    node_colors = []
+    for nodeid in net.nodeids:
+        if nodeid in net.host_ids:
+            node_colors.append(host_color)
+        elif nodeid in net.device_ids:
+            node_colors.append(device_color)
+        elif nodeid in net.switch_ids:
+            node_colors.append(switch_color)
+
+    print(node_colors)
+
+    nx.draw_networkx(net.G,pos=positions,nodelist=net.nodeids,node_color=node_colors,with_labels=True)
+    plt.savefig(filename)
+    plt.close()
+
+def plot_switch_distribution(final_val,filename:str="switch_distribution.png"):
+    '''
+    Bar chart of how many cachelines would ideally sit on each switch
+    '''
+    x = range(len(final_val))
+    y = [x for x in final_val.values()]
+    x_label = final_val.keys()
+    plt.xlabel("Switches")
+    plt.ylabel("Number of cachelines")
+    plt.bar(x,y)
+    plt.xticks(ticks=x,labels=x_label)
+    plt.savefig(filename)
+    plt.close()